@@ -1,4 +1,20 @@
 # Monkeypatch cloudpickle into multiprocessing
 import pickle
 import cloudpickle
-pickle.Pickler = cloudpickle.Pickler
\ No newline at end of file
+pickle.Pickler = cloudpickle.Pickler
+
+# multiprocessing's pickler keeps its reducers - for connections, shared memory, and torch's shared tensors - in an
+# instance-level `dispatch_table`. If it was built on top of cloudpickle's, cloudpickle's class-level table shadows
+# that from the C pickler underneath and everything gets pickled by value. So hand the C pickler both.
+import _pickle
+from collections import ChainMap
+from multiprocessing import reduction
+
+if issubclass(reduction.ForkingPickler, cloudpickle.Pickler):
+    _forking_init = reduction.ForkingPickler.__init__
+
+    def _init(self, *args, **kwargs):
+        _forking_init(self, *args, **kwargs)
+        _pickle.Pickler.dispatch_table.__set__(self, ChainMap(self.__dict__['dispatch_table'], cloudpickle.Pickler.dispatch_table))
+
+    reduction.ForkingPickler.__init__ = _init
@@ -0,0 +1,164 @@
+"""Self-play spread over several processes, for when there isn't a GPU to batch all the searches onto. Each actor owns
+a shard of the envs and its own copy of the agent, pinned to its own cores. Samples go back to the learner through a
+ring of shared-memory slots, and weights come back to the actors through a shared-memory copy of the state dict.
+"""
+import os
+import copy
+import torch
+import multiprocessing
+from logging import getLogger
+from rebar import arrdict, dotdict
+from pavlov import stats, logs
+from . import learning
+
+log = getLogger(__name__)
+
+def play(agent, worlds, resigner=None, out=None):
+    """Takes one step in every env of `worlds`, in place. Returns the worlds as they were before the step, along with
+    the decisions and the transition. 
+    
+    The step writes into `worlds`, so the old worlds need a copy of their own. That's written to `out` if it's given,
+    and to a fresh clone if it isn't."""
+    with torch.no_grad():
+        decisions = agent(worlds, value=True)
+    if out is None:
+        old_worlds = worlds.clone()
+    else:
+        old_worlds = out.starmap(torch.Tensor.copy_, worlds)
+    transition = worlds.step_(decisions.actions)
+    if resigner is not None:
+        worlds.reset_(resigner(decisions.v, transition))
+    return arrdict.arrdict(worlds=old_worlds, decisions=decisions, transitions=transition)
+
+def split_cores(n_actors):
+    """Deals the cores this process can run on out between `n_actors`. If there are fewer cores than actors, some of
+    the actors share."""
+    cores = sorted(os.sched_getaffinity(0))
+    return [cores[i::n_actors] or [cores[i % len(cores)]] for i in range(n_actors)]
+
+def _actor(agent, worlds, cores, weights, version, lock, slots, free, ready, stop, depth, resign, run):
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    with logs.to_run(run), stats.to_run(run):
+        resigner = None if resign is None else learning.Resigner(worlds.n_envs, *resign, device=worlds.device)
+
+        seen, t = None, 0
+        while not stop.is_set():
+            if int(version) != seen:
+                with lock:
+                    agent.network.load_state_dict(weights)
+                    seen = int(version)
+                # Any tree carried over was evaluated with the old weights
+                agent.forget()
+
+            while not free.acquire(timeout=1):
+                if stop.is_set():
+                    return
+            # The old worlds go straight into the slot. Assigning through `__setitem__` doesn't reach the tensors of 
+            # a namedarrtuple like `Hex`, so the rest is copied leafwise.
+            slot = slots[t % depth]
+            sample = play(agent, worlds, resigner, out=slot.worlds)
+            slot.decisions.starmap(torch.Tensor.copy_, sample.decisions)
+            slot.transitions.starmap(torch.Tensor.copy_, sample.transitions)
+            ready.release()
+            t += 1
+
+def _wait(actor, f):
+    while not f():
+        if not actor.process.is_alive():
+            raise RuntimeError(f'{actor.process.name} died with exit code {actor.process.exitcode}')
+
+class ActorPool:
+
+    def __init__(self, agent, worlds, n_actors, depth=4, resign=None, run=None):
+        """Shards `worlds` between `n_actors` processes, each of which plays `agent` on its shard. Both should be on
+        the CPU. Each actor runs up to `depth` steps ahead of the learner. With `resign`, each actor resigns its games
+        through a :class:`~boardlaw.learning.Resigner` built from it. Actors log to `run`, if it's given."""
+        ctx = multiprocessing.get_context('spawn')
+        self._depth = depth
+        self._stop = ctx.Event()
+        # A `multiprocessing.Value` won't go through the cloudpickle we've patched in, so the version's a tensor too
+        self._version = torch.zeros((), dtype=torch.long).share_memory_()
+        self._lock = ctx.Lock()
+        self._weights = {k: v.detach().cpu().clone().share_memory_() for k, v in agent.network.state_dict().items()}
+
+        # The ring's shapes come from a sample. Playing a copy keeps any tree it builds from being sent to the actors.
+        exemplar = play(copy.deepcopy(agent), worlds[:1].clone())
+
+        self._actors = []
+        shards = torch.arange(worlds.n_envs).chunk(n_actors)
+        for i, (envs, cores) in enumerate(zip(shards, split_cores(n_actors))):
+            actor = dotdict.dotdict(
+                slots=exemplar.map(lambda x: x.new_zeros((depth, len(envs), *x.shape[1:])).share_memory_()),
+                free=ctx.Semaphore(depth),
+                ready=ctx.Semaphore(0),
+                t=0)
+            actor.process = ctx.Process(
+                target=_actor,
+                name=f'actor-{i}',
+                args=(agent, worlds[envs], cores, self._weights, self._version, self._lock,
+                        actor.slots, actor.free, actor.ready, self._stop, depth, resign, run))
+            actor.process.start()
+            self._actors.append(actor)
+        log.info(f'Launched {len(self._actors)} actors')
+
+    def step(self):
+        """Returns the next step from every actor, concatenated in env order. Blocks until they've all got one ready."""
+        samples = []
+        for actor in self._actors:
+            _wait(actor, lambda: actor.ready.acquire(timeout=1))
+            samples.append(actor.slots[actor.t % self._depth].clone())
+            actor.free.release()
+            actor.t += 1
+        return arrdict.cat(samples)
+
+    def update(self, network):
+        """Broadcasts `network`'s weights to the actors. Each picks them up before its next step."""
+        with self._lock:
+            for k, v in network.state_dict().items():
+                self._weights[k].copy_(v)
+            self._version += 1
+
+    def close(self):
+        self._stop.set()
+        for actor in self._actors:
+            actor.process.join(5)
+            if actor.process.is_alive():
+                log.info(f'Abruptly terminating {actor.process.name}; it should have shut down naturally!')
+                actor.process.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args, **kwargs):
+        self.close()
+
+def test_pool():
+    from . import hex, networks, mcts
+
+    worlds = hex.Hex.initial(6, 3, device='cpu')
+    network = networks.FCModel(worlds.obs_space, worlds.action_space, width=16, depth=1)
+    agent = mcts.MCTSAgent(network, n_nodes=8, noise_eps=0.)
+
+    with ActorPool(agent, worlds, 2, depth=1) as pool:
+        sample = pool.step()
+        assert sample.worlds.board.shape == (6, 3, 3)
+        assert sample.decisions.actions.shape == (6,)
+        assert sample.transitions.rewards.shape == (6, 2)
+
+        # The actors step in place, so consecutive samples should follow on from each other
+        after, _ = sample.worlds.step(sample.decisions.actions)
+        assert torch.equal(pool.step().worlds.board, after.board)
+
+        for p in network.parameters():
+            p.data.zero_()
+        pool.update(network)
+
+        # With depth 1, the slot and the step the actor's blocked on could both predate the update
+        for _ in range(2):
+            pool.step()
+        sample = pool.step()
+        # Without noise, the root's prior comes straight from the network, and a zeroed network's is uniform
+        prior = sample.decisions.prior.float().exp()
+        expected = sample.worlds.valid.float()/sample.worlds.valid.float().sum(-1, keepdim=True)
+        torch.testing.assert_close(prior, expected, atol=1e-3, rtol=0)
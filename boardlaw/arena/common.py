@@ -1,10 +1,12 @@
+import math
 import torch
 import numpy as np
-from rebar import dotdict
+from rebar import dotdict, arrdict
 from logging import getLogger
 from itertools import permutations
 from pavlov import storage, runs
 from ..mcts import MCTSAgent
+from ..networks import EvalCache, Deduplicator
 from ..hex import Hex
 
 log = getLogger(__name__)
@@ -12,7 +14,7 @@ log = getLogger(__name__)
 def agent(run, idx=None, device='cpu'):
     try:
         network = storage.load_raw(run, 'model', device)
-        agent = MCTSAgent(network)
+        agent = MCTSAgent(EvalCache(Deduplicator(network)))
 
         if idx is None:
             sd = storage.load_latest(run)
@@ -51,29 +53,47 @@ def gather(wins, moves, matchup_idxs, names, boardsize):
     return results
 
 def evaluate(worlds, agents):
+    """Plays each env out to the end, with the agents taking seats according to :func:`matchup_indices`.
+
+    The live envs are kept sorted by which agent is to move, so each agent sees contiguous runs of the batch, and 
+    finished games are dropped from the batch as they end. That way there's no work wasted on finished games while 
+    waiting for the last few to end. Sorting and dropping both mean a copy of the worlds, so they only happen on the
+    turns that need them: dropping when some game's just finished, and sorting when the movers have got split into more
+    runs than there are agents."""
     assert worlds.n_seats == 2, 'Only support 2 seats for now'
-    assert worlds.n_envs % np.math.factorial(worlds.n_seats) == 0, 'Number of envs needs to be divisible by the number of permutations of seats'
+    assert worlds.n_envs % math.factorial(worlds.n_seats) == 0, 'Number of envs needs to be divisible by the number of permutations of seats'
     assert len(agents) == worlds.n_seats, 'Need to pass one agent per seat'
 
-    envs = torch.arange(worlds.n_envs, device=worlds.device)
-    terminal = torch.zeros((worlds.n_envs,), dtype=torch.bool, device=worlds.device)
+    names = list(agents)
     wins = torch.zeros((worlds.n_envs, worlds.n_seats), dtype=torch.int, device=worlds.device)
     moves = torch.zeros((worlds.n_envs, worlds.n_seats), dtype=torch.int, device=worlds.device)
     matchup_idxs = matchup_indices(worlds.n_envs, worlds.n_seats).to(worlds.device)
-    while True:
-        for i, id in enumerate(agents):
-            mask = (matchup_idxs[envs, worlds.seats.long()] == i) & ~terminal
-            if mask.any():
-                decisions = agents[id](worlds[mask], eval=True)
-                worlds[mask], transitions = worlds[mask].step(decisions.actions)
-                terminal[mask] = transitions.terminal
-                wins[mask] += (transitions.rewards == 1).int()
-                moves[mask] += 1
-
-        if terminal.all():
-            break
+    boardsize = getattr(worlds, 'boardsize', None)
+
+    # The original index of each env still in play
+    live = torch.arange(worlds.n_envs, device=worlds.device)
+    while len(live) > 0:
+        movers = matchup_idxs[live, worlds.seats.long()]
+        ids, counts = torch.unique_consecutive(movers, return_counts=True)
+        if len(ids) > len(agents):
+            movers, order = torch.sort(movers, stable=True)
+            live, worlds = live[order], worlds[order]
+            ids, counts = torch.unique_consecutive(movers, return_counts=True)
+
+        actions, start = [], 0
+        for id, count in zip(ids.tolist(), counts.tolist()):
+            actions.append(agents[names[id]](worlds[start:start+count], eval=True).actions)
+            start += count
+        worlds, transitions = worlds.step(torch.cat(actions))
+
+        wins.index_add_(0, live, (transitions.rewards == 1).int())
+        moves.index_add_(0, live, torch.ones_like(transitions.rewards, dtype=torch.int))
+
+        # Indexing with a mask keeps the envs in order, so the runs stay as they were
+        if transitions.terminal.any():
+            live, worlds = live[~transitions.terminal], worlds[~transitions.terminal]
     
-    results = gather(wins.cpu(), moves.cpu(), matchup_idxs.cpu(), list(agents), worlds.boardsize)
+    results = gather(wins.cpu(), moves.cpu(), matchup_idxs.cpu(), names, boardsize)
     return results
 
 def test_evaluate():
@@ -83,4 +103,8 @@ def test_evaluate():
     results = evaluate(worlds, {'one': RandomAgent(), 'two': RandomAgent()})
 
     assert results[0].wins == (2., 0.)
-    assert results[1].wins == (2., 0.)
\ No newline at end of file
+    assert results[1].wins == (2., 0.)
+    # Hex games end at different times, so this exercises dropping finished games
+    worlds = Hex.initial(8, 3, device='cpu')
+    results = evaluate(worlds, {'one': RandomAgent(), 'two': RandomAgent()})
+    assert sum(r.games for r in results) == 8
@@ -57,6 +57,10 @@ using I1D = TensorProxy<int, 1>;
 using I2D = TensorProxy<int, 2>;
 using I3D = TensorProxy<int, 3>;
 
+using L1D = TensorProxy<int64_t, 1>;
+using L2D = TensorProxy<int64_t, 2>;
+using L3D = TensorProxy<int64_t, 3>;
+
 using S1D = TensorProxy<short, 1>;
 using S2D = TensorProxy<short, 2>;
 using S3D = TensorProxy<short, 3>;
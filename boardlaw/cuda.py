@@ -1,4 +1,11 @@
+import os
 import sys
+import fcntl
+import hashlib
+import importlib.machinery
+import importlib.util
+from contextlib import contextmanager
+from pathlib import Path
 import torch
 import torch.cuda
 import sysconfig
@@ -6,15 +13,74 @@ from pkg_resources import resource_filename
 
 DEBUG = False
 
-def load_cuda(pkg, files):
-    # This import is pretty slow, so let's defer it
-    import torch.utils.cpp_extension
+# Built extensions are kept here, one directory per combination of sources, flags and torch version. Point this at a
+# shared disk and every worker on every machine can skip the compile. 
+CACHE = Path(os.environ.get('BOARDLAW_EXTENSIONS', Path.home() / '.cache' / 'boardlaw' / 'extensions'))
+SUFFIXES = ('.h', '.cuh', '.cpp', '.cu')
+
+def fingerprint(sources, **kwargs):
+    """A hash of everything that could change the built extension: the sources and any headers alongside them, the 
+    compiler flags, and the torch, CUDA and Python versions."""
+    h = hashlib.sha256()
+    dirs = {Path(s).parent for s in sources} | {Path(resource_filename(__package__, 'cpp'))}
+    for d in sorted(dirs):
+        for path in sorted(d.iterdir()):
+            if path.suffix in SUFFIXES:
+                h.update(path.name.encode())
+                h.update(path.read_bytes())
+    for s in sources:
+        h.update(Path(s).name.encode())
+    h.update(repr(sorted(kwargs.items())).encode())
+    h.update(f'{torch.__version__} {torch.version.cuda} {sys.version}'.encode())
+    return h.hexdigest()[:16]
+
+@contextmanager
+def lock(path):
+    """An exclusive lock that's shared between processes, and released by the OS if the holder dies"""
+    with open(path, 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def import_library(name, path):
+    loader = importlib.machinery.ExtensionFileLoader(name, str(path))
+    spec = importlib.util.spec_from_file_location(name, str(path), loader=loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+def cached(name, sources, **kwargs):
+    """Loads the extension from the cache if it's there, and builds it into the cache if it isn't. Processes that 
+    start at the same time wait on one another rather than all compiling, but once it's built, loading it doesn't 
+    take the lock at all."""
+    directory = CACHE / f'{name}-{fingerprint(sources, **kwargs)}'
+    library = directory / f'{name}.so'
+    # The linker writes the library in place, so its existence alone doesn't mean another process has finished it. 
+    # This marker's only written once it has.
+    built = directory / 'built'
+    if built.exists():
+        return import_library(name, library)
 
+    directory.mkdir(parents=True, exist_ok=True)
+    with lock(CACHE / f'{directory.name}.lock'):
+        if library.exists():
+            module = import_library(name, library)
+        else:
+            # This import is pretty slow, so let's defer it
+            import torch.utils.cpp_extension
+            module = torch.utils.cpp_extension.load(
+                name=name, sources=sources, build_directory=str(directory), **kwargs)
+        built.touch()
+        return module
+
+def load_cuda(pkg, files):
     name = pkg.split('.')[-1] + 'cuda' 
-    [torch_libdir] = torch.utils.cpp_extension.library_paths()
+    torch_libdir = os.path.join(os.path.dirname(torch.__file__), 'lib')
     python_libdir = sysconfig.get_config_var('LIBDIR')
     libpython_ver = sysconfig.get_config_var('LDVERSION')
-    return torch.utils.cpp_extension.load(
+    return cached(
         name=name, 
         sources=[resource_filename(pkg, f'cpp/{fn}') for fn in files], 
         extra_cflags=['-std=c++17'] + (['-g'] if DEBUG else []), 
@@ -27,14 +93,11 @@ def load_cuda(pkg, files):
             f'-L{python_libdir}', f'-Wl,-rpath,{python_libdir}'])
 
 def load_cpu(pkg, files):
-    # This import is pretty slow, so let's defer it
-    import torch.utils.cpp_extension
-
     name = pkg.split('.')[-1] + 'cuda' 
-    [torch_libdir] = torch.utils.cpp_extension.library_paths()
+    torch_libdir = os.path.join(os.path.dirname(torch.__file__), 'lib')
     python_libdir = sysconfig.get_config_var('LIBDIR')
     libpython_ver = sysconfig.get_config_var('LDVERSION')
-    return torch.utils.cpp_extension.load(
+    return cached(
         name=name, 
         sources=[resource_filename(pkg, f'cpp/{fn}') for fn in files], 
         extra_cflags=['-std=c++17', '-DNOCUDA'] + (['-g'] if DEBUG else []), 
@@ -63,6 +126,17 @@ def load(pkg, files=('wrappers.cpp', 'kernels.cu')):
         return load_cpu(pkg, [f for f in files if not f.endswith('.cu')])
 
 
+def build():
+    """Compiles the Hex and MCTS extensions into the cache, so that processes launched later can skip straight to 
+    loading them. Run it with ``python -m boardlaw.cuda``."""
+    from .hex import cuda as hexcuda
+    from .mcts import cuda as mctscuda
+    for module in (hexcuda, mctscuda):
+        print(module.module().__file__)
+
 def assert_shape(x, s):
     assert (x.ndim == len(s)) and x.shape == s, f'Expected {s}, got {x.shape}'
 
+if __name__ == '__main__':
+    build()
+
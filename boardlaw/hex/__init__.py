@@ -1,4 +1,5 @@
 from rebar import arrdict, profiling
+from functools import partial
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
@@ -73,17 +74,26 @@ def plot_board(colors, ax=None, black='dimgray', white='lightgray', edges=True):
 
     return ax
 
-class Hex(arrdict.namedarrtuple(fields=('board', 'seats'))):
+class Hex(arrdict.namedarrtuple(fields=('board', 'seats', 'hash'))):
+    """The `hash` field holds two 64-bit Zobrist hashes per world. `hash[..., 0]` is of the board as it stands, and 
+    `hash[..., 1]` is of the board transposed with the colors swapped - the view white is given by `obs`. So 
+    :attr:`canonical` is the hash of the position as the player to move sees it. Both are kept up to date by the step
+    kernels, and if you leave `hash` out when constructing a world, it's computed from the board, on the board's own 
+    device. Writing to `board` directly leaves the hash stale, so rebuild the world without it if you do that.
+    """
 
     @classmethod
     def initial(cls, n_envs, boardsize=11, device='cuda'):
         # As per OpenSpiel and convention, black plays first.
         return cls(
             board=torch.full((n_envs, boardsize, boardsize), 0, device=device, dtype=torch.uint8),
-            seats=torch.full((n_envs,), 0, device=device, dtype=torch.int))
+            seats=torch.full((n_envs,), 0, device=device, dtype=torch.int),
+            hash=torch.full((n_envs, 2), 0, device=device, dtype=torch.long))
 
     @profiling.nvtx
     def __init__(self, *args, **kwargs):
+        if isinstance(kwargs.get('board'), torch.Tensor) and ('hash' not in kwargs):
+            kwargs['hash'] = cuda.hash(kwargs['board'])
         super().__init__(*args, **kwargs)
         if not isinstance(self.board, torch.Tensor):
             # Need this conditional to deal with the case where we're calling a method like `self.clone()`, and the
@@ -92,7 +102,7 @@ class Hex(arrdict.namedarrtuple(fields=('board', 'seats'))):
 
         self.n_seats = 2
         self.n_envs = self.board.shape[0]
-        self.boardsize = self.board.shape[1]
+        self.boardsize = self.board.shape[-1]
         self.device = self.board.device
 
         self.obs_space = heads.Tensor((self.boardsize, self.boardsize, 2))
@@ -100,6 +110,11 @@ class Hex(arrdict.namedarrtuple(fields=('board', 'seats'))):
 
         self._obs = None
         self._valid = None 
+        self._forest = None
+
+        # Double buffers for `step_`
+        self._spare_obs = None
+        self._spare_valid = None
 
     @property
     def obs(self):
@@ -114,52 +129,233 @@ class Hex(arrdict.namedarrtuple(fields=('board', 'seats'))):
             self._valid = (self.obs == 0).all(-1).reshape(*shape, -1)
         return self._valid
 
+    @property
+    def canonical(self):
+        """The Zobrist hash of the position from the point of view of the player to move. Two worlds with the same
+        canonical hash have the same `obs`, barring collisions."""
+        return self.hash.gather(-1, self.seats.long()[..., None]).squeeze(-1)
+
+    @property
+    def forest(self):
+        """Union-find state for the CPU step kernel, which is what :meth:`step` and :meth:`step_` use on the CPU. It 
+        gives bit-identical results to the flood fill the CUDA kernel uses, but doesn't have to walk a whole group to 
+        relabel it. It's built from the board the first time it's needed, and then carried along by stepping and 
+        indexing. Writes through `__setitem__` drop it; if you edit `board` in place, set `_forest` back to None."""
+        if self._forest is None:
+            S = self.boardsize
+            forest = cuda.forest(self.board.reshape(-1, S, S))
+            self._forest = forest.reshape(*self.board.shape[:-2], *forest.shape[1:])
+        return self._forest
+
     @profiling.nvtx
     def step(self, actions):
         """Args:
-            actions: (n_env, 2)-int tensor between (0, 0) and (boardsize, boardsize). Cells are indexed in row-major
-            order from the top-left.
+            actions: int tensor of cell indices with the same leading shape as the worlds, or of (row, col) pairs 
+            between (0, 0) and (boardsize, boardsize) with an extra trailing dimension of 2. Cells are indexed in 
+            row-major order from the top-left.
             
         Returns:
 
         """
-        if self.board.ndim != 3:
-            #TODO: Support stepping arbitrary batchings. Only needs a reshaping.
-            raise ValueError('You can only step a board with a single batch dimension')
-
-        assert (0 <= actions).all(), 'You passed a negative action'
-        if actions.ndim == 2:
-            actions = actions[..., 0]*self.boardsize + actions[:, 1]
-
-        assert actions.shape == (self.n_envs,)
-        assert self.valid.gather(1, actions[:, None]).squeeze(-1).all()
-
+        actions = self._actions(actions)
         new_board = self.board.clone()
-        rewards = cuda.step(new_board, self.seats.int(), actions.int())
+        new_hash = self.hash.clone()
+        new_forest = self.forest.clone() if (self.device.type == 'cpu') else None
+        rewards = self._step_flat(new_board, new_hash, new_forest, actions)
         terminal = (rewards > 0).any(-1)
 
         new_board[terminal] = 0
+        new_hash[terminal] = 0
 
         new_seat = 1 - self.seats
         new_seat[terminal] = 0
 
-        new_world = type(self)(board=new_board, seats=new_seat)
+        new_world = type(self)(board=new_board, seats=new_seat, hash=new_hash)
+        if new_forest is not None:
+            new_forest[terminal] = torch.arange(new_forest.size(-1), dtype=new_forest.dtype, device=self.device)
+            new_world._forest = new_forest
 
         transition = arrdict.arrdict(
             terminal=terminal, 
             rewards=rewards)
         return new_world, transition
 
+    @profiling.nvtx
+    def step_(self, actions):
+        """In-place version of :meth:`step`. The board and seats are written to directly, and the cached `obs` and
+        `valid` are updated incrementally rather than recomputed. Anything holding a reference to this world's 
+        tensors - like a buffer of past worlds - will see them change, so clone before stepping if you need to keep
+        the old state around.
+
+        Returns just the transition.
+        """
+        actions = self._actions(actions)
+        obs, valid = self._obs, self._valid
+
+        forest = self.forest if (self.device.type == 'cpu') else None
+        rewards = self._step_flat(self.board, self.hash, forest, actions)
+        terminal = (rewards > 0).any(-1)
+
+        self.board[terminal] = 0
+        self.hash[terminal] = 0
+        if self._forest is not None:
+            self._forest[terminal] = torch.arange(self._forest.size(-1), dtype=self._forest.dtype, device=self.device)
+
+        self.seats.neg_().add_(1)
+        self.seats[terminal] = 0
+
+        # The mover sees their stone at (a // S, a % S) in channel 0. The next player sees the same board 
+        # transposed with the channels swapped. That's a full rewrite, so flip between two buffers rather 
+        # than allocating a new one each step.
+        S = self.boardsize
+        flat_actions = actions.reshape(-1)
+        envs = torch.arange(flat_actions.size(0), device=self.device)
+        if obs is not None:
+            flat, spare = obs.view(-1, S, S, 2), self._spare_obs
+            flat[envs, flat_actions // S, flat_actions % S, 0] = 1.
+            if spare is None:
+                spare = torch.empty_like(obs)
+            spare.view(-1, S, S, 2)[..., 0].copy_(flat[..., 1].transpose(1, 2))
+            spare.view(-1, S, S, 2)[..., 1].copy_(flat[..., 0].transpose(1, 2))
+            spare[terminal] = 0.
+            self._obs, self._spare_obs = spare, obs
+
+        if valid is not None:
+            flat, spare = valid.view(-1, S, S), self._spare_valid
+            flat.view(-1, S*S)[envs, flat_actions] = False
+            if spare is None:
+                spare = torch.empty_like(valid)
+            spare.view(-1, S, S).copy_(flat.transpose(1, 2))
+            spare[terminal] = True
+            self._valid, self._spare_valid = spare, valid
+
+        return arrdict.arrdict(
+            terminal=terminal, 
+            rewards=rewards)
+
+    @profiling.nvtx
+    def reset_(self, mask):
+        """Restarts the games in the envs picked out by `mask` from an empty board, in place. The cached `obs` and
+        `valid` are patched rather than dropped, same as in :meth:`step_`."""
+        self.board[mask] = 0
+        self.hash[mask] = 0
+        if self._forest is not None:
+            self._forest[mask] = torch.arange(self._forest.size(-1), dtype=self._forest.dtype, device=self.device)
+        self.seats[mask] = 0
+        if self._obs is not None:
+            self._obs[mask] = 0.
+        if self._valid is not None:
+            self._valid[mask] = True
+
+    @profiling.nvtx
+    def step_at(self, parents, leaves, actions):
+        """Fused gather-step-scatter for a (n_envs, n_nodes) store of worlds, like the one MCTS keeps. For each env 
+        `e`, the world at node `parents[e]` is stepped with `actions[e]` and the result written to node `leaves[e]`,
+        all in place. This saves gathering the parents into a batch and scattering the children back.
+
+        Returns the (n_envs,)-batched transition.
+        """
+        if self.board.ndim != 4:
+            raise ValueError('You can only `step_at` a store with (n_envs, n_nodes) batch dimensions')
+        S = self.boardsize
+        envs = torch.arange(self.n_envs, device=self.device)
+
+        assert (0 <= actions).all(), 'You passed a negative action'
+        if actions.shape == (self.n_envs, 2):
+            actions = actions[..., 0]*S + actions[..., 1]
+        assert actions.shape == (self.n_envs,)
+
+        # Checking against the parents' boards directly is much cheaper than computing `valid` for the whole store
+        seats = self.seats[envs, parents]
+        rows = torch.where(seats == 0, actions // S, actions % S)
+        cols = torch.where(seats == 0, actions % S, actions // S)
+        assert (self.board[envs, parents, rows, cols] == 0).all()
+
+        rewards = cuda.step_at(self.board, self.seats, self.hash, parents.int(), leaves.int(), actions.int())
+        terminal = (rewards > 0).any(-1)
+
+        self._obs = None
+        self._valid = None
+        self._forest = None
+
+        return arrdict.arrdict(
+            terminal=terminal, 
+            rewards=rewards)
+
+    @profiling.nvtx
+    def playout(self, n_steps=None, seed=None):
+        """Plays uniformly-random moves for every env in a single native call. 
+        
+        With `n_steps=None`, each game is played to its end and the final board is left in place - it isn't reset 
+        like `step` would. With an int, each env plays exactly that many moves, with finished games restarted as in 
+        `step`. On CUDA the work is done on the CPU and copied back.
+
+        `seed` fixes the moves played; if it's not given, one is drawn from torch's global RNG.
+
+        Returns the new worlds and an arrdict of 
+            * `rewards`: the result of each env's last finished game, or zero if it didn't finish one.
+            * `first_actions`: the first move each env made, in the same frame as `step`'s actions. 
+        """
+        if self.board.ndim != 3:
+            raise ValueError('You can only play out a board with a single batch dimension')
+        if seed is None:
+            seed = int(torch.randint(2**62, ()))
+
+        board, seats, hash = self.board.clone(), self.seats.int().clone(), self.hash.clone()
+        n_steps = -1 if n_steps is None else n_steps
+        rewards, first_actions = cuda.playout(board, seats, hash, n_steps, seed)
+
+        worlds = type(self)(board=board, seats=seats.type(self.seats.dtype), hash=hash)
+        return worlds, arrdict.arrdict(
+            rewards=rewards,
+            first_actions=first_actions.long())
+
+    def _actions(self, actions):
+        shape = self.board.shape[:-2]
+
+        assert (0 <= actions).all(), 'You passed a negative action'
+        if actions.shape == (*shape, 2):
+            actions = actions[..., 0]*self.boardsize + actions[..., 1]
+
+        assert actions.shape == shape
+        assert self.valid.gather(-1, actions[..., None]).squeeze(-1).all()
+        return actions
+
+    def _step_flat(self, board, hash, forest, actions):
+        # The kernels only know about a single batch dimension
+        S = self.boardsize
+        shape = board.shape[:-2]
+        flat_board = board.view(-1, S, S)
+        flat_seats = self.seats.reshape(-1).int()
+        flat_hash = hash.view(-1, 2)
+        flat_actions = actions.reshape(-1).int()
+        if forest is not None:
+            flat_forest = forest.view(-1, *forest.shape[-2:])
+            rewards = cuda.step_uf(flat_board, flat_forest, flat_seats, flat_actions, flat_hash)
+        else:
+            rewards = cuda.step(flat_board, flat_seats, flat_actions, flat_hash)
+        return rewards.reshape(*shape, 2)
+
     @profiling.nvtx
     def __getitem__(self, x):
-        # Just exists for profiling
-        return super().__getitem__(x)
+        world = super().__getitem__(x)
+        # The forest has the same batch dimensions as the board, so it can come along rather than be rebuilt
+        if (self._forest is not None) and isinstance(world, Hex) and isinstance(world.board, torch.Tensor):
+            world._forest = self._forest[x]
+        return world
 
     @profiling.nvtx
     def __setitem__(self, x, y):
-        # Just exists for profiling
+        # Writing to the board invalidates the union-find state and the cached obs
+        self._forest = None
+        self._obs = None
+        self._valid = None
         return super().__setitem__(x, y)
 
+    def __reduce__(self):
+        # The default pickling builds an empty world and fills it in, which the field check won't allow
+        return (partial(type(self), **dict(self)), ())
+
     @classmethod
     def plot_worlds(cls, worlds, e=None, ax=None, colors='obs'):
         e = (0,)*(worlds.board.ndim-2) if e is None else e
@@ -177,6 +373,222 @@ class Hex(arrdict.namedarrtuple(fields=('board', 'seats'))):
         plt.close(ax.figure)
         return ax
 
+def _bitboard(boardsize, fields):
+    # The per-size subclasses are made on the fly, so a fresh process might not have them yet
+    return Bitboard.sized(boardsize)(**fields)
+
+class Bitboard(arrdict.namedarrtuple(fields=('bits', 'seats', 'hash'))):
+    """Hex with the stones packed into 64-bit words, CPU only. `bits[..., :, :]` is four planes of ceil(S²/64) words:
+    black's stones, white's stones, the stones connected to their player's first edge (top for black, left for 
+    white) and those connected to their second edge. Keeping the edge planes up to date means a step only has to 
+    look at the new stone's neighbours.
+    
+    Plays identically to :class:`Hex` - same rewards, same `obs`, same `hash` - and supports the same `step`, 
+    `step_`, `reset_`, `step_at` and `playout`, so it can be used anywhere a :class:`Hex` can. A board takes 
+    32*ceil(S²/64) bytes rather than S² bytes, and boards up to 32x32 are supported.
+
+    The board size can't be recovered from the packed words, so each board size gets its own subclass. Use 
+    :meth:`initial` or :meth:`from_hex` rather than the constructor.
+    """
+
+    boardsize = None
+
+    @classmethod
+    def sized(cls, boardsize):
+        name = f'Bitboard{boardsize}'
+        if name not in globals():
+            globals()[name] = type(name, (Bitboard,), {'boardsize': boardsize, '__qualname__': name})
+        return globals()[name]
+
+    @classmethod
+    def initial(cls, n_envs, boardsize=11, device='cpu'):
+        n_words = (boardsize**2 + 63)//64
+        return cls.sized(boardsize)(
+            bits=torch.full((n_envs, 4, n_words), 0, device=device, dtype=torch.long),
+            seats=torch.full((n_envs,), 0, device=device, dtype=torch.int),
+            hash=torch.full((n_envs, 2), 0, device=device, dtype=torch.long))
+
+    @classmethod
+    def from_hex(cls, worlds):
+        S = worlds.boardsize
+        shape = worlds.board.shape[:-2]
+        bits = cuda.pack(worlds.board.reshape(-1, S, S))
+        return cls.sized(S)(
+            bits=bits.reshape(*shape, *bits.shape[-2:]),
+            seats=worlds.seats.clone(),
+            hash=worlds.hash.clone())
+
+    @profiling.nvtx
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not isinstance(self.bits, torch.Tensor):
+            return 
+        if self.boardsize is None:
+            raise ValueError('Create bitboards with `Bitboard.initial` or `Bitboard.from_hex`')
+
+        self.n_seats = 2
+        self.n_envs = self.bits.shape[0]
+        self.device = self.bits.device
+
+        self.obs_space = heads.Tensor((self.boardsize, self.boardsize, 2))
+        self.action_space = heads.Masked(self.boardsize*self.boardsize)
+
+        self._obs = None
+        self._valid = None 
+
+    @property
+    def obs(self):
+        if self._obs is None:
+            self._obs = cuda.bits_observe(self.bits, self.seats, self.boardsize)
+        return self._obs
+
+    @property
+    def valid(self):
+        if self._valid is None:
+            shape = self.bits.shape[:-2]
+            self._valid = (self.obs == 0).all(-1).reshape(*shape, -1)
+        return self._valid
+
+    canonical = Hex.canonical
+
+    @property
+    def board(self):
+        """The equivalent :class:`Hex` board, edge markers and all"""
+        flat = cuda.unpack(self.bits.reshape(-1, *self.bits.shape[-2:]), self.boardsize)
+        return flat.reshape(*self.bits.shape[:-2], self.boardsize, self.boardsize)
+
+    def to_hex(self):
+        return Hex(board=self.board, seats=self.seats.clone(), hash=self.hash.clone())
+
+    @profiling.nvtx
+    def step(self, actions):
+        """Same as :meth:`Hex.step`"""
+        actions = self._actions(actions)
+        new_bits = self.bits.clone()
+        new_hash = self.hash.clone()
+        rewards = self._step_flat(new_bits, new_hash, actions)
+        terminal = (rewards > 0).any(-1)
+
+        new_bits[terminal] = 0
+        new_hash[terminal] = 0
+
+        new_seat = 1 - self.seats
+        new_seat[terminal] = 0
+
+        new_world = type(self)(bits=new_bits, seats=new_seat, hash=new_hash)
+
+        transition = arrdict.arrdict(
+            terminal=terminal, 
+            rewards=rewards)
+        return new_world, transition
+
+    @profiling.nvtx
+    def step_(self, actions):
+        """Same as :meth:`Hex.step_`, except that the cached `obs` and `valid` are dropped rather than patched"""
+        actions = self._actions(actions)
+        rewards = self._step_flat(self.bits, self.hash, actions)
+        terminal = (rewards > 0).any(-1)
+
+        self.bits[terminal] = 0
+        self.hash[terminal] = 0
+        self.seats.neg_().add_(1)
+        self.seats[terminal] = 0
+
+        self._obs = None
+        self._valid = None
+
+        return arrdict.arrdict(
+            terminal=terminal, 
+            rewards=rewards)
+
+    @profiling.nvtx
+    def reset_(self, mask):
+        """Same as :meth:`Hex.reset_`"""
+        self.bits[mask] = 0
+        self.hash[mask] = 0
+        self.seats[mask] = 0
+        self._obs = None
+        self._valid = None
+
+    @profiling.nvtx
+    def step_at(self, parents, leaves, actions):
+        """Same as :meth:`Hex.step_at`"""
+        if self.bits.ndim != 4:
+            raise ValueError('You can only `step_at` a store with (n_envs, n_nodes) batch dimensions')
+        S = self.boardsize
+        envs = torch.arange(self.n_envs, device=self.device)
+
+        assert (0 <= actions).all(), 'You passed a negative action'
+        if actions.shape == (self.n_envs, 2):
+            actions = actions[..., 0]*S + actions[..., 1]
+        assert actions.shape == (self.n_envs,)
+
+        # Checking against the parents' stones directly is much cheaper than computing `valid` for the whole store
+        seats = self.seats[envs, parents]
+        cells = torch.where(seats == 0, actions, (actions % S)*S + actions // S)
+        stones = self.bits[envs, parents, :2].gather(-1, (cells // 64)[:, None, None].expand(-1, 2, 1))
+        assert ((stones >> (cells % 64)[:, None, None]) & 1 == 0).all()
+
+        rewards = cuda.bits_step_at(self.bits, self.seats, self.hash, parents.int(), leaves.int(), actions.int(), S)
+        terminal = (rewards > 0).any(-1)
+
+        self._obs = None
+        self._valid = None
+
+        return arrdict.arrdict(
+            terminal=terminal, 
+            rewards=rewards)
+
+    @profiling.nvtx
+    def playout(self, n_steps=None, seed=None):
+        """Same as :meth:`Hex.playout`. Given the same seed, it plays the same moves as the :class:`Hex` it was packed
+        from."""
+        if self.bits.ndim != 3:
+            raise ValueError('You can only play out a board with a single batch dimension')
+        if seed is None:
+            seed = int(torch.randint(2**62, ()))
+
+        bits, seats, hash = self.bits.clone(), self.seats.int().clone(), self.hash.clone()
+        n_steps = -1 if n_steps is None else n_steps
+        rewards, first_actions = cuda.bits_playout(bits, seats, hash, n_steps, seed, self.boardsize)
+
+        worlds = type(self)(bits=bits, seats=seats.type(self.seats.dtype), hash=hash)
+        return worlds, arrdict.arrdict(
+            rewards=rewards,
+            first_actions=first_actions.long())
+
+    def _actions(self, actions):
+        shape = self.bits.shape[:-2]
+
+        assert (0 <= actions).all(), 'You passed a negative action'
+        if actions.shape == (*shape, 2):
+            actions = actions[..., 0]*self.boardsize + actions[..., 1]
+
+        assert actions.shape == shape
+        assert self.valid.gather(-1, actions[..., None]).squeeze(-1).all()
+        return actions
+
+    def _step_flat(self, bits, hash, actions):
+        shape = bits.shape[:-2]
+        flat_bits = bits.view(-1, *bits.shape[-2:])
+        flat_seats = self.seats.reshape(-1).int()
+        flat_hash = hash.view(-1, 2)
+        flat_actions = actions.reshape(-1).int()
+        rewards = cuda.bits_step(flat_bits, flat_seats, flat_hash, flat_actions, self.boardsize)
+        return rewards.reshape(*shape, 2)
+
+    @profiling.nvtx
+    def __setitem__(self, x, y):
+        self._obs = None
+        self._valid = None
+        return super().__setitem__(x, y)
+
+    def __reduce__(self):
+        return (_bitboard, (self.boardsize, dict(self)))
+
+    def display(self, *args, **kwargs):
+        return self.to_hex().display(*args, **kwargs)
+
 class Solitaire(Hex):
     """One-player Hex"""
 
@@ -208,6 +620,11 @@ class Solitaire(Hex):
         transitions['rewards'] = transitions.rewards[envs, self.seats.long()][:, None]
         return worlds, transitions
 
+    # The opponent's reply is part of a solitaire step, so there's no in-place, fused or native version
+    step_ = None
+    step_at = None
+    playout = None
+
 class Lazy(Solitaire):
     """Opponent plays the first available action"""
 
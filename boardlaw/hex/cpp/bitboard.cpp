@@ -0,0 +1,468 @@
+#include "common.h"
+#include <ATen/Parallel.h>
+
+// A bit-packed Hex board. Each color's stones are packed row-major into W 64-bit 
+// words, cell (r, c) being bit r*S+c. Neighbours are found by shifting the whole
+// mask and masking off whatever wrapped around a row end, so a step propagates
+// connectivity one word at a time rather than one cell at a time.
+//
+// Alongside the two color planes are two edge planes. FIRST holds the black stones
+// connected to the top row and the white stones connected to the left col; SECOND
+// holds those connected to the bottom row and the right col. A color's stones never
+// overlap the other's, so each plane carries two of the four edge masks. They're 
+// kept up to date as stones are played, so a step is one spread from the new stone
+// rather than a flood of its whole group.
+
+namespace hexbits {
+
+// Envs per task when splitting a batch across ATen's intra-op threads
+const int64_t GRAIN = 64;
+
+enum {
+    EMPTY,
+    BLACK,
+    WHITE,
+    TOP,
+    BOT, 
+    LEFT,
+    RIGHT
+};
+
+// The planes of a board
+enum { BLACK_PLANE, WHITE_PLANE, FIRST_PLANE, SECOND_PLANE, N_PLANES };
+
+// Enough words for a 32x32 board
+const int MAXW = 16;
+
+struct Mask {
+    uint64_t w[MAXW];
+};
+
+struct Masks {
+    int S;
+    int W;
+    Mask board; // bits that are on the board at all
+    Mask first_row, last_row, first_col, last_col;
+};
+
+inline bool get(const uint64_t* x, int i) { return (x[i / 64] >> (i % 64)) & 1; }
+inline void set(uint64_t* x, int i) { x[i / 64] |= (uint64_t(1) << (i % 64)); }
+
+inline void clear(Mask& x, int W) {
+    for (int w=0; w<W; w++) { x.w[w] = 0; }
+}
+
+// Shifts towards higher bit indices; 0 < k < 64
+inline void shl(const uint64_t* x, int k, uint64_t* out, int W) {
+    for (int w=W-1; w>0; w--) { out[w] = (x[w] << k) | (x[w-1] >> (64-k)); }
+    out[0] = x[0] << k;
+}
+
+// Shifts towards lower bit indices; 0 < k < 64
+inline void shr(const uint64_t* x, int k, uint64_t* out, int W) {
+    for (int w=0; w<W-1; w++) { out[w] = (x[w] >> k) | (x[w+1] << (64-k)); }
+    out[W-1] = x[W-1] >> k;
+}
+
+// Adds every on-board neighbour of `x` to `x`.
+void spread(const Masks& m, Mask& x) {
+    const int S = m.S, W = m.W;
+    Mask acc = x;
+    Mask t;
+
+    // Neighbours are {-1, 0}, {-1, +1}, {0, -1}, {0, +1}, {+1, -1}, {+1, 0}. Moving by +1
+    // or -(S-1) can wrap into the first column, moving by -1 or +(S-1) into the last.
+    shl(x.w, 1, t.w, W);
+    for (int w=0; w<W; w++) { acc.w[w] |= t.w[w] & ~m.first_col.w[w]; }
+    shr(x.w, 1, t.w, W);
+    for (int w=0; w<W; w++) { acc.w[w] |= t.w[w] & ~m.last_col.w[w]; }
+    shl(x.w, S, t.w, W);
+    for (int w=0; w<W; w++) { acc.w[w] |= t.w[w]; }
+    shr(x.w, S, t.w, W);
+    for (int w=0; w<W; w++) { acc.w[w] |= t.w[w]; }
+    if (S > 1) {
+        shl(x.w, S-1, t.w, W);
+        for (int w=0; w<W; w++) { acc.w[w] |= t.w[w] & ~m.last_col.w[w]; }
+        shr(x.w, S-1, t.w, W);
+        for (int w=0; w<W; w++) { acc.w[w] |= t.w[w] & ~m.first_col.w[w]; }
+    }
+
+    for (int w=0; w<W; w++) { x.w[w] = acc.w[w] & m.board.w[w]; }
+}
+
+// Grows `seed` to everything reachable from it through `stones`.
+void flood(const Masks& m, Mask& seed, const uint64_t* stones) {
+    const int W = m.W;
+    for (int w=0; w<W; w++) { seed.w[w] &= stones[w]; }
+    while (true) {
+        Mask next = seed;
+        spread(m, next);
+        bool changed = false;
+        for (int w=0; w<W; w++) { 
+            next.w[w] &= stones[w]; 
+            changed |= (next.w[w] != seed.w[w]);
+        }
+        if (!changed) { break; }
+        seed = next;
+    }
+}
+
+Masks masks(int S) {
+    const int W = (S*S + 63)/64;
+    TORCH_CHECK(W <= MAXW, "Bitboards only go up to 32x32");
+
+    Masks m;
+    m.S = S;
+    m.W = W;
+    clear(m.board, W);
+    clear(m.first_row, W);
+    clear(m.last_row, W);
+    clear(m.first_col, W);
+    clear(m.last_col, W);
+    for (int r=0; r<S; r++) {
+        for (int c=0; c<S; c++) {
+            set(m.board.w, r*S+c);
+            if (r == 0)   { set(m.first_row.w, r*S+c); }
+            if (r == S-1) { set(m.last_row.w, r*S+c); }
+            if (c == 0)   { set(m.first_col.w, r*S+c); }
+            if (c == S-1) { set(m.last_col.w, r*S+c); }
+        }
+    }
+    return m;
+}
+
+// Plays a stone for `seat` at (row, col) on the board whose planes start at `x`,
+// writing any win into `result` and folding the stone into `hash`.
+void step_cell(const Masks& m, uint64_t* x, int seat, int row, int col, float* result, int64_t* hash) {
+    const int S = m.S, W = m.W;
+    const int cell = row*S + col;
+
+    uint64_t* stones = x + seat*W;
+    uint64_t* first = x + FIRST_PLANE*W;
+    uint64_t* second = x + SECOND_PLANE*W;
+    // Black's edges are the first and last rows, white's the first and last cols
+    const Mask& first_edge = seat? m.first_col : m.first_row;
+    const Mask& second_edge = seat? m.last_col : m.last_row;
+
+    set(stones, cell);
+    hexzobrist::place(hash, seat, row, col, S);
+
+    // The new stone plus its friendly neighbours
+    Mask group;
+    clear(group, W);
+    set(group.w, cell);
+    spread(m, group);
+    bool touches_first = get(first_edge.w, cell);
+    bool touches_second = get(second_edge.w, cell);
+    for (int w=0; w<W; w++) { 
+        group.w[w] &= stones[w]; 
+        touches_first |= (group.w[w] & first[w]) != 0;
+        touches_second |= (group.w[w] & second[w]) != 0;
+    }
+
+    if (touches_first || touches_second) {
+        // If every friendly neighbour is already in the edge groups the stone joins, 
+        // it's just the stone to add. Otherwise it's merging in a group that isn't
+        // edge-connected yet, and that group has to be flooded out.
+        bool merges = false;
+        for (int w=0; w<W; w++) {
+            uint64_t known = (touches_first? first[w] : ~uint64_t(0)) & (touches_second? second[w] : ~uint64_t(0));
+            merges |= (group.w[w] & ~known) != 0;
+        }
+        if (merges) { flood(m, group, stones); }
+
+        for (int w=0; w<W; w++) {
+            if (touches_first) { first[w] |= group.w[w]; }
+            if (touches_second) { second[w] |= group.w[w]; }
+        }
+    }
+
+    if (touches_first && touches_second) {
+        result[0] = seat? -1.f : +1.f;
+        result[1] = seat? +1.f : -1.f;
+    }
+}
+
+// Actions are in the mover's frame, so white's are transposed
+inline void cell_of(int action, int seat, int S, int& row, int& col) {
+    if (seat == 0) { row = action / S, col = action % S; }
+    else           { row = action % S, col = action / S; }
+}
+
+inline void wipe(uint64_t* x, int64_t* hash, int W) {
+    std::memset(x, 0, N_PLANES*W*sizeof(uint64_t));
+    hash[0] = 0;
+    hash[1] = 0;
+}
+
+void check(TT bits, const Masks& m) {
+    TORCH_CHECK((bits.size(-2) == N_PLANES) && (bits.size(-1) == m.W), "bits should be shaped (..., 4, W)");
+}
+
+TT step(TT bits, TT seats, TT hash, TT actions, int S) {
+    const uint B = bits.size(0);
+    const auto m = masks(S);
+    check(bits, m);
+
+    TT results = bits.new_zeros({B, 2}, at::kFloat);
+
+    auto bits_ta = L3D(bits).ta();
+    auto seats_ta = I1D(seats).ta();
+    auto hash_ta = L2D(hash).ta();
+    auto actions_ta = I1D(actions).ta();
+    auto results_ta = F2D(results).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            int row, col;
+            cell_of(actions_ta[b], seats_ta[b], S, row, col);
+            step_cell(m, (uint64_t*)bits_ta[b].data(), seats_ta[b], row, col, results_ta[b].data(), hash_ta[b].data());
+        }
+    });
+
+    return results;
+}
+
+// Same as `hexcpu::step_at_kernel`, but on a (B*N, 4, W) node store
+void step_at_kernel(
+    const Masks& m, L3D::TA bits, I1D::TA seats, L2D::TA hash, I1D::TA parents, I1D::TA leaves, I1D::TA actions, 
+    F2D::TA results, uint N, uint b) {
+
+    const uint src = b*N + parents[b];
+    const uint dst = b*N + leaves[b];
+    const int seat = seats[src];
+
+    uint64_t* x = (uint64_t*)bits[dst].data();
+    if (src != dst) {
+        std::memcpy(x, bits[src].data(), N_PLANES*m.W*sizeof(uint64_t));
+        hash[dst][0] = hash[src][0];
+        hash[dst][1] = hash[src][1];
+    }
+
+    int row, col;
+    cell_of(actions[b], seat, m.S, row, col);
+    step_cell(m, x, seat, row, col, results[b].data(), hash[dst].data());
+
+    if ((results[b][0] > 0) || (results[b][1] > 0)) {
+        wipe(x, hash[dst].data(), m.W);
+        seats[dst] = 0;
+    } else {
+        seats[dst] = 1 - seat;
+    }
+}
+
+TT step_at(TT bits, TT seats, TT hash, TT parents, TT leaves, TT actions, int S) {
+    const uint B = bits.size(0);
+    const uint N = bits.size(1);
+    const auto m = masks(S);
+    check(bits, m);
+
+    TT results = bits.new_zeros({B, 2}, at::kFloat);
+
+    // Accessors only point at their tensor's sizes, so the flat views need to outlive them
+    auto flatbits = bits.view({B*N, N_PLANES, m.W});
+    auto flatseats = seats.view({B*N});
+    auto flathash = hash.view({B*N, 2});
+
+    auto bits_ta = L3D(flatbits).ta();
+    auto seats_ta = I1D(flatseats).ta();
+    auto hash_ta = L2D(flathash).ta();
+    auto parents_ta = I1D(parents).ta();
+    auto leaves_ta = I1D(leaves).ta();
+    auto actions_ta = I1D(actions).ta();
+    auto results_ta = F2D(results).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            step_at_kernel(m, bits_ta, seats_ta, hash_ta, parents_ta, leaves_ta, actions_ta, results_ta, N, b);
+        }
+    });
+
+    return results;
+}
+
+// Same as `hexcpu::playout_kernel`, and with the same RNG streams, so a bitboard 
+// playout makes the same moves as the unpacked one it was packed from.
+void playout_kernel(
+    const Masks& m, L3D::TA bits, I1D::TA seats, L2D::TA hash, F2D::TA results, I1D::TA first_actions, 
+    int64_t n_steps, uint64_t seed, uint b) {
+
+    const int S = m.S;
+    hexcpu::RNG rng(seed, b);
+    uint64_t* x = (uint64_t*)bits[b].data();
+
+    thread_local std::vector<short> empty;
+    if (empty.size() < S*S) { empty.resize(S*S); }
+    int n_empty = 0;
+    for (int i=0; i<S*S; i++) {
+        if (!get(x + BLACK_PLANE*m.W, i) && !get(x + WHITE_PLANE*m.W, i)) { empty[n_empty++] = i; }
+    }
+
+    float result[2];
+    for (int64_t t=0; (n_steps < 0) || (t < n_steps); t++) {
+        if (n_empty == 0) { break; }
+
+        const int seat = seats[b];
+        const int idx = rng.below(n_empty);
+        const int cell = empty[idx];
+        empty[idx] = empty[--n_empty];
+
+        const int row = cell / S, col = cell % S;
+        if (t == 0) { first_actions[b] = seat? (col*S + row) : (row*S + col); }
+
+        result[0] = 0.f;
+        result[1] = 0.f;
+        step_cell(m, x, seat, row, col, result, hash[b].data());
+
+        if ((result[0] > 0) || (result[1] > 0)) {
+            results[b][0] = result[0];
+            results[b][1] = result[1];
+
+            if (n_steps < 0) { 
+                seats[b] = 1 - seat;
+                break; 
+            }
+
+            wipe(x, hash[b].data(), m.W);
+            seats[b] = 0;
+            n_empty = S*S;
+            for (int i=0; i<S*S; i++) { empty[i] = i; }
+        } else {
+            seats[b] = 1 - seat;
+        }
+    }
+}
+
+std::tuple<TT, TT> playout(TT bits, TT seats, TT hash, int64_t n_steps, int64_t seed, int S) {
+    const uint B = bits.size(0);
+    const auto m = masks(S);
+    check(bits, m);
+
+    TT results = bits.new_zeros({B, 2}, at::kFloat);
+    TT first_actions = bits.new_full({B}, -1, at::kInt);
+
+    auto bits_ta = L3D(bits).ta();
+    auto seats_ta = I1D(seats).ta();
+    auto hash_ta = L2D(hash).ta();
+    auto results_ta = F2D(results).ta();
+    auto first_ta = I1D(first_actions).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            playout_kernel(m, bits_ta, seats_ta, hash_ta, results_ta, first_ta, n_steps, seed, b);
+        }
+    });
+
+    return std::make_tuple(results, first_actions);
+}
+
+void observe_kernel(const Masks& m, L3D::TA bits, I1D::TA seats, F4D::TA obs, uint b) {
+    const uint B = bits.size(0);
+    const int S = m.S;
+
+    if (b >= B) return;
+
+    // Same convention as the unpacked board: white sees the board transposed and
+    // with the colors swapped, so that each player sees themselves as black.
+    auto flip = seats[b] == 1;
+    for (int c=0; c<2; c++) {
+        const uint64_t* stones = (const uint64_t*)bits[b][c].data();
+        for (int i=0; i<S; i++) {
+            for (int j=0; j<S; j++) {
+                if (get(stones, i*S+j)) {
+                    if (flip) {
+                        obs[b][j][i][1-c] = 1.f;
+                    } else {
+                        obs[b][i][j][c] = 1.f;
+                    }
+                }
+            }
+        }
+    }
+}
+
+TT observe(TT bits, TT seats, int S) {
+    const auto m = masks(S);
+    check(bits, m);
+
+    auto flatbits = bits.reshape({-1, N_PLANES, m.W}).contiguous();
+    auto flatseats = seats.reshape({-1}).to(at::kInt).contiguous();
+
+    const uint B = flatbits.size(0);
+
+    auto obs = flatbits.new_zeros({B, S, S, 2}, at::kFloat);
+
+    auto bits_ta = L3D(flatbits).ta();
+    auto seats_ta = I1D(flatseats).ta();
+    auto obs_ta = F4D(obs).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            observe_kernel(m, bits_ta, seats_ta, obs_ta, b);
+        }
+    });
+
+    auto sizes = bits.sizes().vec();
+    sizes.pop_back();
+    sizes.pop_back();
+    sizes.push_back(S);
+    sizes.push_back(S);
+    sizes.push_back(2);
+    return obs.view(sizes);
+}
+
+// The unpacked board already marks which stones are edge-connected, so packing
+// is just a matter of sorting its codes into planes
+TT pack(TT board) {
+    const uint B = board.size(0);
+    const int S = board.size(1);
+    const auto m = masks(S);
+
+    TT bits = board.new_zeros({B, N_PLANES, m.W}, at::kLong);
+    auto b_ = C3D(board).ta();
+    auto bits_ = L3D(bits).ta();
+    for (uint b=0; b<B; b++) {
+        uint64_t* black = (uint64_t*)bits_[b][BLACK_PLANE].data();
+        uint64_t* white = (uint64_t*)bits_[b][WHITE_PLANE].data();
+        uint64_t* first = (uint64_t*)bits_[b][FIRST_PLANE].data();
+        uint64_t* second = (uint64_t*)bits_[b][SECOND_PLANE].data();
+        for (int r=0; r<S; r++) {
+            for (int c=0; c<S; c++) {
+                auto val = b_[b][r][c];
+                if ((val == BLACK) | (val == TOP) | (val == BOT)) { set(black, r*S+c); }
+                if ((val == WHITE) | (val == LEFT) | (val == RIGHT)) { set(white, r*S+c); }
+                if ((val == TOP) | (val == LEFT)) { set(first, r*S+c); }
+                if ((val == BOT) | (val == RIGHT)) { set(second, r*S+c); }
+            }
+        }
+    }
+    return bits;
+}
+
+// Recovers the uint8 board, edge markers and all, that the unpacked Hex would hold.
+// A stone connected to both edges only happens on a won board, which gets reset, 
+// so the first edge winning ties doesn't matter.
+TT unpack(TT bits, int S) {
+    const uint B = bits.size(0);
+    const auto m = masks(S);
+    check(bits, m);
+
+    TT board = bits.new_zeros({B, S, S}, at::kByte);
+    auto b_ = C3D(board).ta();
+    auto bits_ = L3D(bits).ta();
+    for (uint b=0; b<B; b++) {
+        const uint64_t* black = (const uint64_t*)bits_[b][BLACK_PLANE].data();
+        const uint64_t* white = (const uint64_t*)bits_[b][WHITE_PLANE].data();
+        const uint64_t* first = (const uint64_t*)bits_[b][FIRST_PLANE].data();
+        const uint64_t* second = (const uint64_t*)bits_[b][SECOND_PLANE].data();
+        for (int r=0; r<S; r++) {
+            for (int c=0; c<S; c++) {
+                int i = r*S+c;
+                if (get(black, i)) {
+                    b_[b][r][c] = get(first, i)? TOP : (get(second, i)? BOT : BLACK);
+                } else if (get(white, i)) {
+                    b_[b][r][c] = get(first, i)? LEFT : (get(second, i)? RIGHT : WHITE);
+                }
+            }
+        }
+    }
+    return board;
+}
+
+}
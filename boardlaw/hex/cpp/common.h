@@ -1,10 +1,41 @@
 #pragma once
 #include "../../cpp/common.h"
 
+#ifdef __CUDACC__
+#define HOST_DEVICE __host__ __device__
+#else
+#define HOST_DEVICE
+#endif
+
+namespace hexzobrist {
+
+// Zobrist keys are a pure function of the color and cell rather than a table, 
+// so they're the same on every device and every run. 
+inline HOST_DEVICE int64_t key(int color, int cell) {
+    uint64_t z = 0x5EED0F4E8A11C0DEull + 0x9E3779B97F4A7C15ull*uint64_t(2*cell + color + 1);
+    z = (z ^ (z >> 30))*0xBF58476D1CE4E5B9ull;
+    z = (z ^ (z >> 27))*0x94D049BB133111EBull;
+    return int64_t(z ^ (z >> 31));
+}
+
+// Each world carries two hashes. hash[0] is of the board as it stands, while 
+// hash[1] is of the board transposed with the colors swapped - which is how 
+// white sees it in `observe`. So hash[seat] is the hash of the mover's view.
+inline HOST_DEVICE void place(int64_t* hash, int color, int row, int col, int S) {
+    hash[0] ^= key(color, row*S + col);
+    hash[1] ^= key(1 - color, col*S + row);
+}
+
+}
+
 namespace hexcuda {
 
-TT step(TT board, TT seats, TT actions);
+TT step(TT board, TT seats, TT hash, TT actions);
+
+TT step_at(TT board, TT seats, TT hash, TT parents, TT leaves, TT actions);
 
 TT observe(TT board, TT seats);
 
+TT hash(TT board);
+
 }
\ No newline at end of file
@@ -1,7 +1,15 @@
 #include "common.h"
+#include <ATen/Parallel.h>
+#include <vector>
+#include <cstring>
+#include <tuple>
 
 namespace hexcpu {
 
+// Envs per task when splitting a batch across ATen's intra-op threads. Each env
+// is only a few hundred cycles of work, so smaller chunks are all overhead.
+const int64_t GRAIN = 64;
+
 enum {
     EMPTY,
     BLACK,
@@ -22,17 +30,26 @@ void flood(C3D::TA board, int row, int col, uint8_t new_val, uint b) {
 
     uint8_t old_val = board[b][row][col];
 
-    // Set up a queue to keep track of which cells need exploring
+    // Set up a queue to keep track of which cells need exploring. The scratch
+    // is per-thread and reused across calls, so there's no allocation per step.
+    thread_local std::vector<uint8_t> queue;
+    thread_local std::vector<uint32_t> seen;
+    thread_local uint32_t stamp = 0;
+    if (queue.size() < 2*S*S) { queue.resize(2*S*S); }
+
+    // Keep track of which cells we've already seen by stamping them with a 
+    // per-call counter, so the mask only needs clearing when the counter wraps.
+    if ((seen.size() < S*S) || (stamp == UINT32_MAX)) { 
+        seen.assign(std::max<size_t>(seen.size(), S*S), 0); 
+        stamp = 0;
+    }
+    stamp += 1;
+
     int start = 0;
     int end = 1;
-    uint8_t *queue = (uint8_t*)malloc(S*S*2*sizeof(uint8_t));
     queue[0] = row;
     queue[1] = col;
 
-    // Set up a mask to keep track of which cells we've already seen
-    uint8_t *seen = (uint8_t*)malloc(S*S*sizeof(uint8_t));
-    for (int s=0; s<S*S; s++) { seen[s] = 0; }
-
     while (true) {
         // See if there's anything left in the queue
         if (start == end) { break; }
@@ -54,12 +71,12 @@ void flood(C3D::TA board, int row, int col, uint8_t new_val, uint b) {
                 // but only if they're not over the edge
                 if ((0 <= r) && (r < S) && (0 <= c) && (c < S)) {
                     // and we haven't seen them already
-                    if (!seen[r*S+c]) {
+                    if (seen[r*S+c] != stamp) {
                         queue[2*end+0] = r;
                         queue[2*end+1] = c;
                         end += 1;
 
-                        seen[r*S+c] = 1;
+                        seen[r*S+c] = stamp;
                     }
                 }
             }
@@ -67,18 +84,13 @@ void flood(C3D::TA board, int row, int col, uint8_t new_val, uint b) {
     }
 }
 
-void step_kernel(
-    C3D::TA board, I1D::TA seats, I1D::TA actions, F2D::TA results, uint b) {
+// Plays `action` for `seat` on board `i`, writing any win into `result` and 
+// folding the new stone into the pair of hashes at `hash`
+void step_cell(C3D::TA board, uint i, int seat, int action, float* result, int64_t* hash) {
 
-    const uint B = board.size(0);
     const uint S = board.size(1);
 
-    if (b >= B) return;
-
-    const int seat = seats[b]; 
-
     // Swap rows and cols if we're playing white
-    const int action = actions[b];
     int row, col;
     if (seat == 0) { row = action / S, col = action % S; }
     else           { row = action % S, col = action / S; }
@@ -99,15 +111,15 @@ void step_kernel(
         else if (r >= S) { adj[BOT] = true; }
         else if (c <  0) { adj[LEFT] = true; }
         else if (c >= S) { adj[RIGHT] = true; }
-        else { adj[board[b][r][c]] = true; }
+        else { adj[board[i][r][c]] = true; }
     }
 
     // Use the adjacency to decide what the new cell should be
     char new_val;
     if (seat) {
         if (adj[LEFT] && adj[RIGHT]) { 
-            results[b][0] = -1.f;
-            results[b][1] = +1.f;
+            result[0] = -1.f;
+            result[1] = +1.f;
         } 
 
         if (adj[LEFT]) { new_val = LEFT; } 
@@ -115,8 +127,8 @@ void step_kernel(
         else { new_val = WHITE; }
     } else {
         if (adj[TOP] && adj[BOT]) {
-            results[b][0] = +1.f;
-            results[b][1] = -1.f;
+            result[0] = +1.f;
+            result[1] = -1.f;
         } 
 
         if (adj[TOP]) { new_val = TOP; } 
@@ -124,33 +136,444 @@ void step_kernel(
         else { new_val = BLACK; }
     }
 
-    board[b][row][col] = seat? WHITE : BLACK;
+    board[i][row][col] = seat? WHITE : BLACK;
+    hexzobrist::place(hash, seat, row, col, S);
 
-    flood(board, row, col, new_val, b);
+    flood(board, row, col, new_val, i);
 }
 
-TT step(TT board, TT seats, TT actions) {
+void step_kernel(
+    C3D::TA board, I1D::TA seats, L2D::TA hash, I1D::TA actions, F2D::TA results, uint b) {
+
     const uint B = board.size(0);
+    if (b >= B) return;
+
+    step_cell(board, b, seats[b], actions[b], results[b].data(), hash[b].data());
+}
+
+// Copies node `parents[b]` of env `b` over node `leaves[b]`, then steps the copy.
+// `board`, `seats` and `hash` are the node store flattened to (B*N, ...).
+void step_at_kernel(
+    C3D::TA board, I1D::TA seats, L2D::TA hash, I1D::TA parents, I1D::TA leaves, I1D::TA actions, F2D::TA results, 
+    uint N, uint b) {
+
+    const uint B = results.size(0);
     const uint S = board.size(1);
+    if (b >= B) return;
+
+    const uint src = b*N + parents[b];
+    const uint dst = b*N + leaves[b];
+    const int seat = seats[src];
+
+    if (src != dst) {
+        std::memcpy(board[dst].data(), board[src].data(), S*S*sizeof(uint8_t));
+        hash[dst][0] = hash[src][0];
+        hash[dst][1] = hash[src][1];
+    }
+
+    step_cell(board, dst, seat, actions[b], results[b].data(), hash[dst].data());
+
+    // Same as `Hex.step`: terminal boards are reset, and the seat passes on otherwise
+    if ((results[b][0] > 0) || (results[b][1] > 0)) {
+        std::memset(board[dst].data(), 0, S*S*sizeof(uint8_t));
+        seats[dst] = 0;
+        hash[dst][0] = 0;
+        hash[dst][1] = 0;
+    } else {
+        seats[dst] = 1 - seat;
+    }
+}
+
+TT step_at(TT board, TT seats, TT hash, TT parents, TT leaves, TT actions) {
+    const uint B = board.size(0);
+    const uint N = board.size(1);
+    const uint S = board.size(2);
 
     TT results = board.new_zeros({B, 2}, at::kFloat);
 
-    for (uint b=0; b<B; b++) {
-        step_kernel(C3D(board).ta(), I1D(seats).ta(), I1D(actions).ta(), F2D(results).ta(), b);
+    // Accessors only point at their tensor's sizes, so the flat views need to outlive them
+    auto flatboard = board.view({B*N, S, S});
+    auto flatseats = seats.view({B*N});
+    auto flathash = hash.view({B*N, 2});
+
+    auto board_ta = C3D(flatboard).ta();
+    auto seats_ta = I1D(flatseats).ta();
+    auto hash_ta = L2D(flathash).ta();
+    auto parents_ta = I1D(parents).ta();
+    auto leaves_ta = I1D(leaves).ta();
+    auto actions_ta = I1D(actions).ta();
+    auto results_ta = F2D(results).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            step_at_kernel(board_ta, seats_ta, hash_ta, parents_ta, leaves_ta, actions_ta, results_ta, N, b);
+        }
+    });
+
+    return results;
+}
+
+// splitmix64. Each env gets its own stream, so results don't depend on how the 
+// batch is split across threads.
+struct RNG {
+    uint64_t state;
+
+    RNG(uint64_t seed, uint64_t b) : state(seed ^ (0x9E3779B97F4A7C15ull*(b + 1))) {}
+
+    uint64_t next() {
+        uint64_t z = (state += 0x9E3779B97F4A7C15ull);
+        z = (z ^ (z >> 30))*0xBF58476D1CE4E5B9ull;
+        z = (z ^ (z >> 27))*0x94D049BB133111EBull;
+        return z ^ (z >> 31);
+    }
+
+    // Uniform over [0, n)
+    int below(int n) { return int(((next() >> 32)*uint64_t(n)) >> 32); }
+};
+
+// Plays uniformly-random moves on env `b`. With `n_steps` negative, plays until 
+// the game ends and leaves the final board in place; otherwise plays exactly 
+// `n_steps` moves, resetting finished games like `Hex.step` does.
+void playout_kernel(
+    C3D::TA board, I1D::TA seats, L2D::TA hash, F2D::TA results, I1D::TA first_actions, 
+    int64_t n_steps, uint64_t seed, uint b) {
+
+    const uint S = board.size(1);
+    RNG rng(seed, b);
+
+    // The empty cells, kept unordered so a move is a swap-remove
+    thread_local std::vector<short> empty;
+    if (empty.size() < S*S) { empty.resize(S*S); }
+    int n_empty = 0;
+    for (int i=0; i<S*S; i++) {
+        if (board[b][i / S][i % S] == EMPTY) { empty[n_empty++] = i; }
+    }
+
+    float result[2];
+    for (int64_t t=0; (n_steps < 0) || (t < n_steps); t++) {
+        if (n_empty == 0) { break; }
+
+        const int seat = seats[b];
+        const int idx = rng.below(n_empty);
+        const int cell = empty[idx];
+        empty[idx] = empty[--n_empty];
+
+        // Actions are in the mover's frame, so white's are transposed
+        const int row = cell / S, col = cell % S;
+        const int action = seat? (col*S + row) : (row*S + col);
+        if (t == 0) { first_actions[b] = action; }
+
+        result[0] = 0.f;
+        result[1] = 0.f;
+        step_cell(board, b, seat, action, result, hash[b].data());
+
+        if ((result[0] > 0) || (result[1] > 0)) {
+            results[b][0] = result[0];
+            results[b][1] = result[1];
+
+            if (n_steps < 0) { 
+                seats[b] = 1 - seat;
+                break; 
+            }
+
+            std::memset(board[b].data(), 0, S*S*sizeof(uint8_t));
+            seats[b] = 0;
+            hash[b][0] = 0;
+            hash[b][1] = 0;
+            n_empty = S*S;
+            for (int i=0; i<S*S; i++) { empty[i] = i; }
+        } else {
+            seats[b] = 1 - seat;
+        }
+    }
+}
+
+std::tuple<TT, TT> playout(TT board, TT seats, TT hash, int64_t n_steps, int64_t seed) {
+    const uint B = board.size(0);
+
+    TT results = board.new_zeros({B, 2}, at::kFloat);
+    TT first_actions = board.new_full({B}, -1, at::kInt);
+
+    auto board_ta = C3D(board).ta();
+    auto seats_ta = I1D(seats).ta();
+    auto results_ta = F2D(results).ta();
+    auto first_ta = I1D(first_actions).ta();
+    auto hash_ta = L2D(hash).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            playout_kernel(board_ta, seats_ta, hash_ta, results_ta, first_ta, n_steps, seed, b);
+        }
+    });
+
+    return std::make_tuple(results, first_actions);
+}
+
+TT step(TT board, TT seats, TT hash, TT actions) {
+    const uint B = board.size(0);
+    const uint S = board.size(1);
+
+    TT results = board.new_zeros({B, 2}, at::kFloat);
+
+    auto board_ta = C3D(board).ta();
+    auto seats_ta = I1D(seats).ta();
+    auto hash_ta = L2D(hash).ta();
+    auto actions_ta = I1D(actions).ta();
+    auto results_ta = F2D(results).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            step_kernel(board_ta, seats_ta, hash_ta, actions_ta, results_ta, b);
+        }
+    });
+
+    return results;
+}
+
+// Disjoint-set alternative to the flood fill above. Each env gets a forest over
+// its S*S cells plus four virtual nodes - one per edge, at S*S + (edge - TOP).
+// forest[b][0] holds the parent pointers and forest[b][1] threads each set into
+// a ring, so a group that picks up an edge can be relabelled without searching
+// for it. The board is kept bit-identical to the one `step` produces.
+
+struct Forest {
+    short* parent;
+    short* next;
+
+    Forest(S3D::TA forest, uint b) :
+        parent(forest[b][0].data()),
+        next(forest[b][1].data()) {}
+
+    int find(int x) {
+        while (parent[x] != x) {
+            // Path halving
+            parent[x] = parent[parent[x]];
+            x = parent[x];
+        }
+        return x;
+    }
+
+    void unite(int x, int y) {
+        x = find(x);
+        y = find(y);
+        if (x == y) { return; }
+
+        // Always root at the larger index, so any set containing an edge is
+        // rooted at an edge node.
+        if (x > y) { std::swap(x, y); }
+        parent[x] = y;
+
+        // Splice the two rings together
+        std::swap(next[x], next[y]);
+    }
+};
+
+inline bool is_black(uint8_t val) { return (val == BLACK) | (val == TOP) | (val == BOT); }
+inline bool is_white(uint8_t val) { return (val == WHITE) | (val == LEFT) | (val == RIGHT); }
+
+void forest_kernel(C3D::TA board, S3D::TA forest, uint b) {
+    const int S = board.size(1);
+    const int N = forest.size(2);
+
+    Forest f(forest, b);
+    for (int i=0; i<N; i++) {
+        f.parent[i] = i;
+        f.next[i] = i;
     }
 
+    // Only need to look at half the neighbours, since links are symmetric
+    const int neighbours[3][2] = {{0, +1}, {+1, -1}, {+1, 0}};
+    for (int r=0; r<S; r++) {
+        for (int c=0; c<S; c++) {
+            auto val = board[b][r][c];
+            if (val == EMPTY) { continue; }
+            bool black = is_black(val);
+
+            if (black && (r == 0))    { f.unite(r*S+c, S*S+TOP-TOP); }
+            if (black && (r == S-1))  { f.unite(r*S+c, S*S+BOT-TOP); }
+            if (!black && (c == 0))   { f.unite(r*S+c, S*S+LEFT-TOP); }
+            if (!black && (c == S-1)) { f.unite(r*S+c, S*S+RIGHT-TOP); }
+
+            for (int n=0; n<3; n++) {
+                int rr = r + neighbours[n][0];
+                int cc = c + neighbours[n][1];
+                if ((0 <= rr) && (rr < S) && (0 <= cc) && (cc < S)) {
+                    auto other = board[b][rr][cc];
+                    if ((other != EMPTY) && (is_black(other) == black)) {
+                        f.unite(r*S+c, rr*S+cc);
+                    }
+                }
+            }
+        }
+    }
+}
+
+TT forest(TT board) {
+    const uint B = board.size(0);
+    const uint S = board.size(1);
+
+    TORCH_CHECK(S*S+4 <= 32767, "Board is too large for a short-indexed forest");
+    TT forest = board.new_empty({B, 2, S*S+4}, at::kShort);
+
+    auto board_ta = C3D(board).ta();
+    auto forest_ta = S3D(forest).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            forest_kernel(board_ta, forest_ta, b);
+        }
+    });
+
+    return forest;
+}
+
+void step_uf_kernel(
+    C3D::TA board, S3D::TA forest, I1D::TA seats, L2D::TA hash, I1D::TA actions, F2D::TA results, uint b) {
+
+    const uint B = board.size(0);
+    const int S = board.size(1);
+
+    if (b >= B) return;
+
+    const int seat = seats[b];
+    uint8_t* cells = board[b].data();
+    Forest f(forest, b);
+
+    // Swap rows and cols if we're playing white
+    const int action = actions[b];
+    int row, col;
+    if (seat == 0) { row = action / S, col = action % S; }
+    else           { row = action % S, col = action / S; }
+    const int cell = row*S + col;
+
+    // Black connects TOP to BOT, white connects LEFT to RIGHT
+    const uint8_t color = seat? WHITE : BLACK;
+    const uint8_t first = seat? LEFT : TOP;
+    const uint8_t second = seat? RIGHT : BOT;
+    const int first_node = S*S + first - TOP;
+    const int second_node = S*S + second - TOP;
+
+    const int first_root = f.find(first_node);
+    const int second_root = f.find(second_node);
+
+    // Collect the roots of the same-colored groups this move touches.
+    int roots[6];
+    int n_roots = 0;
+    bool touches_first = false;
+    bool touches_second = false;
+
+    const int neighbours[6][2] = {{-1, 0}, {-1, +1}, {0, -1}, {0, +1}, {+1, -1}, {+1, 0}};
+    for (int n=0; n<6; n++) {
+        int r = row + neighbours[n][0];
+        int c = col + neighbours[n][1];
+
+        if      (r <  0) { touches_first  |= (first == TOP); }
+        else if (r >= S) { touches_second |= (second == BOT); }
+        else if (c <  0) { touches_first  |= (first == LEFT); }
+        else if (c >= S) { touches_second |= (second == RIGHT); }
+        else {
+            auto val = cells[r*S+c];
+            if (!(seat? is_white(val) : is_black(val))) { continue; }
+
+            int root = f.find(r*S+c);
+            touches_first |= (root == first_root);
+            touches_second |= (root == second_root);
+
+            bool seen = false;
+            for (int i=0; i<n_roots; i++) { seen |= (roots[i] == root); }
+            if (!seen) { roots[n_roots++] = root; }
+        }
+    }
+
+    if (touches_first && touches_second) {
+        results[b][0] = seat? -1.f : +1.f;
+        results[b][1] = seat? +1.f : -1.f;
+    }
+
+    // Same priority as the flood fill: first edge, then second, else plain color
+    uint8_t new_val = touches_first? first : (touches_second? second : color);
+
+    // Relabel any unlabelled groups that are being joined to an edge. Sets that
+    // contain an edge are rooted at that edge, so unlabelled sets have cell roots.
+    if (new_val != color) {
+        for (int i=0; i<n_roots; i++) {
+            int x = roots[i];
+            if (x >= S*S) { continue; }
+            do {
+                cells[x] = new_val;
+                x = f.next[x];
+            } while (x != roots[i]);
+        }
+    }
+    cells[cell] = new_val;
+    hexzobrist::place(hash[b].data(), seat, row, col, S);
+
+    for (int i=0; i<n_roots; i++) { f.unite(cell, roots[i]); }
+    if (touches_first)  { f.unite(cell, first_node); }
+    if (touches_second) { f.unite(cell, second_node); }
+}
+
+TT step_uf(TT board, TT forest, TT seats, TT hash, TT actions) {
+    const uint B = board.size(0);
+    const uint S = board.size(1);
+
+    TORCH_CHECK(forest.size(0) == B && forest.size(1) == 2 && forest.size(2) == S*S+4,
+        "forest should be shaped (B, 2, S*S+4)");
+
+    TT results = board.new_zeros({B, 2}, at::kFloat);
+
+    auto board_ta = C3D(board).ta();
+    auto forest_ta = S3D(forest).ta();
+    auto seats_ta = I1D(seats).ta();
+    auto hash_ta = L2D(hash).ta();
+    auto actions_ta = I1D(actions).ta();
+    auto results_ta = F2D(results).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            step_uf_kernel(board_ta, forest_ta, seats_ta, hash_ta, actions_ta, results_ta, b);
+        }
+    });
+
     return results;
 }
 
+// Hashes a board from scratch. Stepping keeps the hash up to date incrementally,
+// so this is only needed when a world is built from a bare board.
+TT hash(TT board) {
+    auto flatboard = board.contiguous().view({-1, board.size(-1), board.size(-1)});
+
+    const uint B = flatboard.size(0);
+    const int S = flatboard.size(1);
+
+    auto hashes = flatboard.new_zeros({B, 2}, at::kLong);
+
+    auto board_ta = C3D(flatboard).ta();
+    auto hash_ta = L2D(hashes).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            for (int r=0; r<S; r++) {
+                for (int c=0; c<S; c++) {
+                    auto val = board_ta[b][r][c];
+                    if (val != EMPTY) {
+                        hexzobrist::place(hash_ta[b].data(), is_black(val)? 0 : 1, r, c, S);
+                    }
+                }
+            }
+        }
+    });
+
+    auto sizes = board.sizes().vec();
+    sizes.pop_back();
+    sizes.back() = 2;
+    return hashes.view(sizes);
+}
+
 void observe_kernel(C3D::TA board, I1D::TA seats, F4D::TA obs, uint b) {
     const uint B = board.size(0);
     const uint S = board.size(1);
 
     if (b >= B) return;
 
-    uint8_t* colors = (uint8_t*)malloc(S*S*sizeof(uint8_t));
+    thread_local std::vector<uint8_t> colors;
+    if (colors.size() < S*S) { colors.resize(S*S); }
 
-    // Copy the color into shared memory
+    // Copy the color into per-thread scratch
     for (int i=0; i<S; i++) {
         for (int j=0; j<S; j++) {
             auto c = board[b][i][j];
@@ -192,9 +615,14 @@ TT observe(TT board, TT seats) {
 
     auto obs = flatboard.new_zeros({B, S, S, 2}, at::kFloat);
 
-    for (uint b=0; b<B; b++) {
-        observe_kernel(C3D(flatboard).ta(), I1D(flatseats).ta(), F4D(obs).ta(), b);
-    }
+    auto board_ta = C3D(flatboard).ta();
+    auto seats_ta = I1D(flatseats).ta();
+    auto obs_ta = F4D(obs).ta();
+    at::parallel_for(0, B, GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            observe_kernel(board_ta, seats_ta, obs_ta, b);
+        }
+    });
 
     auto sizes = board.sizes().vec();
     sizes.push_back(2);
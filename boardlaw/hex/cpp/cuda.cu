@@ -15,9 +15,8 @@ enum {
     RIGHT
 };
 
-__device__ void flood(C3D::PTA board, int row, int col, uint8_t new_val) {
+__device__ void flood(C3D::PTA board, uint b, int row, int col, uint8_t new_val) {
     const uint S = board.size(1);
-    const int b = blockIdx.x*blockDim.x + threadIdx.x;
 
     const int neighbours[6][2] = {{-1, 0}, {-1, +1}, {0, -1}, {0, +1}, {+1, -1}, {+1, 0}};
 
@@ -73,19 +72,13 @@ __device__ void flood(C3D::PTA board, int row, int col, uint8_t new_val) {
     }
 }
 
-__global__ void step_kernel(
-    C3D::PTA board, I1D::PTA seats, I1D::PTA actions, F2D::PTA results) {
+// Plays `action` for `seat` on board `i`, writing any win into `result` and 
+// folding the new stone into the pair of hashes at `hash`
+__device__ void step_cell(C3D::PTA board, uint i, int seat, int action, float* result, int64_t* hash) {
 
-    const uint B = board.size(0);
     const uint S = board.size(1);
-    const int b = blockIdx.x*blockDim.x + threadIdx.x;
-
-    if (b >= B) return;
-
-    const int seat = seats[b]; 
 
     // Swap rows and cols if we're playing white
-    const int action = actions[b];
     int row, col;
     if (seat == 0) { row = action / S, col = action % S; }
     else           { row = action % S, col = action / S; }
@@ -106,15 +99,15 @@ __global__ void step_kernel(
         else if (r >= S) { adj[BOT] = true; }
         else if (c <  0) { adj[LEFT] = true; }
         else if (c >= S) { adj[RIGHT] = true; }
-        else { adj[board[b][r][c]] = true; }
+        else { adj[board[i][r][c]] = true; }
     }
 
     // Use the adjacency to decide what the new cell should be
     char new_val;
     if (seat) {
         if (adj[LEFT] && adj[RIGHT]) { 
-            results[b][0] = -1.f;
-            results[b][1] = +1.f;
+            result[0] = -1.f;
+            result[1] = +1.f;
         } 
 
         if (adj[LEFT]) { new_val = LEFT; } 
@@ -122,8 +115,8 @@ __global__ void step_kernel(
         else { new_val = WHITE; }
     } else {
         if (adj[TOP] && adj[BOT]) {
-            results[b][0] = +1.f;
-            results[b][1] = -1.f;
+            result[0] = +1.f;
+            result[1] = -1.f;
         } 
 
         if (adj[TOP]) { new_val = TOP; } 
@@ -131,12 +124,67 @@ __global__ void step_kernel(
         else { new_val = BLACK; }
     }
 
-    board[b][row][col] = seat? WHITE : BLACK;
+    board[i][row][col] = seat? WHITE : BLACK;
+    hexzobrist::place(hash, seat, row, col, S);
+
+    flood(board, i, row, col, new_val);
+}
+
+__global__ void step_kernel(
+    C3D::PTA board, I1D::PTA seats, L2D::PTA hash, I1D::PTA actions, F2D::PTA results) {
+
+    const uint B = board.size(0);
+    const int b = blockIdx.x*blockDim.x + threadIdx.x;
 
-    flood(board, row, col, new_val);
+    if (b >= B) return;
+
+    step_cell(board, b, seats[b], actions[b], &results[b][0], &hash[b][0]);
 }
 
-__host__ TT step(TT board, TT seats, TT actions) {
+// Copies node `parents[b]` of env `b` over node `leaves[b]`, then steps the copy.
+// `board`, `seats` and `hash` are the node store flattened to (B*N, ...).
+__global__ void step_at_kernel(
+    C3D::PTA board, I1D::PTA seats, L2D::PTA hash, I1D::PTA parents, I1D::PTA leaves, I1D::PTA actions, F2D::PTA results, 
+    uint N) {
+
+    const uint B = results.size(0);
+    const uint S = board.size(1);
+    const int b = blockIdx.x*blockDim.x + threadIdx.x;
+
+    if (b >= B) return;
+
+    const uint src = b*N + parents[b];
+    const uint dst = b*N + leaves[b];
+    const int seat = seats[src];
+
+    if (src != dst) {
+        for (int r=0; r<S; r++) {
+            for (int c=0; c<S; c++) {
+                board[dst][r][c] = board[src][r][c];
+            }
+        }
+        hash[dst][0] = hash[src][0];
+        hash[dst][1] = hash[src][1];
+    }
+
+    step_cell(board, dst, seat, actions[b], &results[b][0], &hash[dst][0]);
+
+    // Same as `Hex.step`: terminal boards are reset, and the seat passes on otherwise
+    if ((results[b][0] > 0) || (results[b][1] > 0)) {
+        for (int r=0; r<S; r++) {
+            for (int c=0; c<S; c++) {
+                board[dst][r][c] = EMPTY;
+            }
+        }
+        seats[dst] = 0;
+        hash[dst][0] = 0;
+        hash[dst][1] = 0;
+    } else {
+        seats[dst] = 1 - seat;
+    }
+}
+
+__host__ TT step(TT board, TT seats, TT hash, TT actions) {
     c10::cuda::CUDAGuard g(board.device());
     const uint B = board.size(0);
     const uint S = board.size(1);
@@ -145,7 +193,28 @@ __host__ TT step(TT board, TT seats, TT actions) {
 
     const uint n_blocks = (B + BLOCK - 1)/BLOCK;
     step_kernel<<<{n_blocks}, {BLOCK}, BLOCK*S*S*3*sizeof(uint8_t), stream()>>>(
-        C3D(board).pta(), I1D(seats).pta(), I1D(actions).pta(), F2D(results).pta());
+        C3D(board).pta(), I1D(seats).pta(), L2D(hash).pta(), I1D(actions).pta(), F2D(results).pta());
+    C10_CUDA_CHECK(cudaGetLastError());
+
+    return results;
+}
+
+__host__ TT step_at(TT board, TT seats, TT hash, TT parents, TT leaves, TT actions) {
+    c10::cuda::CUDAGuard g(board.device());
+    const uint B = board.size(0);
+    const uint N = board.size(1);
+    const uint S = board.size(2);
+
+    TT results = board.new_zeros({B, 2}, at::kFloat);
+
+    auto flatboard = board.view({B*N, S, S});
+    auto flatseats = seats.view({B*N});
+    auto flathash = hash.view({B*N, 2});
+
+    const uint n_blocks = (B + BLOCK - 1)/BLOCK;
+    step_at_kernel<<<{n_blocks}, {BLOCK}, BLOCK*S*S*3*sizeof(uint8_t), stream()>>>(
+        C3D(flatboard).pta(), I1D(flatseats).pta(), L2D(flathash).pta(), 
+        I1D(parents).pta(), I1D(leaves).pta(), I1D(actions).pta(), F2D(results).pta(), N);
     C10_CUDA_CHECK(cudaGetLastError());
 
     return results;
@@ -216,4 +285,46 @@ __host__ TT observe(TT board, TT seats) {
 
 }
 
-}
\ No newline at end of file
+// Same as `hexcpu::hash`. It's only needed when a world is built from a bare board,
+// but doing it here saves that world a round trip through the host.
+__global__ void hash_kernel(C3D::PTA board, L2D::PTA hash) {
+    const uint B = board.size(0);
+    const uint S = board.size(1);
+    const int b = blockIdx.x*blockDim.x + threadIdx.x;
+
+    if (b >= B) return;
+
+    int64_t h[2] = {0, 0};
+    for (int r=0; r<S; r++) {
+        for (int c=0; c<S; c++) {
+            auto val = board[b][r][c];
+            if ((val == BLACK) | (val == TOP) | (val == BOT)) {
+                hexzobrist::place(h, 0, r, c, S);
+            } else if ((val == WHITE) | (val == LEFT) | (val == RIGHT)) {
+                hexzobrist::place(h, 1, r, c, S);
+            }
+        }
+    }
+    hash[b][0] = h[0];
+    hash[b][1] = h[1];
+}
+
+__host__ TT hash(TT board) {
+    c10::cuda::CUDAGuard g(board.device());
+
+    auto flatboard = board.contiguous().view({-1, board.size(-1), board.size(-1)});
+    const uint B = flatboard.size(0);
+
+    auto hashes = flatboard.new_zeros({B, 2}, at::kLong);
+
+    const uint n_blocks = (B + BLOCK - 1)/BLOCK;
+    hash_kernel<<<{n_blocks}, {BLOCK}, 0, stream()>>>(C3D(flatboard).pta(), L2D(hashes).pta());
+    C10_CUDA_CHECK(cudaGetLastError());
+
+    auto sizes = board.sizes().vec();
+    sizes.pop_back();
+    sizes.back() = 2;
+    return hashes.view(sizes);
+}
+
+}
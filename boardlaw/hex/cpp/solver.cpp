@@ -0,0 +1,195 @@
+#include "common.h"
+#include <algorithm>
+#include <unordered_map>
+#include <vector>
+#include <tuple>
+
+// Exact solver for small boards. Each color's stones fit in a single 64-bit
+// mask, so boards up to 8x8 are supported, though from the empty board only
+// 5x5 and smaller finish in reasonable time.
+//
+// It's a plain negamax: Hex can't be drawn, so every position is either a win
+// or a loss for the player to move, and the search can stop at the first
+// winning move. Results are kept in a transposition table keyed on the same
+// canonical Zobrist hash as `Hex.canonical`, so the table can be handed back
+// to Python and used as a tablebase.
+
+namespace hexsolve {
+
+enum {
+    EMPTY,
+    BLACK,
+    WHITE,
+    TOP,
+    BOT,
+    LEFT,
+    RIGHT
+};
+
+struct Solver {
+    const int S;
+    uint64_t full, first_row, last_row, first_col, last_col;
+    std::vector<int> order;
+    std::unordered_map<int64_t, bool> table;
+
+    Solver(int S) : S(S) {
+        full = (S*S == 64)? ~0ull : ((1ull << (S*S)) - 1);
+        first_row = (1ull << S) - 1;
+        last_row = first_row << (S*(S-1));
+        first_col = 0;
+        for (int r=0; r<S; r++) { first_col |= 1ull << (r*S); }
+        last_col = first_col << (S-1);
+
+        // Try the cells nearest the center first; that's where the winning moves usually are
+        for (int i=0; i<S*S; i++) { order.push_back(i); }
+        auto centrality = [S](int i) {
+            int dr = 2*(i / S) - (S-1), dc = 2*(i % S) - (S-1);
+            return dr*dr + dc*dc + dr*dc;
+        };
+        std::stable_sort(order.begin(), order.end(), [&](int a, int b) { return centrality(a) < centrality(b); });
+    }
+
+    uint64_t spread(uint64_t x) const {
+        return (x | (x >> S) | (x << S)
+                  | ((x >> (S-1)) & ~first_col) | ((x << 1) & ~first_col)
+                  | ((x << (S-1)) & ~last_col) | ((x >> 1) & ~last_col)) & full;
+    }
+
+    // Does the group containing `seed` join the mover's two edges?
+    bool connects(uint64_t seed, uint64_t stones, int seat) const {
+        uint64_t x = seed;
+        while (true) {
+            uint64_t y = spread(x) & stones;
+            if (y == x) { break; }
+            x = y;
+        }
+        return seat? ((x & first_col) && (x & last_col)) : ((x & first_row) && (x & last_row));
+    }
+
+    // How many moves the player is from connecting, ignoring the opponent's
+    // replies. Each step grows the player's territory by one ring of cells,
+    // with their own stones coming for free. Returns S*S if they're cut off.
+    int distance(uint64_t mine, uint64_t theirs, int seat) const {
+        const uint64_t open = full & ~theirs;
+        const uint64_t goal = seat? last_col : last_row;
+        uint64_t x = (seat? first_col : first_row) & open;
+        for (int d=0; d<S*S; d++) {
+            while (true) {
+                uint64_t y = (spread(x) & mine) | x;
+                if (y == x) { break; }
+                x = y;
+            }
+            if (x & goal) { return d; }
+            uint64_t frontier = spread(x) & open & ~x;
+            if (!frontier) { break; }
+            x |= frontier;
+        }
+        return S*S;
+    }
+
+    // Whether the player to move wins. `mine` and `theirs` are the mover's and
+    // the opponent's stones, `seat` is the mover and `hash` is as in `Hex.hash`.
+    bool wins(uint64_t mine, uint64_t theirs, int seat, const int64_t* hash) {
+        const int64_t key = hash[seat];
+        auto found = table.find(key);
+        if (found != table.end()) { return found->second; }
+
+        const uint64_t empty = full & ~(mine | theirs);
+
+        // Look for immediate wins for either side. If we've got one we're done;
+        // if they've got one, we have to block it; and if they've got two, we
+        // can't block both.
+        bool result = false;
+        uint64_t threats = 0;
+        int n_threats = 0;
+        for (int i : order) {
+            uint64_t bit = 1ull << i;
+            if (!(empty & bit)) { continue; }
+            if (connects(bit, mine | bit, seat)) {
+                result = true;
+                break;
+            }
+            if (connects(bit, theirs | bit, 1 - seat)) {
+                threats |= bit;
+                n_threats += 1;
+            }
+        }
+
+        if (!result && (n_threats < 2)) {
+            // Try the moves that do most for our shortest path and least for
+            // theirs first. This ordering is what makes 5x5 tractable.
+            const uint64_t candidates = n_threats? threats : empty;
+            std::vector<std::pair<int, int>> moves;
+            for (int i : order) {
+                uint64_t bit = 1ull << i;
+                if (!(candidates & bit)) { continue; }
+                int score = distance(mine | bit, theirs, seat) - distance(theirs, mine | bit, 1 - seat);
+                moves.push_back(std::make_pair(score, i));
+            }
+            std::stable_sort(moves.begin(), moves.end(),
+                [](const std::pair<int, int>& a, const std::pair<int, int>& b) { return a.first < b.first; });
+
+            for (const auto& move : moves) {
+                const int i = move.second;
+                const uint64_t bit = 1ull << i;
+
+                int64_t child[2] = {hash[0], hash[1]};
+                hexzobrist::place(child, seat, i / S, i % S, S);
+                if (!wins(theirs, mine | bit, 1 - seat, child)) {
+                    result = true;
+                    break;
+                }
+            }
+        }
+
+        table[key] = result;
+        return result;
+    }
+};
+
+// Solves each board in the batch, sharing one transposition table across them.
+// Returns whether the player to move wins, along with every position the
+// search proved as a pair of (canonical hash, mover wins) tensors.
+std::tuple<TT, TT, TT> solve(TT board, TT seats) {
+    const uint B = board.size(0);
+    const int S = board.size(1);
+    TORCH_CHECK((2 <= S) && (S <= 8), "The solver only supports boards between 2x2 and 8x8");
+
+    Solver solver(S);
+
+    TT wins = board.new_zeros({B}, at::kBool);
+    auto board_ta = C3D(board).ta();
+    auto seats_ta = I1D(seats).ta();
+    auto wins_ta = B1D(wins).ta();
+    for (uint b=0; b<B; b++) {
+        uint64_t stones[2] = {0, 0};
+        int64_t hash[2] = {0, 0};
+        for (int r=0; r<S; r++) {
+            for (int c=0; c<S; c++) {
+                auto val = board_ta[b][r][c];
+                if (val == EMPTY) { continue; }
+                int color = ((val == BLACK) | (val == TOP) | (val == BOT))? 0 : 1;
+                stones[color] |= 1ull << (r*S + c);
+                hexzobrist::place(hash, color, r, c, S);
+            }
+        }
+        const int seat = seats_ta[b];
+        wins_ta[b] = solver.wins(stones[seat], stones[1-seat], seat, hash);
+    }
+
+    const int64_t N = solver.table.size();
+    TT keys = board.new_empty({N}, at::kLong);
+    TT values = board.new_empty({N}, at::kBool);
+    auto keys_ta = L1D(keys).ta();
+    auto values_ta = B1D(values).ta();
+    int64_t i = 0;
+    for (const auto& kv : solver.table) {
+        keys_ta[i] = kv.first;
+        values_ta[i] = kv.second;
+        i++;
+    }
+
+    return std::make_tuple(wins, keys, values);
+}
+
+}
@@ -1,27 +1,53 @@
 #include <torch/extension.h>
 #include <torch/csrc/autograd/variable.h>
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
+#include <optional>
 #include "common.h"
 #include "cpu.cpp"
+#include "bitboard.cpp"
+#include "solver.cpp"
 
 namespace py = pybind11;
 using namespace pybind11::literals;
 using namespace std::string_literals;
 
+// The hashes are optional for the plain step kernels, so callers that only care about
+// the board can leave them out. They're still computed, just thrown away.
+TT hash_or_scratch(TT board, std::optional<TT> hash) {
+    return hash? *hash : board.new_zeros({board.size(0), 2}, at::kLong);
+}
+
 #ifdef NOCUDA
-TT step(TT board, TT seats, TT actions) {
-    return hexcpu::step(board, seats, actions);
+TT step(TT board, TT seats, TT actions, std::optional<TT> hash) {
+    return hexcpu::step(board, seats, hash_or_scratch(board, hash), actions);
+}
+
+TT step_at(TT board, TT seats, TT hash, TT parents, TT leaves, TT actions) {
+    return hexcpu::step_at(board, seats, hash, parents, leaves, actions);
 }
 
 TT observe(TT board, TT seats) {
     return hexcpu::observe(board, seats);
 }
+
+TT hash(TT board) {
+    return hexcpu::hash(board);
+}
 #else
-TT step(TT board, TT seats, TT actions) {
+TT step(TT board, TT seats, TT actions, std::optional<TT> hash) {
+    if (board.device().is_cuda()) {
+        return hexcuda::step(board, seats, hash_or_scratch(board, hash), actions);
+    } else {
+        return hexcpu::step(board, seats, hash_or_scratch(board, hash), actions);
+    }
+}
+
+TT step_at(TT board, TT seats, TT hash, TT parents, TT leaves, TT actions) {
     if (board.device().is_cuda()) {
-        return hexcuda::step(board, seats, actions);
+        return hexcuda::step_at(board, seats, hash, parents, leaves, actions);
     } else {
-        return hexcpu::step(board, seats, actions);
+        return hexcpu::step_at(board, seats, hash, parents, leaves, actions);
     }
 }
 
@@ -32,10 +58,95 @@ TT observe(TT board, TT seats) {
         return hexcpu::observe(board, seats);
     }
 }
+
+TT hash(TT board) {
+    if (board.device().is_cuda()) {
+        return hexcuda::hash(board);
+    } else {
+        return hexcpu::hash(board);
+    }
+}
 #endif
 
+// Playouts are serial per env, so they're run on the CPU whatever the device
+std::tuple<TT, TT> playout(TT board, TT seats, TT hash, int64_t n_steps, int64_t seed) {
+    if (board.device().is_cuda()) {
+        auto cpu_board = board.cpu();
+        auto cpu_seats = seats.cpu();
+        auto cpu_hash = hash.cpu();
+        auto [results, first_actions] = hexcpu::playout(cpu_board, cpu_seats, cpu_hash, n_steps, seed);
+        board.copy_(cpu_board);
+        seats.copy_(cpu_seats);
+        hash.copy_(cpu_hash);
+        return std::make_tuple(results.to(board.device()), first_actions.to(board.device()));
+    } else {
+        return hexcpu::playout(board, seats, hash, n_steps, seed);
+    }
+}
+
+// The solver is a serial tree search, so it always runs on the CPU. The table it
+// returns stays there too.
+std::tuple<TT, TT, TT> solve(TT board, TT seats) {
+    auto [wins, keys, values] = hexsolve::solve(board.cpu(), seats.cpu().to(at::kInt));
+    return std::make_tuple(wins.to(board.device()), keys, values);
+}
+
+// The union-find engine only has a CPU implementation
+TT step_uf(TT board, TT forest, TT seats, TT actions, std::optional<TT> hash) {
+    TORCH_CHECK(!board.device().is_cuda(), "step_uf is only implemented on the CPU");
+    return hexcpu::step_uf(board, forest, seats, hash_or_scratch(board, hash), actions);
+}
+
+TT forest(TT board) {
+    TORCH_CHECK(!board.device().is_cuda(), "forest is only implemented on the CPU");
+    return hexcpu::forest(board);
+}
+
+// As are the bitboard kernels
+TT bits_step(TT bits, TT seats, TT hash, TT actions, int boardsize) {
+    TORCH_CHECK(!bits.device().is_cuda(), "bitboards are only implemented on the CPU");
+    return hexbits::step(bits, seats, hash, actions, boardsize);
+}
+
+TT bits_step_at(TT bits, TT seats, TT hash, TT parents, TT leaves, TT actions, int boardsize) {
+    TORCH_CHECK(!bits.device().is_cuda(), "bitboards are only implemented on the CPU");
+    return hexbits::step_at(bits, seats, hash, parents, leaves, actions, boardsize);
+}
+
+std::tuple<TT, TT> bits_playout(TT bits, TT seats, TT hash, int64_t n_steps, int64_t seed, int boardsize) {
+    TORCH_CHECK(!bits.device().is_cuda(), "bitboards are only implemented on the CPU");
+    return hexbits::playout(bits, seats, hash, n_steps, seed, boardsize);
+}
+
+TT bits_observe(TT bits, TT seats, int boardsize) {
+    TORCH_CHECK(!bits.device().is_cuda(), "bitboards are only implemented on the CPU");
+    return hexbits::observe(bits, seats, boardsize);
+}
+
+TT pack(TT board) {
+    TORCH_CHECK(!board.device().is_cuda(), "bitboards are only implemented on the CPU");
+    return hexbits::pack(board);
+}
+
+TT unpack(TT bits, int boardsize) {
+    TORCH_CHECK(!bits.device().is_cuda(), "bitboards are only implemented on the CPU");
+    return hexbits::unpack(bits, boardsize);
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
 
-    m.def("step", &step, "board"_a, "seats"_a, "actions"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("step", &step, "board"_a, "seats"_a, "actions"_a, "hash"_a=py::none(), py::call_guard<py::gil_scoped_release>());
+    m.def("step_at", &step_at, "board"_a, "seats"_a, "hash"_a, "parents"_a, "leaves"_a, "actions"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("playout", &playout, "board"_a, "seats"_a, "hash"_a, "n_steps"_a, "seed"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("solve", &solve, "board"_a, "seats"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("hash", &hash, "board"_a, py::call_guard<py::gil_scoped_release>());
     m.def("observe", &observe, "board"_a, "seats"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("step_uf", &step_uf, "board"_a, "forest"_a, "seats"_a, "actions"_a, "hash"_a=py::none(), py::call_guard<py::gil_scoped_release>());
+    m.def("forest", &forest, "board"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("bits_step", &bits_step, "bits"_a, "seats"_a, "hash"_a, "actions"_a, "boardsize"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("bits_step_at", &bits_step_at, "bits"_a, "seats"_a, "hash"_a, "parents"_a, "leaves"_a, "actions"_a, "boardsize"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("bits_playout", &bits_playout, "bits"_a, "seats"_a, "hash"_a, "n_steps"_a, "seed"_a, "boardsize"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("bits_observe", &bits_observe, "bits"_a, "seats"_a, "boardsize"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("pack", &pack, "board"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("unpack", &unpack, "bits"_a, "boardsize"_a, py::call_guard<py::gil_scoped_release>());
 }
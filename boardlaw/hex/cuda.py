@@ -12,6 +12,54 @@ def module():
 def step(*args, **kwargs):
     return module().step(*args, **kwargs)
 
+@profiling.nvtx
+def step_at(*args, **kwargs):
+    return module().step_at(*args, **kwargs)
+
+@profiling.nvtx
+def playout(*args, **kwargs):
+    return module().playout(*args, **kwargs)
+
+@profiling.nvtx
+def solve(*args, **kwargs):
+    return module().solve(*args, **kwargs)
+
+@profiling.nvtx
+def hash(*args, **kwargs):
+    return module().hash(*args, **kwargs)
+
 @profiling.nvtx
 def observe(*args, **kwargs):
-    return module().observe(*args, **kwargs)
\ No newline at end of file
+    return module().observe(*args, **kwargs)
+
+@profiling.nvtx
+def step_uf(*args, **kwargs):
+    return module().step_uf(*args, **kwargs)
+
+@profiling.nvtx
+def forest(*args, **kwargs):
+    return module().forest(*args, **kwargs)
+
+@profiling.nvtx
+def bits_step(*args, **kwargs):
+    return module().bits_step(*args, **kwargs)
+
+@profiling.nvtx
+def bits_step_at(*args, **kwargs):
+    return module().bits_step_at(*args, **kwargs)
+
+@profiling.nvtx
+def bits_playout(*args, **kwargs):
+    return module().bits_playout(*args, **kwargs)
+
+@profiling.nvtx
+def bits_observe(*args, **kwargs):
+    return module().bits_observe(*args, **kwargs)
+
+@profiling.nvtx
+def pack(*args, **kwargs):
+    return module().pack(*args, **kwargs)
+
+@profiling.nvtx
+def unpack(*args, **kwargs):
+    return module().unpack(*args, **kwargs)
@@ -0,0 +1,154 @@
+"""Exact solutions for small boards.
+
+The native solver proves whether the player to move wins, and along the way proves a lot of other positions too. Those
+get kept as a :class:`Tablebase` - a sorted array of canonical hashes and results - which can be saved to disk and
+memory-mapped back in, so looking up a position is a binary search rather than a search of the game tree. Hashes from
+different board sizes can collide, so a tablebase is tied to a single board size, and its file says which.
+
+From the empty board, everything up to 5x5 solves in a few seconds. Anything larger is only practical from positions
+that are already well along.
+"""
+import os
+import numpy as np
+import torch
+from rebar import arrdict
+from . import cuda
+
+DTYPE = np.dtype([('key', '<i8'), ('win', '?')])
+HEADER = np.dtype([('magic', 'S8'), ('boardsize', '<i8')])
+MAGIC = b'hextable'
+
+def solve(worlds):
+    """Returns whether the player to move in each of `worlds` wins under perfect play, along with a :class:`Tablebase`
+    of every position proved in the process."""
+    wins, keys, values = cuda.solve(worlds.board, worlds.seats)
+    return wins, Tablebase.from_tensors(keys, values, worlds.boardsize)
+
+class Tablebase:
+    """Win/loss for the player to move, keyed on :attr:`Hex.canonical`.
+
+    The table is a single structured array sorted by key, so it can be saved and memory-mapped. On disk it follows a
+    header holding the board size. Positions that aren't in the table come back as unknown. A `boardsize` of None
+    means an empty table that'll take the size of whatever's merged into it."""
+
+    def __init__(self, table, boardsize):
+        self.table = table
+        self.boardsize = boardsize
+
+    @classmethod
+    def from_tensors(cls, keys, wins, boardsize=None):
+        table = np.empty(len(keys), dtype=DTYPE)
+        table['key'] = keys.cpu().numpy()
+        table['win'] = wins.cpu().numpy()
+        table = np.sort(table, order='key')
+        return cls(table, boardsize)
+
+    @classmethod
+    def build(cls, boardsize, path=None):
+        """Solves the empty board, saving the result to `path` if it's given."""
+        from . import Hex
+        _, tablebase = solve(Hex.initial(1, boardsize, device='cpu'))
+        if path is not None:
+            tablebase.save(path)
+        return tablebase
+
+    def save(self, path):
+        if self.boardsize is None:
+            raise ValueError('Can\'t save a tablebase that isn\'t tied to a board size')
+        with open(path, 'wb') as f:
+            np.array([(MAGIC, self.boardsize)], dtype=HEADER).tofile(f)
+            np.asarray(self.table).tofile(f)
+
+    @classmethod
+    def load(cls, path, boardsize=None):
+        """Memory-maps the tablebase at `path`. If `boardsize` is given, it has to match the one it was saved with."""
+        header = np.fromfile(path, dtype=HEADER, count=1)
+        if (len(header) == 0) or (header['magic'][0] != MAGIC):
+            raise ValueError(f'"{path}" isn\'t a tablebase')
+        saved = int(header['boardsize'][0])
+        if (boardsize is not None) and (boardsize != saved):
+            raise ValueError(f'"{path}" is a tablebase for {saved}x{saved} boards, not {boardsize}x{boardsize}')
+
+        if os.path.getsize(path) == HEADER.itemsize:
+            table = np.empty(0, dtype=DTYPE)
+        else:
+            table = np.memmap(path, dtype=DTYPE, mode='r', offset=HEADER.itemsize)
+        return cls(table, saved)
+
+    def _check(self, boardsize):
+        if (self.boardsize is not None) and (boardsize is not None) and (boardsize != self.boardsize):
+            raise ValueError(f'This tablebase is for {self.boardsize}x{self.boardsize} boards, not {boardsize}x{boardsize}')
+
+    def __len__(self):
+        return len(self.table)
+
+    def merge(self, other):
+        """A new in-memory tablebase with the positions from both"""
+        self._check(other.boardsize)
+        table = np.concatenate([np.asarray(self.table), np.asarray(other.table)])
+        table = np.unique(table)
+        return type(self)(table, self.boardsize or other.boardsize)
+
+    def lookup(self, worlds):
+        """Returns an int8 tensor that's 1 where the player to move wins, 0 where they lose, and -1 where the position
+        isn't in the table."""
+        self._check(worlds.boardsize)
+        keys = worlds.canonical.cpu().numpy()
+        idxs = np.searchsorted(self.table['key'], keys).clip(0, max(len(self.table)-1, 0))
+
+        results = np.full(keys.shape, -1, dtype=np.int8)
+        if len(self.table):
+            rows = self.table[idxs]
+            found = rows['key'] == keys
+            results[found] = rows['win'][found]
+        return torch.as_tensor(results, device=worlds.device)
+
+class SolverAgent:
+    """Plays perfectly, choosing uniformly among the winning moves. Positions missing from the tablebase are solved on
+    the fly and added to it. With `random` > 0, that fraction of moves are made uniformly at random instead."""
+
+    def __init__(self, tablebase=None, random=0.):
+        self.tablebase = tablebase if tablebase is not None else Tablebase(np.empty(0, dtype=DTYPE), None)
+        self.random = random
+
+    def _child_wins(self, children):
+        wins = self.tablebase.lookup(children)
+        unknown = (wins == -1).nonzero(as_tuple=True)[0]
+        if len(unknown):
+            solved, tablebase = solve(children[unknown])
+            self.tablebase = self.tablebase.merge(tablebase)
+            wins[unknown] = solved.to(wins.dtype)
+        return wins == 1
+
+    def __call__(self, worlds, value=True, eval=False):
+        envs, actions = worlds.valid.nonzero(as_tuple=True)
+        children, transitions = worlds[envs].step(actions)
+
+        # A move wins if it ends the game, or if it leaves the opponent in a lost position
+        winning = transitions.terminal.clone()
+        live = (~winning).nonzero(as_tuple=True)[0]
+        if len(live):
+            winning[live] = ~self._child_wins(children[live])
+
+        good = torch.zeros_like(worlds.valid)
+        good[envs, actions] = winning
+        wins = good.any(-1)
+        good = good | (~wins[:, None] & worlds.valid)
+
+        logits = torch.log(good.float()/good.sum(-1, keepdims=True))
+        actions = torch.distributions.Categorical(logits=logits).sample()
+        explore = torch.rand(worlds.n_envs, device=worlds.device) < self.random
+        random = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
+        actions = torch.where(explore, random, actions)
+
+        v = 2*wins.float() - 1
+        v = torch.stack([v, -v], -1)
+        v = torch.where(worlds.seats[:, None] == 0, v, v.flip(-1))
+
+        return arrdict.arrdict(
+            logits=logits,
+            v=v,
+            actions=actions)
+
+    def to(self, device):
+        return self
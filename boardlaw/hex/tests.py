@@ -1,10 +1,13 @@
 import time
+import pickle
 import numpy as np
-from . import Hex, cuda, CHARS
+import pytest
+from . import Hex, Bitboard, Random, cuda, CHARS
 import torch
 import torch.distributions
 import torch.cuda
 import torch.testing
+from rebar import arrdict
 
 OPEN_SPIEL_CHARS = 'bw'
 
@@ -140,6 +143,306 @@ def test_basic():
         actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
         worlds, _ = worlds.step(actions)
 
+def test_union_find():
+    # The union-find engine should be bit-identical to the flood-fill one, whether its 
+    # forest is carried along or rebuilt from the board
+    for boardsize in [3, 5, 9]:
+        worlds = Hex.initial(256, boardsize, device='cpu')
+        forest = cuda.forest(worlds.board)
+        for _ in range(4*boardsize**2):
+            seats = worlds.seats.int()
+            actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample().int()
+
+            flood = worlds.board.clone()
+            expected = cuda.step(flood, seats, actions)
+
+            carried = worlds.board.clone()
+            actual = cuda.step_uf(carried, forest, seats, actions)
+            assert torch.equal(flood, carried)
+            assert torch.equal(expected, actual)
+
+            rebuilt = worlds.board.clone()
+            actual = cuda.step_uf(rebuilt, cuda.forest(rebuilt), seats, actions)
+            assert torch.equal(flood, rebuilt)
+            assert torch.equal(expected, actual)
+
+            # Stepping on the CPU goes through the union-find engine by default
+            worlds, transitions = worlds.step(actions)
+            assert worlds._forest is not None
+            assert torch.equal(transitions.rewards, expected)
+            assert torch.equal(worlds.board[~transitions.terminal], flood[~transitions.terminal])
+
+            terminal = transitions.terminal
+            forest[terminal] = cuda.forest(worlds.board[terminal])
+
+def test_bitboard():
+    # Bitboards should play exactly like regular boards, including past 11x11
+    for boardsize in [3, 5, 11, 19]:
+        ours = Hex.initial(64, boardsize, device='cpu')
+        bits = Bitboard.from_hex(ours)
+        inplace = bits.clone()
+        for _ in range(2*boardsize**2):
+            assert torch.equal(bits.board, ours.board)
+            assert torch.equal(bits.hash, ours.hash)
+            assert torch.equal(bits.obs, ours.obs)
+            assert torch.equal(bits.valid, ours.valid)
+
+            actions = torch.distributions.Categorical(probs=ours.valid.float()).sample()
+            ours, expected = ours.step(actions)
+            bits, actual = bits.step(actions)
+            assert torch.equal(expected.rewards, actual.rewards)
+            assert torch.equal(bits.seats, ours.seats)
+
+            actual = inplace.step_(actions)
+            assert torch.equal(expected.rewards, actual.rewards)
+            assert torch.equal(inplace.bits, bits.bits)
+            assert torch.equal(inplace.seats, ours.seats)
+
+        # Packing a board part-way through a game should give the same edge planes as playing it out
+        assert torch.equal(Bitboard.from_hex(ours).bits, bits.bits)
+        assert torch.equal(bits.to_hex().canonical, ours.canonical)
+
+def test_bitboard_natives():
+    worlds = Hex.initial(64, 5, device='cpu')
+    for _ in range(6):
+        actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
+        worlds, _ = worlds.step(actions)
+    bits = Bitboard.from_hex(worlds)
+
+    # Given the same seed, playouts should make the same moves
+    for n_steps in [None, 40]:
+        expected, responses = worlds.playout(n_steps, seed=1)
+        actual, bit_responses = bits.playout(n_steps, seed=1)
+        assert torch.equal(actual.seats, expected.seats)
+        assert torch.equal(actual.hash, expected.hash)
+        assert torch.equal(bit_responses.rewards, responses.rewards)
+        assert torch.equal(bit_responses.first_actions, responses.first_actions)
+        if n_steps is not None:
+            assert torch.equal(actual.board, expected.board)
+
+    store = arrdict.stack([worlds]*4, 1)
+    bit_store = arrdict.stack([bits]*4, 1)
+    envs = torch.arange(worlds.n_envs)
+    for leaf in range(1, 4):
+        parents = torch.randint(leaf, (worlds.n_envs,))
+        leaves = torch.full((worlds.n_envs,), leaf)
+        actions = torch.distributions.Categorical(probs=store[envs, parents].valid.float()).sample()
+        expected = store.step_at(parents, leaves, actions)
+        actual = bit_store.step_at(parents, leaves, actions)
+        assert torch.equal(actual.rewards, expected.rewards)
+        assert torch.equal(bit_store.board, store.board)
+        assert torch.equal(bit_store.seats, store.seats)
+        assert torch.equal(bit_store.hash, store.hash)
+
+    mask = envs % 3 == 0
+    bits.reset_(mask)
+    worlds.reset_(mask)
+    assert torch.equal(bits.obs, worlds.obs)
+    assert torch.equal(bits.hash, worlds.hash)
+
+    # The per-size subclasses need to survive being sent to another process
+    unpickled = pickle.loads(pickle.dumps(bits))
+    assert type(unpickled) is type(bits)
+    assert torch.equal(unpickled.bits, bits.bits)
+
+def test_step_inplace():
+    for boardsize in [3, 5, 11]:
+        ours = Hex.initial(64, boardsize, device='cpu')
+        inplace = ours.clone()
+        for _ in range(2*boardsize**2):
+            actions = torch.distributions.Categorical(probs=ours.valid.float()).sample()
+            ours, expected = ours.step(actions)
+            actual = inplace.step_(actions)
+
+            assert torch.equal(expected.rewards, actual.rewards)
+            assert torch.equal(inplace.board, ours.board)
+            assert torch.equal(inplace.seats, ours.seats)
+            # These are the incrementally-updated caches
+            assert torch.equal(inplace.obs, ours.obs)
+            assert torch.equal(inplace.valid, ours.valid)
+
+def test_reset_inplace():
+    worlds = Hex.initial(64, 5, device='cpu')
+    for _ in range(10):
+        actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
+        worlds.step_(actions)
+
+    mask = torch.arange(64) % 3 == 0
+    board = worlds.board.clone()
+    worlds.reset_(mask)
+
+    fresh = Hex(board=worlds.board.clone(), seats=worlds.seats.clone())
+    assert (worlds.board[mask] == 0).all()
+    assert torch.equal(worlds.board[~mask], board[~mask])
+    assert torch.equal(worlds.hash, fresh.hash)
+    assert torch.equal(worlds.obs, fresh.obs)
+    assert torch.equal(worlds.valid, fresh.valid)
+
+def test_batch_shape():
+    # Stepping a (n_envs, n_nodes) batch should be the same as stepping it flattened
+    flat = Hex.initial(6*4, 5, device='cpu')
+    batched = Hex(board=flat.board.reshape(6, 4, 5, 5), seats=flat.seats.reshape(6, 4))
+    for _ in range(50):
+        actions = torch.distributions.Categorical(probs=flat.valid.float()).sample()
+        flat, expected = flat.step(actions)
+        batched, actual = batched.step(actions.reshape(6, 4))
+
+        assert torch.equal(actual.rewards.reshape(-1, 2), expected.rewards)
+        assert torch.equal(batched.board.reshape(-1, 5, 5), flat.board)
+        assert torch.equal(batched.obs.reshape(-1, 5, 5, 2), flat.obs)
+
+def test_step_at():
+    n_envs, n_nodes = 32, 8
+    worlds = Hex.initial(n_envs, 5, device='cpu')
+    store = Hex(
+        board=worlds.board[:, None].repeat(1, n_nodes, 1, 1), 
+        seats=worlds.seats[:, None].repeat(1, n_nodes))
+    envs = torch.arange(n_envs)
+    for leaf in range(1, n_nodes):
+        # Grow a random tree, stepping each new node from a random existing one
+        parents = torch.randint(leaf, (n_envs,))
+        leaves = torch.full((n_envs,), leaf)
+        parent = store[envs, parents]
+        actions = torch.distributions.Categorical(probs=parent.valid.float()).sample()
+
+        child, expected = parent.step(actions)
+        actual = store.step_at(parents, leaves, actions)
+
+        assert torch.equal(actual.rewards, expected.rewards)
+        assert torch.equal(store.board[envs, leaves], child.board)
+        assert torch.equal(store.seats[envs, leaves], child.seats)
+        assert torch.equal(store[envs, leaves].obs, child.obs)
+
+def test_playout():
+    worlds = Hex.initial(256, 5, device='cpu')
+    finished, responses = worlds.playout(seed=1)
+
+    # Every game should have a single winner, and it should be the last player to move
+    assert (responses.rewards.sum(-1) == 0).all()
+    assert (responses.rewards.abs() == 1).all()
+    winner = (responses.rewards[:, 1] == 1).int()
+    assert torch.equal(finished.seats, 1 - winner)
+
+    # The winning player's stones should include a connected edge group
+    black = ((finished.board == 3) | (finished.board == 4)).any(-1).any(-1)
+    white = ((finished.board == 5) | (finished.board == 6)).any(-1).any(-1)
+    assert (black[winner == 0]).all() and (white[winner == 1]).all()
+
+    # The same seed should play the same games, starting from valid moves
+    again, repeat = worlds.playout(seed=1)
+    assert torch.equal(again.board, finished.board)
+    assert torch.equal(repeat.first_actions, responses.first_actions)
+    assert worlds.valid.gather(1, responses.first_actions[:, None]).all()
+
+    # Stepping for a fixed number of moves should restart finished games
+    mixed, responses = worlds.playout(100, seed=2)
+    assert torch.equal(mixed.obs, Hex(board=mixed.board, seats=mixed.seats).obs)
+    stones = (mixed.board > 0).sum(-1).sum(-1)
+    assert torch.equal(mixed.seats, (stones % 2).int())
+    assert (responses.rewards.abs().sum(-1) > 0).all()
+
+def test_hash():
+    worlds = Hex.initial(64, 5, device='cpu')
+    inplace = worlds.clone()
+    for _ in range(50):
+        actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
+        worlds, _ = worlds.step(actions)
+        inplace.step_(actions)
+
+        # The incremental hash should match hashing the board from scratch
+        assert torch.equal(worlds.hash, cuda.hash(worlds.board))
+        assert torch.equal(inplace.hash, worlds.hash)
+
+    finished, _ = worlds.playout(seed=3)
+    assert torch.equal(finished.hash, cuda.hash(finished.board))
+    
+    # Stepping in place in a store of worlds should also keep the hashes up to date
+    store = arrdict.stack([worlds, worlds], 1)
+    envs = torch.arange(worlds.n_envs)
+    actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
+    store.step_at(torch.zeros_like(envs), torch.ones_like(envs), actions)
+    assert torch.equal(store.hash, cuda.hash(store.board))
+    assert torch.equal(store.hash[:, 0], worlds.hash)
+
+    # Solitaire worlds should carry the hash through the opponent's replies too
+    solo = Random.initial(64, 5, device='cpu')
+    for _ in range(10):
+        actions = torch.distributions.Categorical(probs=solo.valid.float()).sample()
+        solo, _ = solo.step(actions)
+        assert torch.equal(solo.hash, cuda.hash(solo.board))
+
+def test_canonical_hash():
+    worlds = Hex.initial(64, 5, device='cpu')
+    for _ in range(7):
+        actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
+        worlds, _ = worlds.step(actions)
+
+    # Transposing the board and swapping the colors gives the position as the other player sees it
+    swap = torch.tensor([0, 2, 1, 5, 6, 3, 4], dtype=torch.uint8)
+    flipped = Hex(
+        board=swap[worlds.board.long()].transpose(-1, -2).contiguous(), 
+        seats=1 - worlds.seats)
+    assert torch.equal(flipped.obs, worlds.obs)
+    assert torch.equal(flipped.canonical, worlds.canonical)
+    assert torch.equal(flipped.hash, worlds.hash.flip(-1))
+
+    # Canonical hashes should differ whenever the observations do
+    n_distinct_obs = len(torch.unique(worlds.obs.flatten(1), dim=0))
+    assert len(torch.unique(worlds.canonical)) == n_distinct_obs
+
+def test_solver(tmp_path):
+    from .solver import solve, Tablebase, SolverAgent
+
+    # The first player wins on every board size
+    for boardsize in [3, 4]:
+        wins, _ = solve(Hex.initial(1, boardsize, device='cpu'))
+        assert wins.all()
+
+    # A position is won exactly when one of its moves either ends the game or leaves the opponent in a lost position
+    worlds = Hex.initial(64, 4, device='cpu')
+    for _ in range(5):
+        actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
+        worlds, _ = worlds.step(actions)
+    wins, _ = solve(worlds)
+    for e in range(worlds.n_envs):
+        actions = worlds.valid[e].nonzero().squeeze(-1)
+        children, transitions = worlds[[e]*len(actions)].step(actions)
+        child_wins, _ = solve(children)
+        assert wins[e] == (transitions.terminal | ~child_wins).any()
+
+    # Round-tripping the tablebase through disk should give the same lookups
+    tablebase = Tablebase.build(3, tmp_path / 'hex-3.tb')
+    loaded = Tablebase.load(tmp_path / 'hex-3.tb')
+    assert len(loaded) == len(tablebase)
+    assert loaded.boardsize == 3
+
+    # ...and the board size should come along with it, so a tablebase can't be used on the wrong board
+    with pytest.raises(ValueError):
+        Tablebase.load(tmp_path / 'hex-3.tb', boardsize=4)
+    with pytest.raises(ValueError):
+        loaded.lookup(Hex.initial(1, 4, device='cpu'))
+    worlds = Hex.initial(64, 3, device='cpu')
+    for _ in range(3):
+        actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
+        worlds, _ = worlds.step(actions)
+    assert torch.equal(loaded.lookup(worlds), tablebase.lookup(worlds))
+    known = loaded.lookup(worlds) >= 0
+    assert torch.equal(loaded.lookup(worlds)[known].bool(), solve(worlds)[0][known])
+
+    # Playing first, the solver should never lose 
+    agent = SolverAgent(loaded)
+    worlds = Hex.initial(64, 3, device='cpu')
+    rewards = torch.zeros((worlds.n_envs, 2))
+    live = torch.ones(worlds.n_envs, dtype=torch.bool)
+    while live.any():
+        solver_actions = agent(worlds).actions
+        random_actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
+        actions = torch.where(worlds.seats == 0, solver_actions, random_actions)
+        worlds, transitions = worlds.step(actions)
+        rewards += transitions.rewards * live[:, None].float()
+        live = live & ~transitions.terminal
+    assert (rewards[:, 0] == 1).all()
+
 def open_spiel_board(state):
     # state ordering taken from hex.h 
     strs = 'W<>w.bv^B'
@@ -1,6 +1,8 @@
 import torch
 import numpy as np
 from itertools import cycle
+from rebar import arrdict
+from pavlov import stats
 
 PRIME = 160481219
 
@@ -70,6 +72,60 @@ def reward_to_go(reward, value, terminal, gamma=1.):
     fallback[terminal] = reward[terminal]
     return present_value(reward[:-1], fallback, terminal, gamma).detach()
 
+class Resigner:
+
+    def __init__(self, n_envs, threshold=.95, patience=8, playout_frac=.1, device='cuda'):
+        """Ends games early once they're decided. An env resigns once the same seat's root value has been above 
+        `threshold` for `patience` moves in a row, and that seat is declared the winner. 
+        
+        A random `playout_frac` of the games that would've resigned are played on to the end instead, and the 
+        fraction of those the called seat went on to lose is logged as `resign.false-positive`. That's what to tune 
+        `threshold` against."""
+        self.threshold = threshold
+        self.patience = patience
+        self.playout_frac = playout_frac
+        self.leader = torch.full((n_envs,), -1, dtype=torch.long, device=device)
+        self.streak = torch.zeros((n_envs,), dtype=torch.long, device=device)
+        # The seat each played-out game was called for, or -1 if it isn't being played out
+        self.called = torch.full((n_envs,), -1, dtype=torch.long, device=device)
+
+    def __call__(self, v, transition):
+        """Takes the (n_envs, n_seats) root values the moves were chosen with, and the transition that came of them. 
+        Resigned envs are marked as terminal in `transition` and given a win for the leading seat, in place. 
+
+        Returns a mask of the envs that resigned. Their worlds still need resetting."""
+        terminal, rewards = transition.terminal, transition.rewards
+
+        ahead = v > self.threshold
+        leader = torch.where(ahead.any(-1), ahead.float().argmax(-1), torch.full_like(self.leader, -1))
+        held = (leader == self.leader) & (leader >= 0)
+        self.streak = torch.where(held, self.streak + 1, (leader >= 0).long())
+        self.leader = leader
+
+        due = (self.streak >= self.patience) & (self.called < 0) & ~terminal
+        play_out = due & (torch.rand(due.shape, device=due.device) < self.playout_frac)
+        self.called[play_out] = leader[play_out]
+        resigned = due & ~play_out
+
+        finished = terminal & (self.called >= 0)
+        wrong = finished & (rewards.argmax(-1) != self.called)
+
+        seats = torch.arange(rewards.size(-1), device=rewards.device)
+        won = (seats == leader[:, None]).to(rewards.dtype)
+        rewards[resigned] = (2*won - 1)[resigned]
+        terminal[resigned] = True
+
+        self.leader[terminal] = -1
+        self.streak[terminal] = 0
+        self.called[terminal] = -1
+
+        with stats.defer():
+            stats.mean('resign.false-positive', wrong.sum(), finished.sum())
+            stats.mean('resign.rate', resigned.sum(), terminal.sum())
+            stats.cumsum('count.resignations', resigned.sum())
+
+        return resigned
+
 #########
 # TESTS #
 #########
@@ -87,6 +143,36 @@ def test_reward_to_go():
     actual = reward_to_go(reward, value, terminal, gamma)
     torch.testing.assert_allclose(actual, torch.tensor([3., 2., 6.]))
 
+def test_resigner():
+    def transition(terminal, rewards):
+        return arrdict.arrdict(terminal=torch.tensor(terminal), rewards=torch.tensor(rewards))
+
+    # Seat 1 is confident in env 0 from the start, and in env 1 from the second move. Env 2 is never confident.
+    resigner = Resigner(3, threshold=.9, patience=3, playout_frac=0., device='cpu')
+    v = torch.tensor([[-1., 1.], [1., -1.], [0., 0.]])
+    resigned = []
+    for t in range(4):
+        v[1] = torch.tensor([-1., 1.]) if t > 0 else v[1]
+        trans = transition([False]*3, [[0., 0.]]*3)
+        resigned.append(resigner(v, trans))
+        if t == 2:
+            assert torch.equal(trans.terminal, torch.tensor([True, False, False]))
+            assert torch.equal(trans.rewards[0], torch.tensor([-1., 1.]))
+    resigned = torch.stack(resigned)
+
+    assert torch.equal(resigned[:, 0], torch.tensor([False, False, True, False]))
+    assert torch.equal(resigned[:, 1], torch.tensor([False, False, False, True]))
+    assert not resigned[:, 2].any()
+
+    # Games that get played out instead are tracked until they end
+    resigner = Resigner(1, threshold=.9, patience=1, playout_frac=1., device='cpu')
+    v = torch.tensor([[1., -1.]])
+    assert not resigner(v, transition([False], [[0., 0.]])).any()
+    assert resigner.called[0] == 0
+
+    assert not resigner(v, transition([True], [[-1., 1.]])).any()
+    assert resigner.called[0] == -1
+
 def test_batch_indices():
     buffer_length = 16
     buffer_inc = 4
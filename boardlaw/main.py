@@ -1,11 +1,13 @@
 import time
+import copy
 import numpy as np
 import torch
 from rebar import arrdict, profiling, pickle
 from pavlov import stats, logs, runs, storage, archive
-from . import hex, mcts, networks, learning, validation, analysis, arena, leagues
+from . import hex, mcts, networks, learning, validation, analysis, arena, leagues, actors
 from torch.nn import functional as F
 from logging import getLogger
+from contextlib import nullcontext
 
 log = getLogger(__name__)
 
@@ -29,6 +31,7 @@ def chunk_stats(chunk, n_new):
         stats.rate('step-rate.inputs', n_inputs)
         stats.rate('sim-rate', n_sims)
         stats.mean('mcts-n-leaves', d.n_leaves.float().mean())
+        stats.mean('mcts-full-frac', d.full.float().mean())
 
         wins = (t.rewards == 1).sum(0).sum(0)
         for i, w in enumerate(wins):
@@ -84,7 +87,7 @@ def noise_scale(B, opt):
 
 def optimize(network, scaler, opt, batch):
 
-    with torch.cuda.amp.autocast():
+    with torch.cuda.amp.autocast(batch.worlds.device.type == 'cuda'):
         d0 = batch.decisions
         d = network(batch.worlds)
 
@@ -92,7 +95,9 @@ def optimize(network, scaler, opt, batch):
         l = d.logits.where(d.logits > -np.inf, zeros)
         l0 = d0.logits.float().where(d0.logits > -np.inf, zeros)
 
-        policy_loss = -(l0.exp()*l).sum(axis=-1).mean()
+        # Only the moves that got a full search make for good policy targets, but they all count towards the value
+        full = d0.full.float()
+        policy_loss = -((l0.exp()*l).sum(axis=-1)*full).sum()/full.sum().clamp(1, None)
 
         target_value = batch.reward_to_go
         value_loss = (target_value - d.v).square().mean()
@@ -158,19 +163,17 @@ def agent_factory(worldfunc, **kwargs):
     network = networks.FCModel(worlds.obs_space, worlds.action_space, **kwargs).to(worlds.device)
     return mcts.MCTSAgent(network)
 
-def warm_start(agent, opt, scaler, parent):
+def warm_start(agent, opt, scaler, parent, device='cuda'):
     if parent:
         parent = runs.resolve(parent)
-        sd = storage.load_latest(parent, device='cuda')
+        sd = storage.load_latest(parent, device=device)
         agent.load_state_dict(sd['agent'])
         opt.load_state_dict(sd['opt'])
         scaler.load_state_dict(sd['scaler'])
     return parent
 
 def mix(worlds, T=2500):
-    for _ in range(T):
-        actions = torch.distributions.Categorical(probs=worlds.valid.float()).sample()
-        worlds, transitions = worlds.step(actions)
+    worlds, _ = worlds.playout(T)
     return worlds
 
 @arrdict.mapping
@@ -188,58 +191,90 @@ def time_limited_loop(timelimit):
 
         yield 
 
-def run(boardsize, width, depth, timelimit, desc):
+def run(boardsize, width, depth, timelimit, desc, playout_cap=None, resign=None, n_actors=None, device='cuda', bitboard=False):
+    """With `n_actors`, self-play runs in that many CPU processes and only the learner runs on `device`, so a run 
+    without a GPU can pass `device='cpu'`.
+    
+    With `bitboard`, self-play uses :class:`hex.Bitboard` worlds, which take a fraction of the memory per search 
+    tree node. They're CPU-only, so they need either `n_actors` or `device='cpu'`. The learner still gets regular 
+    :class:`hex.Hex` worlds."""
+    if bitboard and (n_actors is None) and (torch.device(device).type != 'cpu'):
+        raise ValueError('Bitboards only run on the CPU, so they need either `n_actors` or `device="cpu"`')
+
     buffer_len = 64
     n_envs = 32*1024
 
     #TODO: Restore league and sched when you go back to large boards
-    worlds = mix(hex.Hex.initial(n_envs, boardsize))
+    worlds = mix(hex.Hex.initial(n_envs, boardsize, device=device))
+    players = worlds if n_actors is None else worlds.to('cpu')
+    if bitboard:
+        players = hex.Bitboard.from_hex(players)
     network = networks.FCModel(worlds.obs_space, worlds.action_space, width=width, depth=depth).to(worlds.device)
-    agent = mcts.MCTSAgent(network)
+    agent = mcts.MCTSAgent(networks.Deduplicator(network), reuse=True, playout_cap=playout_cap)
+    # `resign` is (threshold, patience, playout_frac); see `learning.Resigner`
+    resigner = None if resign is None else learning.Resigner(n_envs, *resign, device=worlds.device)
 
     opt = torch.optim.Adam(network.parameters(), lr=1e-3)
-    scaler = torch.cuda.amp.GradScaler()
+    # Mixed precision is only used on the GPU
+    scaler = torch.cuda.amp.GradScaler(enabled=(worlds.device.type == 'cuda'))
 
-    parent = warm_start(agent, opt, scaler, '')
+    parent = warm_start(agent, opt, scaler, '', device=worlds.device)
 
     run = runs.new_run(
             description=desc, 
-            params=dict(boardsize=worlds.boardsize, width=width, depth=depth, parent=parent))
+            params=dict(boardsize=worlds.boardsize, width=width, depth=depth, parent=parent, playout_cap=playout_cap, resign=resign, n_actors=n_actors, device=str(worlds.device), bitboard=bitboard))
 
     archive.archive(run)
 
+    if n_actors is None:
+        pool = nullcontext()
+    else:
+        # Self-play moves out to CPU processes, each with its own copy of the network
+        actor = mcts.MCTSAgent(networks.Deduplicator(copy.deepcopy(network).cpu()), reuse=True, playout_cap=playout_cap)
+        pool = actors.ActorPool(actor, players, n_actors, resign=resign, run=run)
+
     buffer = []
     with logs.to_run(run), stats.to_run(run), \
-            arena.mohex.run(run):
+            arena.mohex.run(run), pool:
         #TODO: Upgrade this to handle batches that are some multiple of the env count
-        idxs = (torch.randint(buffer_len, (n_envs,), device='cuda'), torch.arange(n_envs, device='cuda'))
+        idxs = (torch.randint(buffer_len, (n_envs,), device=worlds.device), torch.arange(n_envs, device=worlds.device))
         for _ in time_limited_loop(timelimit):
 
             # Collect experience
             while len(buffer) < buffer_len:
-                with torch.no_grad():
-                    decisions = agent(worlds, value=True)
-                new_worlds, transition = worlds.step(decisions.actions)
+                if n_actors is None:
+                    # The buffer holds on to every step until the learner's used it, so each step's old worlds need
+                    # their own storage; `play`'s clone is that storage
+                    sample = actors.play(agent, players, resigner)
+                else:
+                    sample = pool.step()
 
-                buffer.append(arrdict.arrdict(
-                    worlds=worlds,
-                    decisions=decisions.half(),
-                    transitions=half(transition)).detach())
+                if bitboard:
+                    sample['worlds'] = sample.worlds.to_hex()
+                sample = sample.to(worlds.device)
 
-                worlds = new_worlds
+                buffer.append(arrdict.arrdict(
+                    worlds=sample.worlds,
+                    decisions=sample.decisions.half(),
+                    transitions=half(sample.transitions)).detach())
 
                 log.info(f'({len(buffer)}/{buffer_len}) actor stepped')
 
             # Optimize
             chunk, buffer = as_chunk(buffer, n_envs)
             optimize(network, scaler, opt, chunk[idxs])
+            # The reused trees were evaluated by the old weights
+            agent.forget()
+            if n_actors is not None:
+                pool.update(network)
             log.info('learner stepped')
 
             sd = storage.state_dicts(agent=agent, opt=opt, scaler=scaler)
             storage.throttled_latest(run, sd, 60)
             storage.throttled_snapshot(run, sd, 900)
             storage.throttled_raw(run, 'model', lambda: pickle.dumps(network), 900)
-            stats.gpu(worlds.device, 15)
+            if worlds.device.type == 'cuda':
+                stats.gpu(worlds.device, 15)
 
         log.info('Finished; saving final state dict')
         sd = storage.state_dicts(agent=agent, opt=opt, scaler=scaler)
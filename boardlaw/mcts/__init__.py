@@ -1,15 +1,25 @@
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import threading
+import time
+from collections import defaultdict
 from multiprocessing import Value
 import numpy as np
 import torch
 import torch.distributions
-from rebar import arrdict
+from rebar import arrdict, dotdict
 from . import cuda
 import logging
 from rebar import profiling
+from pavlov import stats
 
 log = logging.getLogger(__name__)
 
+# Mixed into position hashes to keep each env's positions apart when evaluations are only shared within an env.
+# It's the 64-bit golden ratio, as a signed int.
+SALT = -7046029254386353131
+
 def dirichlet_noise(logits, valid, eps, alpha_scale=10):
     alpha = alpha_scale/logits.size(-1)
     alpha = torch.full((valid.shape[-1],), alpha, dtype=torch.float, device=logits.device)
@@ -23,13 +33,71 @@ def dirichlet_noise(logits, valid, eps, alpha_scale=10):
 
     return (logits.exp()*(1 - eps) + draw*eps).log()
 
+class Workspace:
+
+    def __init__(self):
+        """Holds on to the buffers of an MCTS between searches, so a new search only has to fill them rather than 
+        allocate them. A buffer's only reallocated when its shape changes, which is when the env count or node count 
+        does. 
+        
+        The buffers are handed out as-is, so the previous search's tree gets overwritten by the next one."""
+        self._buffers = {}
+
+    def empty(self, name, shape, dtype, device):
+        buffer = self._buffers.get(name)
+        if (buffer is None) or (buffer.shape != shape) or (buffer.dtype != dtype) or (buffer.device != device):
+            buffer = self._buffers[name] = torch.empty(shape, dtype=dtype, device=device)
+        return buffer
+
+    def full(self, name, shape, fill, dtype, device):
+        return self.empty(name, shape, dtype, device).fill_(fill)
+
+    def stack(self, name, world, n):
+        """Like `arrdict.stack([world for _ in range(n)], 1)`"""
+        count = itertools.count()
+
+        @arrdict.mapping
+        def expand(x):
+            buffer = self.empty(f'{name}.{next(count)}', (x.shape[0], n, *x.shape[1:]), x.dtype, x.device)
+            return buffer.copy_(x[:, None].expand_as(buffer))
+
+        return expand(world)
+
 
 class MCTS:
 
-    def __init__(self, world, n_nodes=64, c_puct=1/16, noise_eps=.25, alpha_scale=10):
+    def __init__(self, world, n_nodes=64, c_puct=1/16, noise_eps=.25, alpha_scale=10, n_descents=1, share_evals=None, 
+            compact=False, stop_kl=None, precision='compact', pipeline=False, workspace=None):
         """
         c_puct high: concentrates on prior
         c_puct low: concentrates on value
+
+        n_descents > 1 expands that many leaves per env on each simulation, with virtual loss keeping the descents apart.
+        That means fewer, bigger network calls, at the cost of each descent seeing slightly staler statistics.
+
+        share_evals='env' reuses the network's evaluation of a position when a new leaf turns out to hold a 
+        position that's already in the env's tree. 'batch' goes further, and reuses evaluations from any env's tree. 
+        Either needs worlds with a `hash`. Only the evaluations are shared: transposed nodes still keep their own 
+        visit statistics, since the backup follows each node's single parent. Evaluations are matched by hash, so a 
+        hash collision would hand a leaf another position's evaluation.
+
+        compact=True keeps a full world for the root only. The other nodes just keep their seat and hash, and 
+        their worlds are rebuilt by replaying the moves down from the root when they're expanded. That trades a few
+        extra steps per simulation for not having to hold n_nodes copies of the board.
+
+        stop_kl lets each env stop early, once a quarter of its budget is spent and the KL divergence between its 
+        successive root policies drops below stop_kl. It also stops once its most-visited move can't be overtaken, or 
+        if it's only got one move to choose from. Stopped envs are left out of the network calls.
+
+        precision='wide' stores the tree's statistics as floats and its node indices as ints, rather than the halves
+        and shorts of the default 'compact'. That's needed for trees of more than 32k nodes, or for searches long enough
+        that summing values in half-precision starts to lose track of them.
+
+        pipeline=True splits the envs into two halves and staggers their simulations, so one half's descent, 
+        stepping and backup run on a worker thread while the other half's leaves are with the network. The q 
+        normalization and any 'batch' evaluation sharing is then per-half rather than over the whole batch.
+
+        workspace, if given, is a `Workspace` to take the buffers from, rather than allocating new ones.
         """
         self.device = world.device
         self.n_envs = world.n_envs
@@ -37,114 +105,445 @@ class MCTS:
         self.n_seats = world.n_seats
         assert n_nodes > 1, 'MCTS requires at least two nodes'
 
+        if precision not in ('compact', 'wide'):
+            raise ValueError(f'precision should be "compact" or "wide"; got "{precision}"')
+        self.precision = precision
+        self.itype, self.ftype = (torch.short, torch.half) if precision == 'compact' else (torch.int, torch.float)
+        if n_nodes > torch.iinfo(self.itype).max:
+            raise ValueError(f'{n_nodes} nodes is too many for {precision} precision')
+
         self.envs = torch.arange(world.n_envs, device=self.device)
 
-        self.n_actions = np.prod(world.action_space)
+        ws = Workspace() if workspace is None else workspace
+        B, T, S = world.n_envs, self.n_nodes, self.n_seats
+        self.n_actions = A = np.prod(world.action_space)
         self.tree = arrdict.arrdict(
-            children=self.envs.new_full((world.n_envs, self.n_nodes, self.n_actions), -1, dtype=torch.short),
-            parents=self.envs.new_full((world.n_envs, self.n_nodes), -1, dtype=torch.short),
-            relation=self.envs.new_full((world.n_envs, self.n_nodes), -1, dtype=torch.short))
-
-        self.worlds = arrdict.stack([world for _ in range(self.n_nodes)], 1)
+            children=ws.full('children', (B, T, A), -1, self.itype, self.device),
+            parents=ws.full('parents', (B, T), -1, self.itype, self.device),
+            relation=ws.full('relation', (B, T), -1, self.itype, self.device))
+
+        self.compact = compact
+        if compact:
+            store = arrdict.arrdict(seats=world.seats)
+            if 'hash' in world:
+                store['hash'] = world.hash
+            self.worlds = ws.stack('compact', store, self.n_nodes)
+            self.root_world = world.clone()
+        else:
+            self.worlds = ws.stack('worlds', world, self.n_nodes)
         
         self.transitions = arrdict.arrdict(
-            rewards=torch.full((world.n_envs, self.n_nodes, self.n_seats), 0., device=self.device, dtype=torch.half),
-            terminal=torch.full((world.n_envs, self.n_nodes), False, device=self.device, dtype=torch.bool))
+            rewards=ws.full('rewards', (B, T, S), 0., self.ftype, self.device),
+            terminal=ws.full('terminal', (B, T), False, torch.bool, self.device))
 
         self.decisions = arrdict.arrdict(
-            logits=torch.full((world.n_envs, self.n_nodes, self.n_actions), np.nan, device=self.device, dtype=torch.half),
-            v=torch.full((world.n_envs, self.n_nodes, self.n_seats), np.nan, device=self.device, dtype=torch.half))
+            logits=ws.full('logits', (B, T, A), np.nan, self.ftype, self.device),
+            v=ws.full('v', (B, T, S), np.nan, self.ftype, self.device))
 
         self.stats = arrdict.arrdict(
-            n=torch.full((world.n_envs, self.n_nodes), 0, device=self.device, dtype=torch.short),
-            w=torch.full((world.n_envs, self.n_nodes, self.n_seats), 0., device=self.device, dtype=torch.half))
-
-        self.sim = torch.tensor(0, device=self.device, dtype=torch.long)
-        self.worlds[:, 0] = world
+            n=ws.full('n', (B, T), 0, self.itype, self.device),
+            w=ws.full('w', (B, T, S), 0., self.ftype, self.device),
+            # Each node's last policy solution, to warm-start the next. It's a float whatever the precision, since the
+            # Newton search is sensitive to it.
+            alpha=ws.full('alpha', (B, T), 0., torch.float, self.device),
+            # Each node's exponentiated logits, which is what the kernels' policy calculation actually wants. Worked 
+            # out once when the node's logits are stored.
+            prior=ws.full('prior', (B, T, A), np.nan, torch.float, self.device),
+            # Each node's visit count and q normalization as of its last policy solution. A count of -1 marks the 
+            # solution as out of date.
+            solved=ws.full('solved', (B, T, 3), -1., torch.float, self.device))
+
+        # The number of nodes each env has in use. Envs whose trees have been carried over from a previous move can 
+        # start with more than one.
+        self.sim = ws.full('sim', (B,), 0, torch.long, self.device)
+        # The number of nodes each env had when the current search started, so the ones it's added can be counted
+        self.carried = ws.full('carried', (B,), 0, torch.long, self.device)
+        # The number of nodes each env is allowed to use, which can be less than the n_nodes it's got room for
+        self.budget = ws.full('budget', (B,), n_nodes, torch.long, self.device)
 
         # https://github.com/LeelaChessZero/lc0/issues/694
         # Larger c_puct -> greater regularization
-        self.c_puct = torch.full((world.n_envs,), c_puct, device=self.device, dtype=torch.half)
+        self.c_puct = ws.full('c_puct', (B,), c_puct, self.ftype, self.device)
 
         self.noise_eps = noise_eps
         self.alpha_scale = alpha_scale
+        self.n_descents = n_descents
+        self.pipeline = pipeline
+
+        if share_evals not in (None, 'env', 'batch'):
+            raise ValueError(f'share_evals should be None, "env" or "batch"; got "{share_evals}"')
+        if share_evals and ('hash' not in world):
+            raise ValueError('Sharing evaluations needs worlds with a `hash` field')
+        self.share_evals = share_evals
+
+        self.stop_kl = stop_kl
+        self.stopped = ws.full('stopped', (B,), False, torch.bool, self.device)
+        self._last_root = None
+
+        # Wall-clock seconds spent in each phase of the search, kept per thread so that the pipeline's worker never 
+        # updates the same counter as the main thread. See `timings`.
+        self._timings = {}
+
+    @property
+    def timings(self):
+        """Wall-clock seconds spent in each phase of the search. On the GPU these only cover launching the kernels, 
+        since nothing's synchronized. When pipelining, the two threads' times are added together."""
+        totals = defaultdict(float)
+        for timings in list(self._timings.values()):
+            for phase, duration in timings.items():
+                totals[phase] += duration
+        return totals
+
+    @contextmanager
+    def _timed(self, phase):
+        timings = self._timings.setdefault(threading.get_ident(), defaultdict(float))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            timings[phase] += time.perf_counter() - start
 
     def initialize(self, network):
-        world = self.worlds[:, 0]
-        with torch.no_grad():
+        world = self.world_at(self.envs, torch.zeros_like(self.envs))
+        with torch.no_grad(), self._timed('forward'):
             decisions = network(world)
             assert (decisions.logits > -np.inf).any(-1).all(), 'Some row of logits are all neginf or nan'
-        self.decisions.logits[:, self.sim] = dirichlet_noise(decisions.logits, world.valid, self.noise_eps, self.alpha_scale)
+        self._store_logits(self.envs, 0, dirichlet_noise(decisions.logits, world.valid, self.noise_eps, self.alpha_scale))
         self.decisions.v[:, 0] = decisions.v
 
         self.sim += 1
+        if self.stop_kl is not None:
+            self.stopped |= (world.valid.sum(-1) <= 1)
+
+    def _subtrees(self, roots):
+        """Marks the nodes descended from - and including - each env's root. Parents always have lower indices than
+        their children, so this is done by pointer-jumping up the tree in log(n_nodes) steps."""
+        nodes = torch.arange(self.n_nodes, device=self.device)
+        inside = (nodes[None] == roots[:, None])
+        jump = self.tree.parents.long()
+        for _ in range(int(np.ceil(np.log2(self.n_nodes)))):
+            valid = (jump >= 0)
+            safe = jump.clamp(0, None)
+            inside = inside | (valid & inside.gather(1, safe))
+            jump = torch.where(valid, jump.gather(1, safe), jump)
+        return inside
 
-    def _cuda(self):
+    @profiling.nvtx
+    def reroot(self, world, network):
+        """Carries the tree over to `world`, which should be a position reached by the moves played since the tree was
+        last used. For each env, the node holding that position becomes the new root, and the subtree under it is 
+        moved down to the lowest node indices with its visit counts intact. Envs where the position can't be found
+        start again from a fresh root. 
+        
+        The search needs the worlds' hashes to find the positions, so this returns False if there aren't any and the
+        tree is left untouched."""
+        if (world.n_envs != self.n_envs) or ('hash' not in world) or ('hash' not in self.worlds):
+            return False
+
+        nodes = torch.arange(self.n_nodes, device=self.device)
+        exists = (nodes[None] < self.sim[:, None]) & ((self.tree.parents != -1) | (nodes[None] == 0))
+        match = (
+            exists & 
+            ~self.transitions.terminal &
+            (self.worlds.hash == world.hash[:, None]).all(-1) &
+            (self.worlds.seats == world.seats[:, None]))
+        found = match.any(-1)
+        # Prefer the best-explored copy of the position if it's turned up more than once
+        roots = torch.where(match, self.stats.n.long() + 1, torch.zeros_like(self.stats.n, dtype=torch.long)).argmax(-1)
+        roots = torch.where(found, roots, torch.zeros_like(roots))
+
+        inside = self._subtrees(roots) & found[:, None]
+        inside[:, 0] |= ~found
+
+        # Stable-sorting the kept nodes to the front keeps parents in front of their children
+        order = torch.sort((~inside).int(), dim=-1, stable=True).indices
+        kept = inside.gather(1, order)
+        renumber = inside.long().cumsum(-1) - 1
+
+        def remap(idxs):
+            idxs = idxs.long()
+            valid = (idxs >= 0) & inside.gather(1, idxs.clamp(0, None).flatten(1)).view_as(idxs)
+            renumbered = renumber.gather(1, idxs.clamp(0, None).flatten(1)).view_as(idxs)
+            return torch.where(valid, renumbered, torch.full_like(renumbered, -1)).to(self.itype)
+
+        envs = self.envs[:, None]
+        children = remap(self.tree.children[envs, order])
+        parents = remap(self.tree.parents[envs, order])
+        self.tree.children[:] = children.where(kept[..., None], torch.full_like(children, -1))
+        self.tree.parents[:] = parents.where(kept, torch.full_like(parents, -1))
+        self.tree.relation[:] = self.tree.relation[envs, order].where(kept, torch.full_like(self.tree.relation, -1))
+        self.tree.relation[:, 0] = -1
+        self.worlds[:] = self.worlds[envs, order]
+
+        blanks = {
+            'transitions': {'rewards': 0., 'terminal': False},
+            'decisions': {'logits': np.nan, 'v': np.nan},
+            'stats': {'n': 0, 'w': 0., 'alpha': 0., 'prior': np.nan, 'solved': -1.}}
+        for name, fields in blanks.items():
+            for k, blank in fields.items():
+                x = getattr(self, name)[k]
+                mask = kept.view(kept.shape + (1,)*(x.ndim - 2))
+                x[:] = x[envs, order].where(mask, torch.full_like(x, blank))
+
+        # The root's incoming transition is in the past now
+        self.transitions.rewards[:, 0] = 0.
+        self.transitions.terminal[:, 0] = False
+        self.sim[:] = inside.sum(-1)
+
+        # Envs that have moved to a new root need fresh noise, and envs that didn't find their position need a 
+        # fresh root altogether.
+        moved = (found & (roots != 0)).nonzero().squeeze(-1)
+        if len(moved):
+            logits = self.decisions.logits[moved, 0].float()
+            valid = world[moved].valid
+            self._store_logits(moved, 0, dirichlet_noise(logits, valid, self.noise_eps, self.alpha_scale))
+            self.stats.solved[moved, 0] = -1.
+
+        fresh = (~found).nonzero().squeeze(-1)
+        if len(fresh):
+            self.worlds[fresh, 0] = world[fresh]
+            with torch.no_grad(), self._timed('forward'):
+                decisions = network(world[fresh])
+            self._store_logits(fresh, 0, dirichlet_noise(decisions.logits, world[fresh].valid, self.noise_eps, self.alpha_scale))
+            self.stats.solved[fresh, 0] = -1.
+            self.decisions.v[fresh, 0] = decisions.v.to(self.ftype)
+            self.stats.n[fresh, 0] = 0
+            self.stats.w[fresh, 0] = 0.
+            self.tree.children[fresh, 0] = -1
+
+        if self.compact:
+            self.root_world = world.clone()
+
+        self.stopped[:] = False
+        self._last_root = None
+        if self.stop_kl is not None:
+            self.stopped |= (world.valid.sum(-1) <= 1)
+
+        return True
+
+    def _cuda(self, part=slice(None)):
+        # Slicing along the env dimension leaves the tensors contiguous, so the kernels can work on a part in-place
         return cuda.mcts(
-            self.decisions.logits, 
-            self.stats.w, 
-            self.stats.n, 
-            self.c_puct, 
-            self.worlds.seats, 
-            self.transitions.terminal, 
-            self.tree.children)
+            self.decisions.logits[part], 
+            self.stats.w[part], 
+            self.stats.n[part], 
+            self.c_puct[part], 
+            self.worlds.seats[part], 
+            self.transitions.terminal[part], 
+            self.tree.children[part],
+            self.stats.alpha[part],
+            self.stats.prior[part],
+            self.stats.solved[part])
+
+    def _store_logits(self, envs, nodes, logits):
+        """Stores the logits of the given nodes, along with the prior the kernels work from"""
+        self.decisions.logits[envs, nodes] = logits.to(self.ftype)
+        self.stats.prior[envs, nodes] = self.decisions.logits[envs, nodes].float().exp()
 
     @profiling.nvtx
-    def descend(self):
-        result = cuda.descend(self._cuda())
-        return result.parents.long(), result.actions.long()
+    def descend(self, part=slice(None)):
+        with self._timed('descend'):
+            if self.n_descents == 1:
+                result = cuda.descend(self._cuda(part))
+                return result.parents.long()[:, None], result.actions.long()[:, None]
+            parents, actions = cuda.descend_many(self._cuda(part), self.n_descents)
+            return parents.long(), actions.long()
 
     @profiling.nvtx
-    def backup(self, leaves):
+    def backup(self, leaves, part=slice(None)):
+        # Envs with a leaf of -1 are skipped
         bk = cuda.Backup(
-            v=self.decisions.v,
-            w=self.stats.w,
-            n=self.stats.n,
-            rewards=self.transitions.rewards,
-            parents=self.tree.parents,
-            terminal=self.transitions.terminal)
-        cuda.backup(bk, leaves.short())
+            v=self.decisions.v[part],
+            w=self.stats.w[part],
+            n=self.stats.n[part],
+            rewards=self.transitions.rewards[part],
+            parents=self.tree.parents[part],
+            terminal=self.transitions.terminal[part])
+        with self._timed('backup'):
+            cuda.backup(bk, leaves.to(self.itype))
+
+    def active(self):
+        return (self.sim < self.budget) & ~self.stopped
 
     @profiling.nvtx
-    def simulate(self, network):
-        if self.sim >= self.n_nodes:
-            raise ValueError('Called simulate more times than were declared in the constructor')
+    def check_stopping(self, part=slice(None)):
+        """Marks envs in `part` whose search has settled as stopped. See `stop_kl` in the constructor."""
+        with self._timed('root'):
+            probs = cuda.root(self._cuda(part)).float()
+        if self._last_root is None:
+            self._last_root = torch.full((self.n_envs, self.n_actions), np.nan, device=self.device)
+        # The first check in each env compares against NaNs, and so never stops anything
+        last = self._last_root[part]
+        kl = (probs*(probs.clamp(1e-6, None).log() - last.clamp(1e-6, None).log())).sum(-1)
+        sim, budget, n = self.sim[part], self.budget[part], self.stats.n[part]
+        self.stopped[part] |= (kl < self.stop_kl) & (4*sim >= budget)
+        self._last_root[part] = probs
+
+        # If the root keeps gaining visits at the rate it has so far, can the runner-up catch the leader?
+        children = self.tree.children[part, 0].long()
+        visits = n.gather(1, children.clamp(0, None)).where(children >= 0, torch.zeros_like(n[:, :1]))
+        visits = visits.float()
+        top = visits.topk(min(2, visits.size(-1)), -1).values
+        lead = top[:, 0] - (top[:, 1] if top.size(-1) > 1 else 0.)
+        rate = n[:, 0].float()/(sim - 1).clamp(1, None)
+        self.stopped[part] |= (lead > (budget - sim)*rate)
 
-        parents, actions = self.descend()
+    @profiling.nvtx
+    def expand(self, part=slice(None)):
+        """The tree half of a simulation: descends the trees of the envs in `part` and steps into the new leaves. 
+        Returns the leaves that are waiting on the network, or None if there are no active envs in `part`."""
+        active = self.active()[part]
+        if not active.any():
+            return None
+
+        # Each descent uses up one node of its env's budget, whether it finds a new leaf or not. Envs that have already 
+        # used their whole budget - which happens when a tree's been carried over - sit out.
+        parents, actions = self.descend(part)
+        live = active[:, None] & (parents >= 0)
+        slots = self.sim[part, None] + live.long().cumsum(-1) - 1
+        live = live & (slots < self.budget[part, None])
+
+        # The common case of a single leaf for every env doesn't need any compaction
+        everyone = (self.n_descents == 1) and bool(live.all())
+        if everyone:
+            idxs, parents, actions, slots = torch.arange(len(live), device=self.device), parents[:, 0], actions[:, 0], slots[:, 0]
+        else:
+            idxs, ks = live.nonzero(as_tuple=True)
+            parents, actions, slots = parents[idxs, ks], actions[idxs, ks], slots[idxs, ks]
+        envs = self.envs[part][idxs]
 
         # If the transition is terminal - and so we stopped our descent early
         # we don't want to end up creating a new node. 
-        leaves = self.tree.children[self.envs, parents, actions].long()
-        leaves[leaves == -1] = self.sim
+        leaves = self.tree.children[envs, parents, actions].long()
+        leaves = torch.where(leaves == -1, slots, leaves)
+
+        self.tree.children[envs, parents, actions] = leaves.to(self.itype)
+        self.tree.parents[envs, leaves] = parents.to(self.itype)
+        self.tree.relation[envs, leaves] = actions.to(self.itype)
+
+        if everyone:
+            all_leaves = leaves[:, None]
+        else:
+            all_leaves = torch.full((len(live), self.n_descents), -1, dtype=torch.long, device=self.device)
+            all_leaves[idxs, ks] = leaves
+
+        whole = everyone and (len(envs) == self.n_envs)
+        with self._timed('step'):
+            if whole and not self.compact and (getattr(self.worlds, 'step_at', None) is not None):
+                # Step straight from parent to leaf inside the store
+                transition = self.worlds.step_at(parents, leaves, actions)
+                world = self.worlds[envs, leaves]
+            else:
+                old_world = self.world_at(envs, parents)
+                world, transition = old_world.step(actions)
+                self.worlds[envs, leaves] = world
+
+        self.transitions.rewards[envs, leaves] = transition.rewards.to(self.ftype)
+        self.transitions.terminal[envs, leaves] = transition.terminal
+
+        if self.share_evals:
+            # Copy across the evaluations of any positions we've seen before, and only evaluate the rest
+            found, (source_envs, source_nodes) = self._transposed(envs, world, transition.terminal, part)
+            source_envs, source_nodes = source_envs[found], source_nodes[found]
+            self._store_logits(envs[found], leaves[found], self.decisions.logits[source_envs, source_nodes])
+            self.decisions.v[envs[found], leaves[found]] = self.decisions.v[source_envs, source_nodes]
+            unseen = (~found).nonzero().squeeze(-1)
+            envs, leaves, world = envs[unseen], leaves[unseen], world[unseen]
+
+        return dotdict.dotdict(part=part, envs=envs, leaves=leaves, world=world, all_leaves=all_leaves, live=live)
 
-        self.tree.children[self.envs, parents, actions] = leaves.short()
-        self.tree.parents[self.envs, leaves] = parents.short()
-        self.tree.relation[self.envs, leaves] = actions.short()
-
-        old_world = self.worlds[self.envs, parents]
-        world, transition = old_world.step(actions)
-
-        self.worlds[self.envs, leaves] = world
-        self.transitions.rewards[self.envs, leaves] = transition.rewards.half()
-        self.transitions.terminal[self.envs, leaves] = transition.terminal
+    @profiling.nvtx
+    def evaluate(self, pending, network):
+        """The network half of a simulation. Doesn't touch the tree, so it can run alongside another part's `expand`."""
+        if (pending is None) or (len(pending.envs) == 0):
+            return None
 
+        world = pending.world
         autocast = (world.device.type == 'cuda')
-        with torch.no_grad(), torch.cuda.amp.autocast(autocast):
+        with torch.no_grad(), torch.cuda.amp.autocast(autocast), self._timed('forward'):
             decisions = network(world)
             assert (decisions.logits > -np.inf).any(-1).all(), 'Some row of logits are all neginf or nan'
-        self.decisions.logits[self.envs, leaves] = decisions.logits.half()
-        self.decisions.v[self.envs, leaves] = decisions.v.half()
+        return decisions
 
-        self.backup(leaves)
+    @profiling.nvtx
+    def finish(self, pending, decisions):
+        """Stores the network's evaluations of the pending leaves and backs them up."""
+        if pending is None:
+            return
 
-        self.sim += 1
+        if decisions is not None:
+            self._store_logits(pending.envs, pending.leaves, decisions.logits)
+            self.decisions.v[pending.envs, pending.leaves] = decisions.v.to(self.ftype)
+
+        for k in range(pending.all_leaves.shape[1]):
+            self.backup(pending.all_leaves[:, k], pending.part)
+
+        self.sim[pending.part] += pending.live.sum(-1)
+
+    @profiling.nvtx
+    def simulate(self, network):
+        if not self.active().any():
+            raise ValueError('Called simulate more times than were declared in the constructor')
+
+        pending = self.expand()
+        self.finish(pending, self.evaluate(pending, network))
+
+    def world_at(self, envs, nodes):
+        """The worlds at the given nodes. In compact mode, these are rebuilt by walking up from each node to the root
+        to collect the moves, then replaying them from the root down."""
+        if not self.compact:
+            return self.worlds[envs, nodes]
+
+        path = []
+        current = nodes
+        while True:
+            below = current > 0
+            if not below.any():
+                break
+            path.append(torch.where(below, self.tree.relation[envs, current].long(), torch.full_like(current, -1)))
+            current = torch.where(below, self.tree.parents[envs, current].long(), current)
+
+        # Nodes nearer the root have shorter paths, and so sit out the first few steps 
+        world = self.root_world[envs]
+        for actions in reversed(path):
+            moving = (actions >= 0).nonzero().squeeze(-1)
+            stepped, _ = world[moving].step(actions[moving])
+            world[moving] = stepped
+        return world
+
+    def _transposed(self, envs, world, terminal, part=slice(None)):
+        """For each leaf in `world`, looks for an earlier node holding the same position among the envs in `part`. 
+        Returns a mask of the leaves that found one, along with the (env, node) of the earlier node.
+        
+        Roots are left out since their logits have noise mixed in, and terminal nodes are left out since their worlds
+        have already been reset."""
+        keys = self.worlds.hash[part, :, 0]
+        leaf_keys = world.hash[..., 0].contiguous()
+        if self.share_evals == 'env':
+            keys = keys + SALT*self.envs[part, None]
+            leaf_keys = leaf_keys + SALT*envs
+
+        nodes = torch.arange(self.n_nodes, device=self.device)
+        candidates = (nodes > 0) & ~torch.isnan(self.decisions.v[part, :, 0]) & ~self.transitions.terminal[part]
+        candidate_envs, candidate_nodes = candidates.nonzero(as_tuple=True)
+        if len(candidate_envs) == 0:
+            return torch.zeros_like(terminal), (torch.zeros_like(envs), torch.zeros_like(envs))
+        keys = keys[candidate_envs, candidate_nodes]
+        candidate_envs = self.envs[part][candidate_envs]
+
+        candidate_keys, order = keys.sort()
+        idxs = torch.searchsorted(candidate_keys, leaf_keys).clamp(None, len(candidate_keys)-1)
+        found = (candidate_keys[idxs] == leaf_keys) & ~terminal
+        sources = order[idxs]
+        return found, (candidate_envs[sources], candidate_nodes[sources])
 
     @profiling.nvtx
     def root(self):
-        r = cuda.root(self._cuda())
+        with self._timed('root'):
+            r = cuda.root(self._cuda())
         return arrdict.arrdict(
             # This dumb thing is because log isn't implemented for half on CPU
-            logits=r.log() if (r.device.type == 'cuda') else r.float().log().half(),
+            logits=r.log() if (r.device.type == 'cuda') else r.float().log().to(r.dtype),
             prior=self.decisions.logits[:, 0], # useful for monitoring KL div
             v=self.decisions.v[:, 0])
     
@@ -155,7 +554,7 @@ class MCTS:
         import networkx as nx
         import matplotlib.pyplot as plt
 
-        root_seat = self.worlds[:, 0].seats[e]
+        root_seat = self.worlds.seats[e, 0]
 
         ws = self.stats.w[e, ..., root_seat]
         ns = self.stats.n[e]
@@ -163,7 +562,7 @@ class MCTS:
         q_min, q_max = np.nanmin(qs), np.nanmax(qs)
 
         nodes, edges = {}, {}
-        for i in range(self.sim):
+        for i in range(int(self.sim[e])):
             p = int(self.tree.parents[e, i].cpu())
             if (i == 0) or (p >= 0):
                 t = self.transitions.terminal[e, i].cpu().numpy()
@@ -197,43 +596,110 @@ class MCTS:
 
         return plt.gca()
 
-def mcts(worlds, network, **kwargs):
-    mcts = MCTS(worlds, **kwargs)
-
-    mcts.initialize(network)
-    for _ in range(mcts.n_nodes-1):
+def _pipelined(mcts, network, n_rounds):
+    """Runs `n_rounds` simulations on each half of the envs. While one half's leaves are being evaluated and backed up 
+    on this thread, the other half's next leaves are being found on a worker thread. The kernels release the GIL, so 
+    the two genuinely overlap."""
+    split = mcts.n_envs//2
+    halves = [slice(0, split), slice(split, mcts.n_envs)]
+    with ThreadPoolExecutor(1) as pool:
+        pending = mcts.expand(halves[0])
+        for r in range(2*n_rounds):
+            upcoming = pool.submit(mcts.expand, halves[(r + 1) % 2]) if (r + 1 < 2*n_rounds) else None
+            mcts.finish(pending, mcts.evaluate(pending, network))
+            if mcts.stop_kl is not None:
+                mcts.check_stopping(halves[r % 2])
+            pending = upcoming.result() if (upcoming is not None) else None
+
+def mcts(worlds, network, tree=None, workspace=None, budget=None, **kwargs):
+    """Searches from `worlds`. If a `tree` from a previous search is passed, it's re-rooted at `worlds` and topped up
+    to its node budget, rather than a fresh tree being built. A fresh tree takes its buffers from `workspace` if 
+    one's given. 
+    
+    `budget` can be a per-env number of nodes to search to. It's capped at the tree's `n_nodes`."""
+    if tree is not None:
+        tree._timings.clear()
+    if (tree is not None) and tree.reroot(worlds, network):
+        mcts = tree
+        mcts.carried[:] = mcts.sim
+    else:
+        mcts = MCTS(worlds, workspace=workspace, **kwargs)
+        mcts.initialize(network)
+
+    mcts.budget[:] = mcts.n_nodes if budget is None else budget.clamp(None, mcts.n_nodes)
+    n_sims = int((mcts.budget - mcts.sim).max())
+    n_rounds = (n_sims + mcts.n_descents - 1)//mcts.n_descents
+    if mcts.pipeline and (mcts.n_envs > 1):
+        _pipelined(mcts, network, n_rounds)
+        return mcts
+
+    for _ in range(n_rounds):
+        if mcts.stop_kl is not None:
+            mcts.check_stopping()
+            if not mcts.active().any():
+                break
         mcts.simulate(network)
 
     return mcts
 
 class MCTSAgent:
 
-    def __init__(self, network, **kwargs):
+    def __init__(self, network, reuse=False, playout_cap=None, **kwargs):
+        """With `reuse`, the tree from each call is kept, and the next call searches on from whichever part of it 
+        matches the worlds it's given. That saves re-evaluating the subtree under the moves that were played. The 
+        carried-over nodes keep the evaluations they were given when they were added though, so once the network's 
+        weights have changed, call :meth:`forget` to start the next search from scratch.
+        
+        With `playout_cap=(frac, n_cheap)`, only a random `frac` of the envs get a full search on each call, while 
+        the rest stop at `n_cheap` nodes. The `full` field of the output says which envs got the full search, and 
+        only those are worth using as policy targets. Calls with `eval` always get the full search."""
         self.network = network
+        self.reuse = reuse
+        self.playout_cap = playout_cap
         self.kwargs = kwargs
+        self._tree = None
+        self._workspace = Workspace()
 
     @profiling.nvtx
     def __call__(self, world, value=True, eval=False, **kwargs):
-        m = mcts(world, self.network, **{**self.kwargs, **kwargs})
+        kwargs = {**self.kwargs, **kwargs}
+        tree = self._tree if (self._tree is not None) and (self._tree_kwargs == kwargs) else None
+        budget, full = None, torch.ones((world.n_envs,), dtype=torch.bool, device=world.device)
+        if (self.playout_cap is not None) and not eval:
+            frac, n_cheap = self.playout_cap
+            full = torch.rand((world.n_envs,), device=world.device) < frac
+            budget = torch.full((world.n_envs,), n_cheap, device=world.device).masked_fill(full, torch.iinfo(torch.long).max)
+        m = mcts(world, self.network, tree=tree, workspace=self._workspace, budget=budget, **kwargs)
+        if self.reuse:
+            self._tree, self._tree_kwargs = m, kwargs
         r = m.root()
 
+        for phase, duration in m.timings.items():
+            stats.duty(f'mcts-duty.{phase}', duration)
+
         # Need to go back to float here because `sample` doesn't like halves
         actions = r.logits.argmax(-1) if eval else torch.distributions.Categorical(logits=r.logits.float()).sample()
 
         return arrdict.arrdict(
             logits=r.logits,
             prior=r.prior,
-            n_sims=torch.full_like(m.envs, m.sim+1),
+            n_sims=m.sim - m.carried + 1,
             n_leaves=m.n_leaves(),
+            full=full,
             v=r.v,
             actions=actions).clone()
 
+    def forget(self):
+        """Drops the tree kept from the last call, if there is one"""
+        self._tree = None
+
     def load_state_dict(self, sd):
         #TODO: Systematize this
         network = {k[8:]: v for k, v in sd.items() if k.startswith('network.')}
         kwargs = {k[7:]: v for k, v in sd.items() if k.startswith('kwargs.')}
         self.network.load_state_dict(network)
         self.kwargs.update(kwargs)
+        self.forget()
 
     def state_dict(self):
         network = {f'network.{k}': v for k, v in self.network.state_dict().items()}
@@ -253,5 +719,6 @@ class DummyAgent:
             prior=r.logits,
             n_sims=torch.full((world.n_envs,), 0, device=world.device),
             n_leaves=torch.full((world.n_envs,), 1, device=world.device),
+            full=torch.ones((world.n_envs,), dtype=torch.bool, device=world.device),
             v=r.v,
             actions=actions).clone()
@@ -1,115 +1,159 @@
 #pragma once
 #include "../../cpp/common.h"
 
-//TODO: Can I template-ize these classes?
+// The types a tree is stored in. `Compact` is half-precision statistics and
+// 16-bit node indices, which caps a tree at 32k nodes and starts losing
+// precision in `w` over long searches. `Wide` is single-precision statistics
+// and 32-bit indices, for when that isn't enough.
+struct Compact {
+  using F = at::Half;
+  using I = int16_t;
+};
+
+struct Wide {
+  using F = float;
+  using I = int32_t;
+};
+
+template <typename P>
 struct MCTSPTA {
-  H3D::PTA logits;
-  H3D::PTA w; 
-  S2D::PTA n; 
-  H1D::PTA c_puct;
-  S2D::PTA seats; 
-  B2D::PTA terminal; 
-  S3D::PTA children;
+  typename TensorProxy<typename P::F, 3>::PTA logits;
+  typename TensorProxy<typename P::F, 3>::PTA w;
+  typename TensorProxy<typename P::I, 2>::PTA n;
+  typename TensorProxy<typename P::F, 1>::PTA c_puct;
+  S2D::PTA seats;
+  B2D::PTA terminal;
+  typename TensorProxy<typename P::I, 3>::PTA children;
+  F2D::PTA alpha;
+  F3D::PTA prior;
+  F3D::PTA solved;
 };
 
+template <typename P>
 struct MCTSTA {
-  H3D::TA logits;
-  H3D::TA w; 
-  S2D::TA n; 
-  H1D::TA c_puct;
-  S2D::TA seats; 
-  B2D::TA terminal; 
-  S3D::TA children;
+  typename TensorProxy<typename P::F, 3>::TA logits;
+  typename TensorProxy<typename P::F, 3>::TA w;
+  typename TensorProxy<typename P::I, 2>::TA n;
+  typename TensorProxy<typename P::F, 1>::TA c_puct;
+  S2D::TA seats;
+  B2D::TA terminal;
+  typename TensorProxy<typename P::I, 3>::TA children;
+  F2D::TA alpha;
+  F3D::TA prior;
+  F3D::TA solved;
 };
 
+template <typename P>
 struct MCTS {
-  H3D logits;
-  H3D w; 
-  S2D n; 
-  H1D c_puct;
-  S2D seats; 
-  B2D terminal; 
-  S3D children;
-
-  MCTSPTA pta() {
-    return MCTSPTA{
-      logits.pta(), 
+  TensorProxy<typename P::F, 3> logits;
+  TensorProxy<typename P::F, 3> w;
+  TensorProxy<typename P::I, 2> n;
+  TensorProxy<typename P::F, 1> c_puct;
+  S2D seats;
+  B2D terminal;
+  TensorProxy<typename P::I, 3> children;
+  // The last solution for each node's Newton search, used to warm-start the next one.
+  F2D alpha;
+  // The exponentiated logits, computed once when a node's expanded rather than 
+  // every time its policy's needed.
+  F3D prior;
+  // The node's visit count and the q normalization's (min, max) as of the last 
+  // time its alpha was solved for. If they're all the same next time, so are
+  // its children's stats, and the solve can be skipped. A count of -1 means 
+  // the alpha's out of date.
+  F3D solved;
+
+  MCTSPTA<P> pta() {
+    return MCTSPTA<P>{
+      logits.pta(),
       w.pta(),
       n.pta(),
       c_puct.pta(),
       seats.pta(),
       terminal.pta(),
-      children.pta()};
+      children.pta(),
+      alpha.pta(),
+      prior.pta(),
+      solved.pta()};
   }
 
-  MCTSTA ta() {
-    return MCTSTA{
-      logits.ta(), 
+  MCTSTA<P> ta() {
+    return MCTSTA<P>{
+      logits.ta(),
       w.ta(),
       n.ta(),
       c_puct.ta(),
       seats.ta(),
       terminal.ta(),
-      children.ta()};
+      children.ta(),
+      alpha.ta(),
+      prior.ta(),
+      solved.ta()};
   }
 };
 
+template <typename P>
 struct DescentPTA {
-  S1D::PTA parents;
-  S1D::PTA actions; 
+  typename TensorProxy<typename P::I, 1>::PTA parents;
+  typename TensorProxy<typename P::I, 1>::PTA actions;
 };
 
+template <typename P>
 struct DescentTA {
-  S1D::TA parents;
-  S1D::TA actions; 
+  typename TensorProxy<typename P::I, 1>::TA parents;
+  typename TensorProxy<typename P::I, 1>::TA actions;
 };
 
+template <typename P>
 struct Descent {
-  S1D parents;
-  S1D actions;
+  TensorProxy<typename P::I, 1> parents;
+  TensorProxy<typename P::I, 1> actions;
 
-  DescentPTA pta() {
-    return DescentPTA{
+  DescentPTA<P> pta() {
+    return DescentPTA<P>{
       parents.pta(),
       actions.pta()};
   }
 
-  DescentTA ta() {
-    return DescentTA{
+  DescentTA<P> ta() {
+    return DescentTA<P>{
       parents.ta(),
       actions.ta()};
   }
 
 };
 
+template <typename P>
 struct BackupPTA {
-  H3D::PTA v;
-  H3D::PTA w;
-  S2D::PTA n;
-  H3D::PTA rewards;
-  S2D::PTA parents;
+  typename TensorProxy<typename P::F, 3>::PTA v;
+  typename TensorProxy<typename P::F, 3>::PTA w;
+  typename TensorProxy<typename P::I, 2>::PTA n;
+  typename TensorProxy<typename P::F, 3>::PTA rewards;
+  typename TensorProxy<typename P::I, 2>::PTA parents;
   B2D::PTA terminal;
 };
 
+template <typename P>
 struct BackupTA {
-  H3D::TA v;
-  H3D::TA w;
-  S2D::TA n;
-  H3D::TA rewards;
-  S2D::TA parents;
+  typename TensorProxy<typename P::F, 3>::TA v;
+  typename TensorProxy<typename P::F, 3>::TA w;
+  typename TensorProxy<typename P::I, 2>::TA n;
+  typename TensorProxy<typename P::F, 3>::TA rewards;
+  typename TensorProxy<typename P::I, 2>::TA parents;
   B2D::TA terminal;
 };
 
+template <typename P>
 struct Backup {
-  H3D v;
-  H3D w;
-  S2D n;
-  H3D rewards;
-  S2D parents;
+  TensorProxy<typename P::F, 3> v;
+  TensorProxy<typename P::F, 3> w;
+  TensorProxy<typename P::I, 2> n;
+  TensorProxy<typename P::F, 3> rewards;
+  TensorProxy<typename P::I, 2> parents;
   B2D terminal;
 
-  BackupPTA pta() {
-    return BackupPTA{
+  BackupPTA<P> pta() {
+    return BackupPTA<P>{
       v.pta(),
       w.pta(),
       n.pta(),
@@ -118,8 +162,8 @@ struct Backup {
       terminal.pta()};
   }
 
-  BackupTA ta() {
-    return BackupTA{
+  BackupTA<P> ta() {
+    return BackupTA<P>{
       v.ta(),
       w.ta(),
       n.ta(),
@@ -131,8 +175,9 @@ struct Backup {
 
 namespace mctscuda {
 
-Descent descend(MCTS m);
-TT root(MCTS m);
-void backup(Backup bk, TT leaves);
+template <typename P> Descent<P> descend(MCTS<P> m);
+template <typename P> std::tuple<TT, TT> descend_many(MCTS<P> m, int K);
+template <typename P> TT root(MCTS<P> m);
+template <typename P> void backup(Backup<P> bk, TT leaves);
 
-}
\ No newline at end of file
+}
@@ -1,9 +1,16 @@
 #include "common.h"
 #include <math.h>
+#include <ATen/Parallel.h>
+#include <vector>
 
 namespace mctscpu {
 const uint BLOCK = 8;
 
+// Envs per task when splitting a batch across ATen's intra-op threads. A descent
+// is a lot more work than a backup, so it gets chopped up more finely.
+const int64_t DESCEND_GRAIN = 1;
+const int64_t BACKUP_GRAIN = 16;
+
 struct Policy {
     int A;
     float* pi;
@@ -14,15 +21,13 @@ struct Policy {
     Policy(int A):
         A(A)
     {
-        pi = (float*)malloc(A*sizeof(float));
-        q  = (float*)malloc(A*sizeof(float));
-    }
-
-    ~Policy() {
-        // This is bad practice - if the obj is ever passed by value accidentally, you'll get a double free.
-        // But frankly I've no idea what I'm doing here anyway. Any rewrite is going to involve gas and a lighter.
-        free(pi);
-        free(q);
+        // The arrays live in per-thread scratch, so there's no allocation per node. 
+        // That means only one policy per thread can be live at a time, which is 
+        // fine since the kernels only ever look at one node at a time.
+        thread_local std::vector<float> scratch;
+        if (scratch.size() < 2*A) { scratch.resize(2*A); }
+        pi = scratch.data();
+        q  = scratch.data() + A;
     }
 
     float prob(int a) {
@@ -37,13 +42,18 @@ struct Policy {
 
 };
 
-float newton_search(Policy& p) {
-    // Find the initial alpha
-    float alpha = 0.f;
+// Solves for the alpha that normalizes the policy. Every alpha below the solution is 
+// above `lower`, and from there Newton's steps rise monotonically to the solution.
+// A warm start from `init` can overshoot, but then the first step lands back 
+// between `lower` and the solution.
+float newton_search(Policy& p, float init) {
+    // Find the lower bound
+    float lower = 0.f;
     for (int a = 0; a<p.A; a++) {
         float gap = fmaxf(p.lambda_n*p.pi[a], 1.e-4f);
-        alpha = fmaxf(alpha, p.q[a] + gap);
+        lower = fmaxf(lower, p.q[a] + gap);
     }
+    float alpha = fmaxf(init, lower);
 
     float error = INFINITY;
     float new_error = INFINITY;
@@ -61,10 +71,10 @@ float newton_search(Policy& p) {
         }
         new_error = S - 1.f;
         // printf("%d: alpha: %.2f, S: %.2f, e: %.2f, g: %.2f\n", b, alpha, S, new_error, g);
-        if ((new_error < 1e-3f) || (error == new_error)) {
+        if ((fabsf(new_error) < 1e-3f) || (error == new_error)) {
             break;
         } else {
-            alpha -= new_error/g;
+            alpha = fmaxf(alpha - new_error/g, lower);
             error = new_error;
         }
     }
@@ -72,70 +82,106 @@ float newton_search(Policy& p) {
     return alpha;
 }
 
-Policy policy(MCTSTA m, H3D::TA q, int t, int b) {
+// `virtual_visits`, if given, counts the descents that have passed through each 
+// of this env's nodes without being backed up yet. Each is treated as a loss, 
+// which is a q of zero after `transition_q`'s normalization.
+template <typename P>
+Policy policy(MCTSTA<P> m, typename TensorProxy<typename P::F, 3>::TA q, F1D::TA bounds, int t, int b, const typename P::I* virtual_visits=nullptr) {
 
     const uint A = m.logits.size(2);
 
     Policy p(A);
 
     int N = 0;
+    bool virtual_loss = false;
     auto seat = m.seats[b][t];
 
     for (int a=0; a<p.A; a++) {
         auto child = m.children[b][t][a];
+        p.pi[a] = m.prior[b][t][a];
 
         if (child > -1) {
-            p.q[a] = q[b][child][seat];
-            p.pi[a] = expf(m.logits[b][t][a]);
-            N += m.n[b][child];
+            float n = m.n[b][child];
+            float v = virtual_visits? virtual_visits[child] : 0.f;
+            p.q[a] = (v > 0)? float(q[b][child][seat])*n/(n + v) : float(q[b][child][seat]);
+            N += n + v;
+            virtual_loss |= (v > 0);
         } else {
             p.q[a] = 0.f;
-            p.pi[a] = expf(m.logits[b][t][a]);
             N += 1;
         }
     }
 
     p.lambda_n = m.c_puct[b]*float(N)/float(N +A);
-    p.alpha = newton_search(p);
+
+    // Any backup through a child passes through this node too, so if this node's
+    // count and the q normalization haven't changed, neither has the solution. 
+    // Virtual visits aren't part of the record, so those always get solved.
+    float count = m.n[b][t];
+    auto record = m.solved[b][t];
+    if (!virtual_loss && (record[0] == count) && (record[1] == bounds[0]) && (record[2] == bounds[1])) {
+        p.alpha = m.alpha[b][t];
+    } else {
+        p.alpha = newton_search(p, m.alpha[b][t]);
+        m.alpha[b][t] = p.alpha;
+        record[0] = virtual_loss? -1.f : count;
+        record[1] = bounds[0];
+        record[2] = bounds[1];
+    }
 
     return p;
 }
 
-TT transition_q(MCTS m) {
+template <typename P>
+std::tuple<TT, TT> transition_q(MCTS<P> m) {
     auto q = m.w.t/(m.n.t.unsqueeze(-1) + 1.e-4f);
-    q = (q - q.min())/(q.max() - q.min() + 1.e-4f);
-    return q.to(at::kHalf);
+    auto lower = q.min();
+    auto upper = q.max();
+    q = (q - lower)/(upper - lower + 1.e-4f);
+    // The bounds go along with the q so the policies can tell if the normalization's changed
+    auto bounds = at::stack({lower, upper}).to(at::kFloat);
+    return std::make_tuple(q.to(m.w.t.scalar_type()), bounds);
 }
 
-void root_kernel(MCTSTA m, H3D::TA q, H2D::TA probs, int b) {
+template <typename P>
+void root_kernel(MCTSTA<P> m, typename TensorProxy<typename P::F, 3>::TA q, F1D::TA bounds, typename TensorProxy<typename P::F, 2>::TA probs, int b) {
     const uint B = m.logits.size(0);
     const uint A = m.logits.size(2);
     if (b >= B) return;
 
-    auto p = policy(m, q, 0, b);
+    auto p = policy(m, q, bounds, 0, b);
 
     for (int a=0; a<A; a++) {
         probs[b][a] = p.prob(a);
     }
 }
 
-TT root(MCTS m) {
+template <typename P>
+TT root(MCTS<P> m) {
     const uint B = m.logits.size(0);
     const uint A = m.logits.size(2);
 
-    auto q = transition_q(m);
+    TT q, bounds;
+    std::tie(q, bounds) = transition_q(m);
 
     auto probs = at::empty_like(m.logits.t.select(1, 0));
 
-    for (int b=0; b<B; b++) {
-        root_kernel(m.ta(), H3D(q).ta(), H2D(probs).ta(), b);
-    } 
+    auto m_ta = m.ta();
+    auto q_ta = TensorProxy<typename P::F, 3>(q).ta();
+    auto bounds_ta = F1D(bounds).ta();
+    auto probs_ta = TensorProxy<typename P::F, 2>(probs).ta();
+    at::parallel_for(0, B, DESCEND_GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            root_kernel(m_ta, q_ta, bounds_ta, probs_ta, b);
+        }
+    });
 
     return probs;
 }
 
+template <typename P>
 void descend_kernel(
-    MCTSTA m, H3D::TA q, H2D::TA rands, DescentTA descent, int b) {
+    MCTSTA<P> m, typename TensorProxy<typename P::F, 3>::TA q, F1D::TA bounds, typename TensorProxy<typename P::F, 2>::TA rands, DescentTA<P> descent, int b) {
 
     const uint B = m.logits.size(0);
     const uint A = m.logits.size(2);
@@ -150,9 +196,9 @@ void descend_kernel(
         if (t == -1) break;
         if (m.terminal[b][t]) break;
 
-        auto p = policy(m, q, t, b);
+        auto p = policy(m, q, bounds, t, b);
 
-        float rand = rands[b][t];
+        float rand = float(rands[b][t]);
         float total = 0.f;
         // This is a bit of a mess. Intent is to handle the edge 
         // case of rand being 1, and the probabilities not summing
@@ -179,31 +225,145 @@ void descend_kernel(
     descent.actions[b] = action;
 }
 
-Descent descend(MCTS m) {
+// Like `descend_kernel`, but makes `K` descents in a row. Nodes on each path
+// pick up a virtual visit, so later descents are pushed away from earlier ones,
+// and an unexpanded edge that's already been picked can't be picked again. A 
+// descent that finds nothing left to pick gets a parent of -1.
+template <typename P>
+void descend_many_kernel(
+    MCTSTA<P> m, typename TensorProxy<typename P::F, 3>::TA q, F1D::TA bounds, typename TensorProxy<typename P::F, 3>::TA rands, 
+    typename TensorProxy<typename P::I, 2>::TA virtual_visits, typename TensorProxy<typename P::I, 2>::TA parents, 
+    typename TensorProxy<typename P::I, 2>::TA actions, int b) {
+
     const uint B = m.logits.size(0);
     const uint A = m.logits.size(2);
+    const uint K = parents.size(1);
 
-    auto q = transition_q(m);
-    auto rands = at::rand_like(m.logits.t.select(2, 0));
+    if (b >= B) return;
+
+    typename P::I* visits = virtual_visits[b].data();
+    for (int k=0; k<K; k++) {
+        int t = 0;
+        int parent = 0;
+        int action = -1;
+        while (true) {
+            if (t == -1) break;
+            if (m.terminal[b][t]) break;
+
+            auto p = policy(m, q, bounds, t, b, visits);
+
+            // Unexpanded edges that an earlier descent has claimed are out, so the 
+            // rest of the distribution gets scaled up to fill the gap.
+            float mass = 0.f;
+            for (int a=0; a<A; a++) {
+                p.pi[a] = p.prob(a);
+                if (m.children[b][t][a] == -1) {
+                    for (int j=0; j<k; j++) {
+                        if ((parents[b][j] == t) && (actions[b][j] == a)) { p.pi[a] = 0.f; }
+                    }
+                }
+                mass += p.pi[a];
+            }
 
-    Descent descent{
-        m.seats.t.new_empty({B}),
-        m.seats.t.new_empty({B})};
+            float rand = float(rands[b][k][t])*mass;
+            float total = 0.f;
+            action = -1; 
+            int valid = -1;
+            for (int a=0; a<A; a++) {
+                float prob = p.pi[a];
+                total += prob;
+                if ((prob > 0) && (total >= rand)) {
+                    action = a;
+                    break;
+                } else if (prob > 0) {
+                    valid = a;
+                }
+            }
+            action = (action >= 0)? action : valid;
+            if (action < 0) {
+                parent = -1;
+                break;
+            }
+            parent = t;
+            t = m.children[b][t][action];
+            if (t >= 0) { visits[t] += 1; }
+        }
 
-    for (int b=0; b<B; b++) {
-        descend_kernel(m.ta(), H3D(q).ta(), H2D(rands).ta(), descent.ta(), b);
+        parents[b][k] = parent;
+        actions[b][k] = action;
     }
+}
+
+template <typename P>
+std::tuple<TT, TT> descend_many(MCTS<P> m, int K) {
+    using F3D = TensorProxy<typename P::F, 3>;
+    using I2D = TensorProxy<typename P::I, 2>;
+
+    const uint B = m.logits.size(0);
+    const uint T = m.logits.size(1);
+
+    TT q, bounds;
+    std::tie(q, bounds) = transition_q(m);
+    auto rands = at::rand({B, K, T}, m.logits.t.options());
+    auto virtual_visits = at::zeros({B, T}, m.n.t.options());
+
+    auto parents = m.n.t.new_empty({B, K});
+    auto actions = m.n.t.new_empty({B, K});
+
+    auto m_ta = m.ta();
+    auto q_ta = F3D(q).ta();
+    auto bounds_ta = F1D(bounds).ta();
+    auto rands_ta = F3D(rands).ta();
+    auto visits_ta = I2D(virtual_visits).ta();
+    auto parents_ta = I2D(parents).ta();
+    auto actions_ta = I2D(actions).ta();
+    at::parallel_for(0, B, DESCEND_GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            descend_many_kernel(m_ta, q_ta, bounds_ta, rands_ta, visits_ta, parents_ta, actions_ta, b);
+        }
+    });
+
+    return std::make_tuple(parents, actions);
+}
+
+template <typename P>
+Descent<P> descend(MCTS<P> m) {
+    const uint B = m.logits.size(0);
+    const uint A = m.logits.size(2);
+
+    TT q, bounds;
+    std::tie(q, bounds) = transition_q(m);
+    auto rands = at::rand_like(m.logits.t.select(2, 0));
+
+    Descent<P> descent{
+        m.n.t.new_empty({B}),
+        m.n.t.new_empty({B})};
+
+    auto m_ta = m.ta();
+    auto q_ta = TensorProxy<typename P::F, 3>(q).ta();
+    auto bounds_ta = F1D(bounds).ta();
+    auto rands_ta = TensorProxy<typename P::F, 2>(rands).ta();
+    auto descent_ta = descent.ta();
+    at::parallel_for(0, B, DESCEND_GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            descend_kernel(m_ta, q_ta, bounds_ta, rands_ta, descent_ta, b);
+        }
+    });
 
     return descent;
 }
 
-void backup_kernel(BackupTA bk, S1D::TA leaves, uint b) {
+template <typename P>
+void backup_kernel(BackupTA<P> bk, typename TensorProxy<typename P::I, 1>::TA leaves, uint b) {
     const uint B = bk.v.size(0);
     const uint S = bk.v.size(2);
 
     if (b >= B) return;
+    // Envs that have used up their node budget don't take part in the simulation
+    if (leaves[b] < 0) return;
 
-    float* v = (float*)malloc(S*sizeof(float));
+    thread_local std::vector<float> v;
+    if (v.size() < S) { v.resize(S); }
 
     int current = leaves[b];
     for (int s=0; s<S; s++) {
@@ -226,17 +386,20 @@ void backup_kernel(BackupTA bk, S1D::TA leaves, uint b) {
 
         current = bk.parents[b][current]; 
     }
-
-    free(v);
 }
 
-void backup(Backup bk, TT leaves) {
+template <typename P>
+void backup(Backup<P> bk, TT leaves) {
     const uint B = bk.v.size(0);
     const uint S = bk.v.size(2);
 
-    for (int b=0; b<B; b++) {
-        backup_kernel(bk.ta(), S1D(leaves).ta(), b);
-    }
+    auto bk_ta = bk.ta();
+    auto leaves_ta = TensorProxy<typename P::I, 1>(leaves).ta();
+    at::parallel_for(0, B, BACKUP_GRAIN, [&](int64_t begin, int64_t end) {
+        for (int64_t b=begin; b<end; b++) {
+            backup_kernel(bk_ta, leaves_ta, b);
+        }
+    });
 }
 
 }
\ No newline at end of file
@@ -32,13 +32,18 @@ struct Policy {
 
 };
 
-__device__ float newton_search(Policy p) {
-    // Find the initial alpha
-    float alpha = 0.f;
+// Solves for the alpha that normalizes the policy. Every alpha below the solution is 
+// above `lower`, and from there Newton's steps rise monotonically to the solution.
+// A warm start from `init` can overshoot, but then the first step lands back 
+// between `lower` and the solution.
+__device__ float newton_search(Policy p, float init) {
+    // Find the lower bound
+    float lower = 0.f;
     for (int a = 0; a<p.A; a++) {
         float gap = fmaxf(p.lambda_n*p.pi[a], 1.e-4f);
-        alpha = fmaxf(alpha, p.q[a] + gap);
+        lower = fmaxf(lower, p.q[a] + gap);
     }
+    float alpha = fmaxf(init, lower);
 
     float error = CUDART_INF_F;
     float new_error = CUDART_INF_F;
@@ -56,10 +61,10 @@ __device__ float newton_search(Policy p) {
         }
         new_error = S - 1.f;
         // printf("%d: alpha: %.2f, S: %.2f, e: %.2f, g: %.2f\n", b, alpha, S, new_error, g);
-        if ((new_error < 1e-3f) || (error == new_error)) {
+        if ((fabsf(new_error) < 1e-3f) || (error == new_error)) {
             break;
         } else {
-            alpha -= new_error/g;
+            alpha = fmaxf(alpha - new_error/g, lower);
             error = new_error;
         }
     }
@@ -67,7 +72,11 @@ __device__ float newton_search(Policy p) {
     return alpha;
 }
 
-__device__ Policy policy(MCTSPTA m, H3D::PTA q, int t) {
+// `virtual_visits`, if given, counts the descents that have passed through each 
+// of this env's nodes without being backed up yet. Each is treated as a loss, 
+// which is a q of zero after `transition_q`'s normalization.
+template <typename P>
+__device__ Policy policy(MCTSPTA<P> m, typename TensorProxy<typename P::F, 3>::PTA q, F1D::PTA bounds, int t, const typename P::I* virtual_visits=nullptr) {
 
     const uint A = m.logits.size(2);
     const int b = blockIdx.x*blockDim.x + threadIdx.x;
@@ -75,68 +84,95 @@ __device__ Policy policy(MCTSPTA m, H3D::PTA q, int t) {
     Policy p(A);
 
     int N = 0;
+    bool virtual_loss = false;
     auto seat = m.seats[b][t];
 
     for (int a=0; a<p.A; a++) {
         auto child = m.children[b][t][a];
+        p.pi[a] = m.prior[b][t][a];
 
         if (child > -1) {
-            p.q[a] = q[b][child][seat];
-            p.pi[a] = expf(m.logits[b][t][a]);
-            N += m.n[b][child];
+            float n = m.n[b][child];
+            float v = virtual_visits? virtual_visits[child] : 0.f;
+            p.q[a] = (v > 0)? float(q[b][child][seat])*n/(n + v) : float(q[b][child][seat]);
+            N += n + v;
+            virtual_loss |= (v > 0);
         } else {
             p.q[a] = 0.f;
-            p.pi[a] = expf(m.logits[b][t][a]);
             N += 1;
         }
     }
     __syncthreads(); // memory barrier
 
     p.lambda_n = m.c_puct[b]*float(N)/float(N +A);
-    p.alpha = newton_search(p);
+
+    // Any backup through a child passes through this node too, so if this node's
+    // count and the q normalization haven't changed, neither has the solution. 
+    // Virtual visits aren't part of the record, so those always get solved.
+    float count = m.n[b][t];
+    auto record = m.solved[b][t];
+    if (!virtual_loss && (record[0] == count) && (record[1] == bounds[0]) && (record[2] == bounds[1])) {
+        p.alpha = m.alpha[b][t];
+    } else {
+        p.alpha = newton_search(p, m.alpha[b][t]);
+        m.alpha[b][t] = p.alpha;
+        record[0] = virtual_loss? -1.f : count;
+        record[1] = bounds[0];
+        record[2] = bounds[1];
+    }
 
     return p;
 }
 
-__host__ TT transition_q(MCTS m) {
+template <typename P>
+__host__ std::tuple<TT, TT> transition_q(MCTS<P> m) {
     auto q = m.w.t/(m.n.t.unsqueeze(-1) + 1.e-4f);
-    q = (q - q.min())/(q.max() - q.min() + 1.e-4f);
-    return q.to(at::kHalf);
+    auto lower = q.min();
+    auto upper = q.max();
+    q = (q - lower)/(upper - lower + 1.e-4f);
+    // The bounds go along with the q so the policies can tell if the normalization's changed
+    auto bounds = at::stack({lower, upper}).to(at::kFloat);
+    return std::make_tuple(q.to(m.w.t.scalar_type()), bounds);
 }
 
-__global__ void root_kernel(MCTSPTA m, H3D::PTA q, H2D::PTA probs) {
+template <typename P>
+__global__ void root_kernel(MCTSPTA<P> m, typename TensorProxy<typename P::F, 3>::PTA q, F1D::PTA bounds, typename TensorProxy<typename P::F, 2>::PTA probs) {
     const uint B = m.logits.size(0);
     const uint A = m.logits.size(2);
     const int b = blockIdx.x*blockDim.x + threadIdx.x;
     if (b >= B) return;
 
-    auto p = policy(m, q, 0);
+    auto p = policy<P>(m, q, bounds, 0);
 
     for (int a=0; a<A; a++) {
         probs[b][a] = p.prob(a);
     }
 }
 
-__host__ TT root(MCTS m) {
+template <typename P>
+__host__ TT root(MCTS<P> m) {
     c10::cuda::CUDAGuard g(m.logits.t.device());
 
     const uint B = m.logits.size(0);
     const uint A = m.logits.size(2);
 
-    auto q = transition_q(m);
+    TT q, bounds;
+    std::tie(q, bounds) = transition_q(m);
 
     auto probs = at::empty_like(m.logits.t.select(1, 0));
 
     const uint n_blocks = (B + BLOCK - 1)/BLOCK;
     root_kernel<<<{n_blocks}, {BLOCK}, Policy::memory(A), stream()>>>(
-        m.pta(), H3D(q).pta(), H2D(probs).pta());
+        m.pta(), TensorProxy<typename P::F, 3>(q).pta(), F1D(bounds).pta(), TensorProxy<typename P::F, 2>(probs).pta());
     C10_CUDA_CHECK(cudaGetLastError());
 
     return probs;
 }
 
+template <typename P>
 __global__ void descend_kernel(
-    MCTSPTA m, H3D::PTA q, H2D::PTA rands, DescentPTA descent) {
+    MCTSPTA<P> m, typename TensorProxy<typename P::F, 3>::PTA q, F1D::PTA bounds, typename TensorProxy<typename P::F, 2>::PTA rands, 
+    DescentPTA<P> descent) {
 
     const uint B = m.logits.size(0);
     const uint A = m.logits.size(2);
@@ -152,9 +188,9 @@ __global__ void descend_kernel(
         if (t == -1) break;
         if (m.terminal[b][t]) break;
 
-        auto p = policy(m, q, t);
+        auto p = policy<P>(m, q, bounds, t);
 
-        float rand = rands[b][t];
+        float rand = float(rands[b][t]);
         float total = 0.f;
         // This is a bit of a mess. Intent is to handle the edge 
         // case of rand being 1, and the probabilities not summing
@@ -181,33 +217,135 @@ __global__ void descend_kernel(
     descent.actions[b] = action;
 }
 
-__host__ Descent descend(MCTS m) {
+// Like `descend_kernel`, but makes `K` descents in a row. Nodes on each path
+// pick up a virtual visit, so later descents are pushed away from earlier ones,
+// and an unexpanded edge that's already been picked can't be picked again. A 
+// descent that finds nothing left to pick gets a parent of -1.
+template <typename P>
+__global__ void descend_many_kernel(
+    MCTSPTA<P> m, typename TensorProxy<typename P::F, 3>::PTA q, F1D::PTA bounds, typename TensorProxy<typename P::F, 3>::PTA rands, 
+    typename TensorProxy<typename P::I, 2>::PTA virtual_visits, typename TensorProxy<typename P::I, 2>::PTA parents, 
+    typename TensorProxy<typename P::I, 2>::PTA actions) {
+
+    const uint B = m.logits.size(0);
+    const uint A = m.logits.size(2);
+    const uint K = parents.size(1);
+    const int b = blockIdx.x*blockDim.x + threadIdx.x;
+
+    if (b >= B) return;
+
+    typename P::I* visits = &virtual_visits[b][0];
+    for (int k=0; k<K; k++) {
+        int t = 0;
+        int parent = 0;
+        int action = -1;
+        while (true) {
+            if (t == -1) break;
+            if (m.terminal[b][t]) break;
+
+            auto p = policy<P>(m, q, bounds, t, visits);
+
+            // Unexpanded edges that an earlier descent has claimed are out, so the 
+            // rest of the distribution gets scaled up to fill the gap.
+            float mass = 0.f;
+            for (int a=0; a<A; a++) {
+                p.pi[a] = p.prob(a);
+                if (m.children[b][t][a] == -1) {
+                    for (int j=0; j<k; j++) {
+                        if ((parents[b][j] == t) && (actions[b][j] == a)) { p.pi[a] = 0.f; }
+                    }
+                }
+                mass += p.pi[a];
+            }
+
+            float rand = float(rands[b][k][t])*mass;
+            float total = 0.f;
+            action = -1; 
+            int valid = -1;
+            for (int a=0; a<A; a++) {
+                float prob = p.pi[a];
+                total += prob;
+                if ((prob > 0) && (total >= rand)) {
+                    action = a;
+                    break;
+                } else if (prob > 0) {
+                    valid = a;
+                }
+            }
+            action = (action >= 0)? action : valid;
+            if (action < 0) {
+                parent = -1;
+                break;
+            }
+            parent = t;
+            t = m.children[b][t][action];
+            if (t >= 0) { visits[t] += 1; }
+        }
+
+        parents[b][k] = parent;
+        actions[b][k] = action;
+    }
+}
+
+template <typename P>
+__host__ std::tuple<TT, TT> descend_many(MCTS<P> m, int K) {
+    using F3D = TensorProxy<typename P::F, 3>;
+    using I2D = TensorProxy<typename P::I, 2>;
+
     c10::cuda::CUDAGuard g(m.logits.t.device());
 
     const uint B = m.logits.size(0);
+    const uint T = m.logits.size(1);
     const uint A = m.logits.size(2);
 
-    auto q = transition_q(m);
+    TT q, bounds;
+    std::tie(q, bounds) = transition_q(m);
+    auto rands = at::rand({B, K, T}, m.logits.t.options());
+    auto virtual_visits = at::zeros({B, T}, m.n.t.options());
+
+    auto parents = m.n.t.new_empty({B, K});
+    auto actions = m.n.t.new_empty({B, K});
+
+    const uint n_blocks = (B + BLOCK - 1)/BLOCK;
+    descend_many_kernel<<<{n_blocks}, {BLOCK}, Policy::memory(A), stream()>>>(
+        m.pta(), F3D(q).pta(), F1D(bounds).pta(), F3D(rands).pta(), I2D(virtual_visits).pta(), I2D(parents).pta(), I2D(actions).pta());
+    C10_CUDA_CHECK(cudaGetLastError());
+
+    return std::make_tuple(parents, actions);
+}
+
+template <typename P>
+__host__ Descent<P> descend(MCTS<P> m) {
+    c10::cuda::CUDAGuard g(m.logits.t.device());
+
+    const uint B = m.logits.size(0);
+    const uint A = m.logits.size(2);
+
+    TT q, bounds;
+    std::tie(q, bounds) = transition_q(m);
     auto rands = at::rand_like(m.logits.t.select(2, 0));
 
-    Descent descent{
-        m.seats.t.new_empty({B}),
-        m.seats.t.new_empty({B})};
+    Descent<P> descent{
+        m.n.t.new_empty({B}),
+        m.n.t.new_empty({B})};
 
     const uint n_blocks = (B + BLOCK - 1)/BLOCK;
     descend_kernel<<<{n_blocks}, {BLOCK}, Policy::memory(A), stream()>>>(
-        m.pta(), H3D(q).pta(), H2D(rands).pta(), descent.pta());
+        m.pta(), TensorProxy<typename P::F, 3>(q).pta(), F1D(bounds).pta(), TensorProxy<typename P::F, 2>(rands).pta(), descent.pta());
     C10_CUDA_CHECK(cudaGetLastError());
 
     return descent;
 }
 
-__global__ void backup_kernel(BackupPTA bk, S1D::PTA leaves) {
+template <typename P>
+__global__ void backup_kernel(BackupPTA<P> bk, typename TensorProxy<typename P::I, 1>::PTA leaves) {
     const uint B = bk.v.size(0);
     const uint S = bk.v.size(2);
     const int b = blockIdx.x*blockDim.x + threadIdx.x;
 
     if (b >= B) return;
+    // Envs that have used up their node budget don't take part in the simulation
+    if (leaves[b] < 0) return;
 
     extern __shared__ float shared[];
     float* v = (float*)&shared[threadIdx.x*S];
@@ -235,7 +373,8 @@ __global__ void backup_kernel(BackupPTA bk, S1D::PTA leaves) {
     }
 }
 
-__host__ void backup(Backup bk, TT leaves) {
+template <typename P>
+__host__ void backup(Backup<P> bk, TT leaves) {
     c10::cuda::CUDAGuard c(leaves.device());
 
     const uint B = bk.v.size(0);
@@ -243,8 +382,18 @@ __host__ void backup(Backup bk, TT leaves) {
 
     const uint n_blocks = (B + BLOCK - 1)/BLOCK;
     backup_kernel<<<{n_blocks}, {BLOCK}, BLOCK*S*sizeof(float), stream()>>>(
-        bk.pta(), S1D(leaves).pta());
+        bk.pta(), TensorProxy<typename P::I, 1>(leaves).pta());
     C10_CUDA_CHECK(cudaGetLastError());
 }
 
+template Descent<Compact> descend(MCTS<Compact> m);
+template std::tuple<TT, TT> descend_many(MCTS<Compact> m, int K);
+template TT root(MCTS<Compact> m);
+template void backup(Backup<Compact> bk, TT leaves);
+
+template Descent<Wide> descend(MCTS<Wide> m);
+template std::tuple<TT, TT> descend_many(MCTS<Wide> m, int K);
+template TT root(MCTS<Wide> m);
+template void backup(Backup<Wide> bk, TT leaves);
+
 }
\ No newline at end of file
@@ -9,19 +9,28 @@ using namespace pybind11::literals;
 using namespace std::string_literals;
 
 #ifdef NOCUDA
-Descent descend(MCTS m) {
+template <typename P>
+Descent<P> descend(MCTS<P> m) {
     return mctscpu::descend(m);
 }
 
-TT root(MCTS m) {
+template <typename P>
+std::tuple<TT, TT> descend_many(MCTS<P> m, int K) {
+    return mctscpu::descend_many(m, K);
+}
+
+template <typename P>
+TT root(MCTS<P> m) {
     return mctscpu::root(m);
 }
 
-void backup(Backup m, TT leaves) {
+template <typename P>
+void backup(Backup<P> m, TT leaves) {
     return mctscpu::backup(m, leaves);
 }
 #else
-Descent descend(MCTS m) {
+template <typename P>
+Descent<P> descend(MCTS<P> m) {
     if (m.logits.t.device().is_cuda()) {
         return mctscuda::descend(m);
     } else {
@@ -29,7 +38,17 @@ Descent descend(MCTS m) {
     }
 }
 
-TT root(MCTS m) {
+template <typename P>
+std::tuple<TT, TT> descend_many(MCTS<P> m, int K) {
+    if (m.logits.t.device().is_cuda()) {
+        return mctscuda::descend_many(m, K);
+    } else {
+        return mctscpu::descend_many(m, K);
+    }
+}
+
+template <typename P>
+TT root(MCTS<P> m) {
     if (m.logits.t.device().is_cuda()) {
         return mctscuda::root(m);
     } else {
@@ -37,7 +56,8 @@ TT root(MCTS m) {
     }
 }
 
-void backup(Backup bk, TT leaves) {
+template <typename P>
+void backup(Backup<P> bk, TT leaves) {
     if (bk.terminal.t.device().is_cuda()) {
         return mctscuda::backup(bk, leaves);
     } else {
@@ -46,29 +66,39 @@ void backup(Backup bk, TT leaves) {
 }
 #endif
 
+template <typename P>
+void bind(py::module& m, std::string prefix) {
 
-PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
-
-    py::class_<Descent>(m, "Descent", py::module_local())
-        .def_property_readonly("parents", [](Descent r) { return r.parents.t; })
-        .def_property_readonly("actions", [](Descent r) { return r.actions.t; });
+    py::class_<Descent<P>>(m, (prefix + "Descent").c_str(), py::module_local())
+        .def_property_readonly("parents", [](Descent<P> r) { return r.parents.t; })
+        .def_property_readonly("actions", [](Descent<P> r) { return r.actions.t; });
     
-    py::class_<MCTS>(m, "MCTS", py::module_local())
-        .def(py::init<TT, TT, TT, TT, TT, TT, TT>(), 
-            "logits"_a, "w"_a, "n"_a, "c_puct"_a, "seats"_a, "terminal"_a, "children"_a)
-        .def_property_readonly("logits", [](MCTS s)  { return s.logits.t; })
-        .def_property_readonly("w", [](MCTS s)  { return s.w.t; })
-        .def_property_readonly("n", [](MCTS s)  { return s.n.t; })
-        .def_property_readonly("c_puct", [](MCTS s)  { return s.c_puct.t; })
-        .def_property_readonly("seats", [](MCTS s)  { return s.seats.t; })
-        .def_property_readonly("terminal", [](MCTS s)  { return s.terminal.t; })
-        .def_property_readonly("children", [](MCTS s)  { return s.children.t; });
+    py::class_<MCTS<P>>(m, (prefix + "MCTS").c_str(), py::module_local())
+        .def(py::init<TT, TT, TT, TT, TT, TT, TT, TT, TT, TT>(), 
+            "logits"_a, "w"_a, "n"_a, "c_puct"_a, "seats"_a, "terminal"_a, "children"_a, "alpha"_a, "prior"_a, "solved"_a)
+        .def_property_readonly("logits", [](MCTS<P> s)  { return s.logits.t; })
+        .def_property_readonly("w", [](MCTS<P> s)  { return s.w.t; })
+        .def_property_readonly("n", [](MCTS<P> s)  { return s.n.t; })
+        .def_property_readonly("c_puct", [](MCTS<P> s)  { return s.c_puct.t; })
+        .def_property_readonly("seats", [](MCTS<P> s)  { return s.seats.t; })
+        .def_property_readonly("terminal", [](MCTS<P> s)  { return s.terminal.t; })
+        .def_property_readonly("children", [](MCTS<P> s)  { return s.children.t; })
+        .def_property_readonly("alpha", [](MCTS<P> s)  { return s.alpha.t; })
+        .def_property_readonly("prior", [](MCTS<P> s)  { return s.prior.t; })
+        .def_property_readonly("solved", [](MCTS<P> s)  { return s.solved.t; });
     
-    py::class_<Backup>(m, "Backup", py::module_local())
+    py::class_<Backup<P>>(m, (prefix + "Backup").c_str(), py::module_local())
         .def(py::init<TT, TT, TT, TT, TT, TT>(),
             "v"_a, "w"_a, "n"_a, "rewards"_a, "parents"_a, "terminal"_a);
 
-    m.def("descend", &descend, "m"_a, py::call_guard<py::gil_scoped_release>());
-    m.def("root", &root, "m"_a, py::call_guard<py::gil_scoped_release>());
-    m.def("backup", &backup, "bk"_a, "leaves"_a, py::call_guard<py::gil_scoped_release>());
-}
\ No newline at end of file
+    // Each precision gets its own overload, and pybind picks whichever matches the argument's class
+    m.def("descend", &descend<P>, "m"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("descend_many", &descend_many<P>, "m"_a, "n_descents"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("root", &root<P>, "m"_a, py::call_guard<py::gil_scoped_release>());
+    m.def("backup", &backup<P>, "bk"_a, "leaves"_a, py::call_guard<py::gil_scoped_release>());
+}
+
+PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
+    bind<Compact>(m, "");
+    bind<Wide>(m, "Wide");
+}
@@ -11,7 +11,7 @@ def module():
     return _cache 
 
 @profiling.nvtx
-def mcts(logits, w, n, c_puct, seats, terminal, children):
+def mcts(logits, w, n, c_puct, seats, terminal, children, alpha=None, prior=None, solved=None):
     B, T, A = logits.shape
     S = w.shape[-1]
     cuda.assert_shape(w, (B, T, S))
@@ -20,19 +20,35 @@ def mcts(logits, w, n, c_puct, seats, terminal, children):
     cuda.assert_shape(seats, (B, T))
     cuda.assert_shape(terminal, (B, T))
     cuda.assert_shape(children, (B, T, A))
+    # Alphas of zero mean a cold start
+    alpha = torch.zeros((B, T), device=logits.device) if alpha is None else alpha
+    cuda.assert_shape(alpha, (B, T))
+    # The prior should be the exponentiated logits. If it isn't passed, it's worked out here, once per call.
+    prior = logits.float().exp() if prior is None else prior
+    cuda.assert_shape(prior, (B, T, A))
+    # A visit count of -1 means no alpha's known to be current, so every node gets solved
+    solved = torch.full((B, T, 3), -1., device=logits.device) if solved is None else solved
+    cuda.assert_shape(solved, (B, T, 3))
     assert (c_puct > 0.).all(), 'Zero c_puct not supported; will lead to an infinite loop in the kernel'
     assert len({logits.device, w.device, n.device, c_puct.device, seats.device, terminal.device, children.device}) == 1, 'Inputs span multiple devices'
 
-    return module().MCTS(logits, w, n, c_puct, seats.short(), terminal, children)
+    # Short counts mean the compact half/short kernels; anything else is the wide float/int ones.
+    cls = module().MCTS if n.dtype == torch.short else module().WideMCTS
+    return cls(logits, w, n, c_puct, seats.short(), terminal, children, alpha, prior, solved)
 
 @profiling.nvtx
-def Backup(*args, **kwargs):
-    return module().Backup(*args, **kwargs)
+def Backup(v, w, n, rewards, parents, terminal):
+    cls = module().Backup if n.dtype == torch.short else module().WideBackup
+    return cls(v, w, n, rewards, parents, terminal)
 
 @profiling.nvtx
 def descend(*args, **kwargs):
     return module().descend(*args, **kwargs)
 
+@profiling.nvtx
+def descend_many(*args, **kwargs):
+    return module().descend_many(*args, **kwargs)
+
 @profiling.nvtx
 def root(*args, **kwargs):
     return module().root(*args, **kwargs)
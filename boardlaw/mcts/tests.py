@@ -23,6 +23,62 @@ def test_root_one_node(device='cuda'):
     actual = cuda.root(m)
     torch.testing.assert_allclose(expected, actual, rtol=1e-3, atol=1e-3)
 
+def test_root_warm_start(device='cuda'):
+    torch.manual_seed(0)
+    B, A = 64, 9
+    data = arrdict.arrdict(
+        logits=torch.randn((B, 1+A, A)).log_softmax(-1).half(),
+        w=torch.rand((B, 1+A, 1)).half(),
+        n=torch.randint(1, 10, (B, 1+A)).short(),
+        c_puct=torch.full((B,), 1/16).half(),
+        seats=torch.zeros((B, 1+A)).short(),
+        terminal=torch.zeros((B, 1+A), dtype=torch.bool),
+        children=torch.cat([torch.arange(1, 1+A)[None].expand(1, A), torch.full((A, A), -1)])[None].expand(B, -1, -1).short().contiguous())
+    data = data.to(device)
+
+    cold = cuda.root(cuda.mcts(**data))
+
+    # Whether the search starts from its last solution or from miles above it, it should end up in the same place
+    alpha = torch.zeros((B, 1+A), device=device)
+    first = cuda.root(cuda.mcts(**data, alpha=alpha))
+    assert (alpha[:, 0] > 0).all()
+    second = cuda.root(cuda.mcts(**data, alpha=alpha))
+    alpha[:] = 100.
+    third = cuda.root(cuda.mcts(**data, alpha=alpha))
+
+    for probs in [first, second, third]:
+        torch.testing.assert_close(probs.float(), cold.float(), rtol=0, atol=2e-3)
+    torch.testing.assert_close(third.float().sum(-1), torch.ones(B, device=device), rtol=0, atol=2e-3)
+
+def test_root_cached(device='cuda'):
+    torch.manual_seed(0)
+    B, A = 64, 9
+    data = arrdict.arrdict(
+        logits=torch.randn((B, 1+A, A)).log_softmax(-1).half(),
+        w=torch.rand((B, 1+A, 1)).half(),
+        n=torch.randint(1, 10, (B, 1+A)).short(),
+        c_puct=torch.full((B,), 1/16).half(),
+        seats=torch.zeros((B, 1+A)).short(),
+        terminal=torch.zeros((B, 1+A), dtype=torch.bool),
+        children=torch.cat([torch.arange(1, 1+A)[None].expand(1, A), torch.full((A, A), -1)])[None].expand(B, -1, -1).short().contiguous())
+    data = data.to(device)
+
+    alpha = torch.zeros((B, 1+A), device=device)
+    solved = torch.full((B, 1+A, 3), -1., device=device)
+    first = cuda.root(cuda.mcts(**data, alpha=alpha, solved=solved))
+    assert (solved[:, 0, 0] == data.n[:, 0].float()).all()
+
+    # With nothing changed, the last solution gets reused as it is - so a mangled one comes straight back out
+    alpha[:, 0] += 1.
+    stale = cuda.root(cuda.mcts(**data, alpha=alpha, solved=solved))
+    assert not torch.allclose(stale.float(), first.float(), rtol=0, atol=2e-3)
+
+    # But a change to the node's visit count means solving again
+    data['n'] = data.n.clone()
+    data.n[:, 0] += 1
+    again = cuda.root(cuda.mcts(**data, alpha=alpha, solved=solved))
+    torch.testing.assert_close(again.float(), first.float(), rtol=0, atol=2e-3)
+
 ### DESCEND TESTS
 
 def assert_distribution(xs, freqs):
@@ -278,6 +334,260 @@ def test_multienv():
     expected = torch.tensor([[1/8.], [1/8.]], device=world.device)
     torch.testing.assert_allclose(m.root().v, expected)
 
+def test_reroot():
+    from .. import hex
+    worlds = hex.Hex.initial(8, boardsize=4, device='cpu')
+    network = validation.RandomAgent()
+    m = mcts(worlds, network, n_nodes=16)
+
+    # Play the most-visited move, so there's a subtree to carry over
+    children = m.tree.children[:, 0].long()
+    visits = m.stats.n.gather(1, children.clamp(0, None)).where(children >= 0, torch.full_like(children, -1, dtype=torch.short))
+    actions = visits.argmax(-1)
+    children = children[m.envs, actions]
+    n, w = m.stats.n[m.envs, children].clone(), m.stats.w[m.envs, children].clone()
+    worlds, _ = worlds.step(actions)
+
+    # Every env should find its new root among the old root's children, and keep its visit counts
+    assert (children > 0).all()
+    assert m.reroot(worlds, network)
+    assert (m.tree.parents[:, 0] == -1).all()
+    assert torch.equal(m.stats.n[:, 0], n)
+    assert torch.equal(m.stats.w[:, 0], w)
+    assert torch.equal(m.worlds.hash[:, 0], worlds.hash)
+
+    # The kept nodes should be a well-formed tree in the low indices
+    check_tree(m)
+
+    # Topping back up should fill every env's budget
+    carried = m.sim.clone()
+    m = mcts(worlds, network, tree=m, n_nodes=16)
+    assert (m.sim == 16).all()
+    assert torch.equal(m.carried, carried)
+
+    # An agent reusing its tree should only count the nodes it added, and forgetting should start it afresh
+    agent = MCTSAgent(network, n_nodes=16, reuse=True)
+    decisions = agent(worlds)
+    assert (decisions.n_sims == 17).all()
+    worlds, _ = worlds.step(decisions.actions)
+    decisions = agent(worlds)
+    assert (decisions.n_sims == 17 - agent._tree.carried).all() and (decisions.n_sims < 17).any()
+    agent.forget()
+    assert (agent(worlds).n_sims == 17).all()
+
+def check_tree(m):
+    for e in range(m.n_envs):
+        for i in range(1, int(m.sim[e])):
+            p, a = int(m.tree.parents[e, i]), int(m.tree.relation[e, i])
+            if p == -1:
+                # A descent that revisited a terminal leaf leaves a gap
+                continue
+            assert 0 <= p < i
+            assert m.tree.children[e, p, a] == i
+            child, _ = m.worlds[e, p][None].step(torch.tensor([a]))
+            assert torch.equal(child.hash[0], m.worlds.hash[e, i])
+        assert (m.tree.parents[e, int(m.sim[e]):] == -1).all()
+        assert (m.stats.n[e, int(m.sim[e]):] == 0).all()
+
+def test_many_leaves():
+    from .. import hex
+    worlds = hex.Hex.initial(8, boardsize=4, device='cpu')
+    network = validation.RandomAgent()
+    m = mcts(worlds, network, n_nodes=33, n_descents=8)
+
+    # Four rounds of eight descents should fill the tree, with virtual loss spreading them over distinct leaves
+    assert (m.sim == 33).all()
+    assert ((m.tree.parents[:, 1:] >= 0).sum(-1) > 24).all()
+    check_tree(m)
+
+    # Every visit to a fresh root passes through exactly one of its children
+    children = m.tree.children[:, 0].long()
+    visits = m.stats.n.gather(1, children.clamp(0, None)).where(children >= 0, torch.zeros_like(children, dtype=torch.short))
+    assert torch.equal(m.stats.n[:, 0].long(), visits.long().sum(-1))
+
+    # And the agent should be able to run it too
+    decisions = MCTSAgent(network, n_nodes=17, n_descents=4)(worlds)
+    assert (decisions.n_leaves > 1).all()
+
+class HashNetwork:
+    """Gives each position a value that depends only on its hash, and counts how many it's asked to evaluate"""
+
+    def __init__(self):
+        self.n_evals = 0
+
+    def __call__(self, world, value=True):
+        self.n_evals += world.n_envs
+        v = (world.hash[..., 0] % 101).float()/100
+        return arrdict.arrdict(
+            logits=validation.uniform_logits(world.valid),
+            v=torch.stack([v, -v], -1))
+
+def test_share_evals():
+    from .. import hex
+
+    torch.manual_seed(0)
+    worlds = hex.Hex.initial(4, boardsize=3, device='cpu')
+    counts = {}
+    for share_evals in [None, 'env', 'batch']:
+        network = HashNetwork()
+        m = mcts(worlds, network, n_nodes=128, share_evals=share_evals)
+        counts[share_evals] = network.n_evals
+        check_tree(m)
+
+        # Shared evaluations should be the evaluations of the same position
+        nodes = (m.tree.parents >= 0) & ~m.transitions.terminal
+        expected = (m.worlds.hash[..., 0] % 101).float()/100
+        torch.testing.assert_close(m.decisions.v[..., 0][nodes].float(), expected[nodes], atol=1e-3, rtol=0)
+
+    assert counts['batch'] < counts['env'] < counts[None]
+
+def test_compact():
+    from .. import hex
+
+    worlds = hex.Hex.initial(8, boardsize=4, device='cpu')
+    network = validation.RandomAgent()
+
+    # With the same seed, keeping only the root world should give exactly the same search
+    torch.manual_seed(0)
+    full = mcts(worlds, network, n_nodes=33)
+    torch.manual_seed(0)
+    compact = mcts(worlds, network, n_nodes=33, compact=True)
+    assert torch.equal(full.tree.children, compact.tree.children)
+    assert torch.equal(full.stats.n, compact.stats.n)
+    assert torch.equal(full.worlds.hash, compact.worlds.hash)
+
+    nodes = torch.arange(compact.n_nodes)[None].expand(compact.n_envs, -1)
+    replayed = compact.world_at(compact.envs[:, None].expand_as(nodes).flatten(), nodes.flatten())
+    live = (full.tree.parents >= 0).flatten()
+    assert torch.equal(replayed.board[live], full.worlds.board.flatten(0, 1)[live])
+
+def test_bitboard():
+    from .. import hex
+
+    worlds = hex.Hex.initial(8, boardsize=4, device='cpu')
+    network = validation.RandomAgent()
+
+    # Bitboards play the same as regular boards, so the search should be exactly the same too
+    torch.manual_seed(0)
+    expected = mcts(worlds, network, n_nodes=33, n_descents=4)
+    torch.manual_seed(0)
+    actual = mcts(hex.Bitboard.from_hex(worlds), network, n_nodes=33, n_descents=4)
+    assert torch.equal(actual.tree.children, expected.tree.children)
+    assert torch.equal(actual.stats.n, expected.stats.n)
+    assert torch.equal(actual.worlds.hash, expected.worlds.hash)
+    assert torch.equal(actual.worlds.board, expected.worlds.board)
+    check_tree(actual)
+
+def test_adaptive():
+    from .. import hex
+
+    worlds = hex.Hex.initial(8, boardsize=3, device='cpu')
+    network = validation.RandomAgent()
+
+    torch.manual_seed(0)
+    m = mcts(worlds, network, n_nodes=64, stop_kl=.01)
+    check_tree(m)
+    assert (m.sim <= 64).all()
+    assert m.stopped.any() and (m.sim < 64).any()
+    assert (m.stopped | (m.sim == 64)).all()
+
+    agent = MCTSAgent(network, n_nodes=64, stop_kl=.01)
+    decisions = agent(worlds)
+    assert (decisions.n_sims <= 65).all()
+    assert (worlds.valid.gather(1, decisions.actions[:, None].long())).all()
+
+def test_workspace():
+    from .. import hex
+    from . import Workspace
+
+    worlds = hex.Hex.initial(8, boardsize=3, device='cpu')
+    network = validation.RandomAgent()
+    workspace = Workspace()
+
+    first = mcts(worlds, network, n_nodes=16, workspace=workspace)
+    ptr = first.tree.children.data_ptr()
+    check_tree(first)
+
+    # A second search of the same size fills the same buffers, and ends up just as valid as a fresh one
+    worlds, _ = worlds.step(first.root().logits.argmax(-1))
+    second = mcts(worlds, network, n_nodes=16, workspace=workspace)
+    assert second.tree.children.data_ptr() == ptr
+    assert (second.worlds.board[:, 0] == worlds.board).all()
+    check_tree(second)
+
+    # A different env count needs new buffers
+    third = mcts(worlds[:4], network, n_nodes=16, workspace=workspace)
+    assert third.tree.children.shape[0] == 4
+    check_tree(third)
+
+def test_wide():
+    from .. import hex
+
+    worlds = hex.Hex.initial(8, boardsize=3, device='cpu')
+    network = validation.RandomAgent()
+
+    m = mcts(worlds, network, n_nodes=64, precision='wide', n_descents=4)
+    assert m.stats.n.dtype == torch.int and m.stats.w.dtype == torch.float
+    assert m.tree.children.dtype == torch.int
+    check_tree(m)
+
+    root = m.root()
+    assert root.logits.dtype == torch.float
+    torch.testing.assert_close(root.logits.exp().sum(-1), torch.ones(8), rtol=0, atol=1e-2)
+
+    with pytest.raises(ValueError):
+        mcts(worlds, network, n_nodes=40000)
+
+def test_pipeline():
+    from .. import hex
+
+    # An odd env count, so the halves are different sizes
+    worlds = hex.Hex.initial(7, boardsize=3, device='cpu')
+    network = validation.RandomAgent()
+
+    m = mcts(worlds, network, n_nodes=33, pipeline=True)
+    check_tree(m)
+    assert (m.sim == 33).all()
+    assert (m.stats.n[:, 0] > 0).all()
+    # Both threads' timings should be counted
+    assert len(m._timings) == 2
+    assert {'descend', 'step', 'forward', 'backup'} <= set(m.timings)
+
+    m = mcts(worlds, network, n_nodes=33, pipeline=True, n_descents=3, share_evals='env')
+    check_tree(m)
+    assert (m.sim == 33).all()
+
+    agent = MCTSAgent(network, n_nodes=33, pipeline=True, reuse=True, stop_kl=.01)
+    for _ in range(2):
+        decisions = agent(worlds)
+        assert (decisions.n_sims <= 34).all()
+        worlds, _ = worlds.step(decisions.actions)
+    check_tree(agent._tree)
+
+def test_timings():
+    from .. import hex
+
+    worlds = hex.Hex.initial(4, boardsize=3, device='cpu')
+    m = mcts(worlds, validation.RandomAgent(), n_nodes=16)
+    m.root()
+    assert set(m.timings) == {'descend', 'step', 'forward', 'backup', 'root'}
+    assert all(t > 0 for t in m.timings.values())
+
+def test_playout_cap():
+    from .. import hex
+
+    torch.manual_seed(0)
+    worlds = hex.Hex.initial(64, boardsize=3, device='cpu')
+    agent = MCTSAgent(validation.RandomAgent(), n_nodes=32, playout_cap=(.25, 8))
+
+    decisions = agent(worlds)
+    assert 0 < decisions.full.sum() < 64
+    assert (decisions.n_sims[decisions.full] == 33).all()
+    assert (decisions.n_sims[~decisions.full] == 9).all()
+
+    decisions = agent(worlds, eval=True)
+    assert decisions.full.all() and (decisions.n_sims == 33).all()
+
 def full_game_mcts(s, n_nodes, **kwargs):
     from .. import hex
     world = hex.from_string(s, device='cuda')
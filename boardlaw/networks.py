@@ -4,8 +4,9 @@ from . import heads
 from torch import nn
 import torch.jit
 from rebar import recurrence, arrdict, profiling
+from pavlov import stats
 from torch.nn import functional as F
-from collections import namedtuple
+from collections import namedtuple, defaultdict
 
 class ReZeroResidual(nn.Linear):
 
@@ -35,4 +36,239 @@ class FCModel(nn.Module):
         neck = self.body(worlds.obs)
         return arrdict.arrdict(
             logits=self.policy(neck, worlds.valid), 
-            v=self.value(neck, worlds.valid, worlds.seats))
\ No newline at end of file
+            v=self.value(neck, worlds.valid, worlds.seats))
+
+class EvalCache(nn.Module):
+
+    def __init__(self, network, size=2**16):
+        """Wraps `network`, remembering its outputs for the `size` most-recently-used positions. Positions are keyed 
+        on their 64-bit Zobrist hash, so the worlds need a `hash` field. The key isn't checked against the position 
+        itself, so if two positions' hashes collide, the second is handed the first's evaluation. Any change to the 
+        network's weights - through `load_state_dict`, an optimizer step or a move to another device - drops the 
+        whole cache."""
+        super().__init__()
+        self.network = network
+        self.size = size
+
+        # Running totals, kept as tensors on the cache's device so that counting doesn't force a sync. The `hits`, 
+        # `misses` and `evictions` properties read them out as ints.
+        self._counts = defaultdict(int)
+
+        self._weights = None
+        self.clear()
+
+    @property
+    def hits(self):
+        return int(self._counts['hits'])
+
+    @property
+    def misses(self):
+        return int(self._counts['misses'])
+
+    @property
+    def evictions(self):
+        return int(self._counts['evictions'])
+
+    def weights(self):
+        return tuple((t.data_ptr(), t._version) for t in self.network.state_dict(keep_vars=True).values())
+
+    def clear(self):
+        self.keys = None
+        self.outputs = None
+        self.last_used = None
+        self._step = 0
+
+    def _lookup(self, keys):
+        if self.keys is None:
+            return torch.zeros_like(keys, dtype=torch.bool), torch.zeros_like(keys)
+
+        occupied = (self.last_used >= 0).nonzero(as_tuple=True)[0]
+        if len(occupied) == 0:
+            return torch.zeros_like(keys, dtype=torch.bool), torch.zeros_like(keys)
+
+        stored, order = self.keys[occupied].sort()
+        idxs = torch.searchsorted(stored, keys.contiguous()).clamp(None, len(stored)-1)
+        return (stored[idxs] == keys), occupied[order[idxs]]
+
+    def _insert(self, keys, outputs):
+        if self.outputs is None:
+            self.keys = keys.new_zeros((self.size,))
+            self.outputs = outputs.map(lambda x: x.new_zeros((self.size, *x.shape[1:])))
+            self.last_used = keys.new_full((self.size,), -1)
+
+        # Only the first copy of each position needs storing
+        unique, inverse = torch.unique(keys, return_inverse=True)
+        first = torch.empty_like(unique).scatter_(0, inverse, torch.arange(len(keys), device=keys.device))
+        first = first[-self.size:]
+
+        victims = self.last_used.topk(len(first), largest=False).indices
+        evicted = (self.last_used[victims] >= 0).sum()
+        self.keys[victims] = keys[first]
+        self.outputs[victims] = outputs[first]
+        self.last_used[victims] = self._step
+
+        self._counts['evictions'] = self._counts['evictions'] + evicted
+        stats.cumsum('eval-cache.evictions', evicted)
+
+    @profiling.nvtx
+    def forward(self, worlds):
+        if 'hash' not in worlds:
+            raise ValueError('Caching evaluations needs worlds with a `hash` field')
+
+        weights = self.weights()
+        if weights != self._weights:
+            self.clear()
+            self._weights = weights
+        self._step += 1
+
+        keys = worlds.hash[..., 0]
+        hit, slots = self._lookup(keys)
+        miss = ~hit
+        if self.outputs is not None:
+            self.last_used[slots[hit]] = self._step
+
+        if hit.all():
+            outputs = self.outputs[slots]
+        else:
+            fresh = self.network(worlds[miss])
+            # The hits have to be read out before the misses go in, since the misses might evict them
+            if self.outputs is None:
+                outputs = fresh.map(lambda x: x.new_zeros((len(keys), *x.shape[1:])))
+            else:
+                outputs = self.outputs[slots]
+            outputs[miss] = fresh
+            self._insert(keys[miss], fresh)
+
+        self._counts['hits'] = self._counts['hits'] + hit.sum()
+        self._counts['misses'] = self._counts['misses'] + miss.sum()
+        stats.mean('eval-cache.hit-rate', hit.sum(), hit.nelement())
+        return outputs
+
+    def state_dict(self, *args, **kwargs):
+        return self.network.state_dict(*args, **kwargs)
+
+    def load_state_dict(self, sd, *args, **kwargs):
+        return self.network.load_state_dict(sd, *args, **kwargs)
+
+class Deduplicator(nn.Module):
+
+    def __init__(self, network):
+        """Wraps `network` so that envs holding the same position share a single forward pass. Positions are told 
+        apart by their hash and seat, so the worlds need a `hash` field; two positions whose hashes collide would 
+        share an evaluation. Only the unique positions are evaluated, and their outputs are scattered back to every 
+        env that holds them."""
+        super().__init__()
+        self.network = network
+
+    @profiling.nvtx
+    def forward(self, worlds):
+        if 'hash' not in worlds:
+            raise ValueError('Deduplicating evaluations needs worlds with a `hash` field')
+        B = worlds.n_envs
+        rows = torch.cat([worlds.hash.reshape(B, -1).long(), worlds.seats.reshape(B, -1).long()], -1)
+        unique, inverse = torch.unique(rows, dim=0, return_inverse=True)
+        first = inverse.new_empty((len(unique),)).scatter_(0, inverse, torch.arange(len(inverse), device=inverse.device))
+        stats.mean('dedup.unique-frac', len(first), worlds.n_envs)
+        return self.network(worlds[first])[inverse]
+
+    def state_dict(self, *args, **kwargs):
+        return self.network.state_dict(*args, **kwargs)
+
+    def load_state_dict(self, sd, *args, **kwargs):
+        return self.network.load_state_dict(sd, *args, **kwargs)
+
+def test_eval_cache():
+    from . import hex
+
+    worlds = hex.Hex.initial(8, boardsize=3, device='cpu')
+    network = FCModel(worlds.obs_space, worlds.action_space, width=16, depth=1)
+    cache = EvalCache(network, size=4)
+
+    with torch.no_grad():
+        expected = network(worlds)
+        first = cache(worlds)
+        torch.testing.assert_close(first.logits, expected.logits)
+        torch.testing.assert_close(first.v, expected.v)
+        assert cache.misses == 8 and cache.hits == 0
+        assert isinstance(cache.misses, int)
+
+        # All eight envs hold the same position, so it's been stored once and is a hit from now on
+        second = cache(worlds)
+        torch.testing.assert_close(second.logits, expected.logits)
+        assert cache.hits == 8
+
+        # Nine new positions go through a cache of four, pushing out the empty board along the way
+        for a in range(9):
+            actions = torch.full((worlds.n_envs,), a, dtype=torch.long)
+            cache(worlds.step(actions)[0])
+        assert cache.evictions == 6
+        cache(worlds)
+        assert cache.hits == 8
+
+        # Changing the weights drops the cache
+        sd = {k: v + 1 for k, v in network.state_dict().items()}
+        cache.load_state_dict(sd)
+        third = cache(worlds)
+        assert cache.hits == 8
+        torch.testing.assert_close(third.v, network(worlds).v)
+
+def test_eval_cache_overflow():
+    from . import hex
+
+    worlds = hex.Hex.initial(1, boardsize=3, device='cpu')
+    network = FCModel(worlds.obs_space, worlds.action_space, width=16, depth=1)
+    cache = EvalCache(network, size=4)
+
+    # One position that's a hit, alongside more misses than the cache can hold. Storing the misses evicts the hit, 
+    # which mustn't change what's returned for it.
+    stepped, _ = hex.Hex.initial(4, boardsize=3, device='cpu').step(torch.arange(4))
+    batch = arrdict.cat([worlds, stepped])
+    with torch.no_grad():
+        cache(worlds)
+        actual = cache(batch)
+        expected = network(batch)
+    assert cache.hits == 1
+    torch.testing.assert_close(actual.logits, expected.logits)
+    torch.testing.assert_close(actual.v, expected.v)
+
+def test_deduplicator():
+    from . import hex
+
+    worlds = hex.Hex.initial(8, boardsize=3, device='cpu')
+    actions = torch.tensor([0, 1, 0, 1, 2, 0, 0, 1])
+    worlds, _ = worlds.step(actions)
+
+    network = FCModel(worlds.obs_space, worlds.action_space, width=16, depth=1)
+    sizes = []
+    network.register_forward_pre_hook(lambda m, args: sizes.append(args[0].n_envs))
+    dedup = Deduplicator(network)
+
+    with torch.no_grad():
+        expected = network(worlds)
+        actual = dedup(worlds)
+    torch.testing.assert_close(actual.logits, expected.logits)
+    torch.testing.assert_close(actual.v, expected.v)
+    assert sizes == [8, 3]
+
+def test_cached_deduplicator():
+    from . import hex
+    from .mcts import MCTSAgent
+
+    worlds = hex.Hex.initial(8, boardsize=3, device='cpu')
+    worlds, _ = worlds.step(torch.tensor([0, 1, 0, 1, 2, 0, 0, 1]))
+    network = FCModel(worlds.obs_space, worlds.action_space, width=16, depth=1)
+
+    # Stacked the way the arena stacks them
+    wrapped = EvalCache(Deduplicator(network), size=16)
+    with torch.no_grad():
+        torch.testing.assert_close(wrapped(worlds).v, network(worlds).v)
+        assert wrapped.misses == 8
+
+        sd = {k: v + 1 for k, v in network.state_dict().items()}
+        wrapped.load_state_dict(sd)
+        torch.testing.assert_close(wrapped(worlds).v, network(worlds).v)
+        assert wrapped.misses == 16
+
+    agent = MCTSAgent(wrapped, n_nodes=4)
+    agent(worlds)
+    agent.load_state_dict(agent.state_dict())
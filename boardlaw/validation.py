@@ -22,7 +22,7 @@ class ProxyAgent:
 
 class RandomAgent:
 
-    def __call__(self, world, value=True):
+    def __call__(self, world, value=True, eval=False):
         B, _ = world.valid.shape
         return arrdict.arrdict(
             logits=torch.log(world.valid.float()/world.valid.sum(-1, keepdims=True)),
@@ -36,6 +36,11 @@ class MonteCarloAgent:
         self.temperature = temperature
 
     def rollout(self, world):
+        if getattr(world, 'playout', None) is not None:
+            # Worlds that can play themselves out natively
+            _, responses = world.playout()
+            return responses.rewards, responses.first_actions
+
         B, _ = world.valid.shape
 
         live = torch.ones((B,), dtype=torch.bool, device=world.device)